@@ -0,0 +1,352 @@
+# broadcast.py - Reklama yuborish: rate limit, parallel yuboruvchilar, davom ettirish
+import asyncio
+import logging
+import os
+import time
+from typing import Dict, List, Optional
+
+from aiogram import Bot
+from aiogram.exceptions import (
+    TelegramAPIError, TelegramBadRequest, TelegramForbiddenError,
+    TelegramNetworkError, TelegramRetryAfter, TelegramServerError,
+)
+from aiogram.types import InlineKeyboardButton, InlineKeyboardMarkup
+
+from database import (
+    BroadcastJob, count_segment, create_broadcast_job, get_broadcast_job,
+    list_segment_user_ids_after, list_unfinished_broadcast_jobs, mark_unreachable,
+    save_broadcast_checkpoint, set_broadcast_progress_message, set_broadcast_status,
+)
+
+log = logging.getLogger("broadcast")
+
+# Telegram umumiy limiti ~30 xabar/soniya — biroz zaxira qoldiramiz
+BROADCAST_RATE = float(os.getenv("BROADCAST_RATE", "25"))
+BROADCAST_WORKERS = int(os.getenv("BROADCAST_WORKERS", "8"))
+BROADCAST_PAGE_SIZE = int(os.getenv("BROADCAST_PAGE_SIZE", "500"))
+BROADCAST_PROGRESS_INTERVAL = float(os.getenv("BROADCAST_PROGRESS_INTERVAL", "3"))
+_MAX_ATTEMPTS = 3
+
+UNREACHABLE_BLOCKED = "blocked"
+UNREACHABLE_DEACTIVATED = "deactivated"
+UNREACHABLE_CHAT_NOT_FOUND = "chat_not_found"
+
+
+def unreachable_reason(error: Exception) -> Optional[str]:
+    """
+    Telegram xatosidan foydalanuvchiga umuman yetib bo'lmasligini aniqlaydi.
+    Boshqa xatolar (masalan, nusxalanadigan xabar o'chirilgan) foydalanuvchiga
+    bog'liq emas — ular uchun None.
+    """
+    message = (getattr(error, "message", "") or "").lower()
+    if isinstance(error, TelegramForbiddenError):
+        if "deactivated" in message:
+            return UNREACHABLE_DEACTIVATED
+        return UNREACHABLE_BLOCKED
+    if isinstance(error, TelegramBadRequest):
+        if "chat not found" in message or "user not found" in message or "peer_id_invalid" in message:
+            return UNREACHABLE_CHAT_NOT_FOUND
+    return None
+
+
+class TokenBucket:
+    """
+    Soniyasiga ``rate`` ta token, ``capacity`` tagacha to'planadi.
+    ``block()`` 429 javobidagi ``retry_after`` davomida barcha
+    yuboruvchilarni to'xtatadi.
+    """
+
+    def __init__(self, rate: float, capacity: Optional[float] = None):
+        self.rate = rate
+        self.capacity = capacity or rate
+        self._tokens = self.capacity
+        self._updated = time.monotonic()
+        self._blocked_until = 0.0
+        self._lock = asyncio.Lock()
+
+    def block(self, seconds: float):
+        self._blocked_until = max(self._blocked_until, time.monotonic() + seconds)
+        self._tokens = 0.0
+        self._updated = self._blocked_until
+
+    async def acquire(self):
+        # Lock navbatni adolatli qiladi: kutganlar kelish tartibida token oladi
+        async with self._lock:
+            while True:
+                now = time.monotonic()
+                if now < self._blocked_until:
+                    await asyncio.sleep(self._blocked_until - now)
+                    continue
+                self._tokens = min(self.capacity, self._tokens + (now - self._updated) * self.rate)
+                self._updated = now
+                if self._tokens >= 1:
+                    self._tokens -= 1
+                    return
+                await asyncio.sleep((1 - self._tokens) / self.rate)
+
+
+# segment -> (tugma matni, argument so'rovi). Shartlar: database.BROADCAST_SEGMENTS
+SEGMENT_LABELS = {
+    "all": ("👥 Hammaga", None),
+    "verified": ("✅ Tasdiqlanganlar", None),
+    "pending_withdraw": ("⏳ Yechish so'rovi kutilayotganlar", None),
+    "balance_above": ("💰 Balansi X dan yuqori", "💰 Balans chegarasini kiriting (masalan: 100):"),
+    "joined_days": ("🆕 Oxirgi N kunda qo'shilganlar", "🆕 Necha kun ichida qo'shilganlar? (masalan: 7):"),
+    "ref_by": ("🤝 Taklif qiluvchi bo'yicha", "🤝 Taklif qiluvchining ID raqamini kiriting:"),
+    "inactive_days": ("💤 N kundan beri faol emaslar", "💤 Necha kundan beri faol emas? (masalan: 30):"),
+}
+
+
+def segment_title(segment: str, arg: Optional[int] = None) -> str:
+    label = SEGMENT_LABELS.get(segment, (segment, None))[0]
+    for placeholder in (" X ", " N "):
+        if arg is not None and placeholder in label:
+            return label.replace(placeholder, f" {arg} ")
+    if arg is not None and segment == "ref_by":
+        return f"{label}: {arg}"
+    return label
+
+
+def segment_keyboard() -> InlineKeyboardMarkup:
+    return InlineKeyboardMarkup(inline_keyboard=[
+        [InlineKeyboardButton(text=label, callback_data=f"bc_seg:{segment}")]
+        for segment, (label, _) in SEGMENT_LABELS.items()
+    ])
+
+
+def progress_keyboard(job_id: int, status: str) -> Optional[InlineKeyboardMarkup]:
+    if status == "running":
+        toggle = InlineKeyboardButton(text="⏸ Pauza", callback_data=f"bc_pause:{job_id}")
+    elif status == "paused":
+        toggle = InlineKeyboardButton(text="▶️ Davom ettirish", callback_data=f"bc_resume:{job_id}")
+    else:
+        return None
+    cancel = InlineKeyboardButton(text="⛔ Bekor qilish", callback_data=f"bc_cancel:{job_id}")
+    return InlineKeyboardMarkup(inline_keyboard=[[toggle, cancel]])
+
+
+class BroadcastRunner:
+    """Bitta reklama vazifasi. Holat ``broadcast_jobs`` jadvalida saqlanadi."""
+
+    def __init__(self, bot: Bot, job: BroadcastJob, limiter: TokenBucket):
+        self.bot = bot
+        self.job = job
+        self.limiter = limiter
+        self.status = job.status
+        self.cursor = job.last_user_id
+        self.sent = job.sent
+        self.failed = job.failed
+        self.total = job.total
+        self.unreachable = 0
+        self.task: Optional[asyncio.Task] = None
+        self._resume = asyncio.Event()
+        if self.status == "running":
+            self._resume.set()
+        self._started = time.monotonic()
+        self._done_at_start = self.sent + self.failed
+        self._last_text: Optional[str] = None
+        self._saved = (self.cursor, self.sent, self.failed)
+        # Joriy sahifa: yuborilganlar belgisi va uzluksiz bajarilgan prefiks
+        self._page: List[int] = []
+        self._done: List[bool] = []
+        self._prefix = 0
+
+    @property
+    def processed(self) -> int:
+        return self.sent + self.failed
+
+    def render(self) -> str:
+        titles = {
+            "running": "⏳ yuborilmoqda",
+            "paused": "⏸ pauzada",
+            "cancelled": "⛔ bekor qilindi",
+            "done": "✅ yakunlandi",
+        }
+        percent = self.processed * 100 // self.total if self.total else 100
+        text = (
+            f"📢 <b>Reklama #{self.job.id}</b> — {titles.get(self.status, self.status)}\n"
+            f"🎯 {segment_title(self.job.segment, self.job.segment_arg)}\n"
+            f"📬 Yuborilgan: <b>{self.sent}</b>\n"
+            f"❌ Yetkazilmagan: <b>{self.failed}</b> (🚫 bloklagan/o'chirilgan: {self.unreachable})\n"
+            f"👥 Jami: <b>{self.total}</b> ({percent}%)"
+        )
+        if self.status == "running":
+            elapsed = time.monotonic() - self._started
+            rate = (self.processed - self._done_at_start) / elapsed if elapsed > 0 else 0.0
+            left = max(self.total - self.processed, 0)
+            eta = f"~{left / rate / 60:.0f} daq" if rate > 0 else "—"
+            text += f"\n⚡ Tezlik: <b>{rate:.1f}</b> xabar/s, qolgan vaqt: <b>{eta}</b>"
+        return text
+
+    async def _deliver(self, user_id: int) -> bool:
+        for _ in range(_MAX_ATTEMPTS):
+            await self.limiter.acquire()
+            try:
+                await self.bot.copy_message(
+                    chat_id=user_id, from_chat_id=self.job.from_chat_id, message_id=self.job.message_id
+                )
+                return True
+            except TelegramRetryAfter as e:
+                log.warning("broadcast #%s: flood control, waiting %ss", self.job.id, e.retry_after)
+                self.limiter.block(e.retry_after)
+            except (TelegramNetworkError, TelegramServerError) as e:
+                log.warning("broadcast #%s: %s, retrying %s", self.job.id, e, user_id)
+                await asyncio.sleep(1)
+            except (TelegramForbiddenError, TelegramBadRequest) as e:
+                reason = unreachable_reason(e)
+                if reason:
+                    # Keyingi reklamalarda bu foydalanuvchi o'tkazib yuboriladi
+                    self.unreachable += 1
+                    await mark_unreachable(user_id, reason)
+                return False
+            except TelegramAPIError as e:
+                log.warning("broadcast #%s: %s failed: %s", self.job.id, user_id, e)
+                return False
+        return False
+
+    async def _worker(self, queue: asyncio.Queue):
+        while not queue.empty():
+            await self._resume.wait()
+            if self.status == "cancelled" or queue.empty():
+                return
+            index = queue.get_nowait()
+            if await self._deliver(self._page[index]):
+                self.sent += 1
+            else:
+                self.failed += 1
+            self._done[index] = True
+            while self._prefix < len(self._page) and self._done[self._prefix]:
+                self._prefix += 1
+            if self._prefix:
+                self.cursor = self._page[self._prefix - 1]
+
+    async def _checkpoint(self):
+        state = (self.cursor, self.sent, self.failed)
+        if state == self._saved:
+            return
+        self._saved = state
+        await save_broadcast_checkpoint(self.job.id, *state)
+
+    async def refresh_progress(self):
+        if not self.job.progress_chat_id or not self.job.progress_message_id:
+            return
+        text = self.render()
+        if text == self._last_text:
+            return
+        self._last_text = text
+        try:
+            await self.bot.edit_message_text(
+                text,
+                chat_id=self.job.progress_chat_id,
+                message_id=self.job.progress_message_id,
+                parse_mode="HTML",
+                reply_markup=progress_keyboard(self.job.id, self.status),
+            )
+        except TelegramRetryAfter as e:
+            self.limiter.block(e.retry_after)
+        except TelegramAPIError as e:
+            log.debug("broadcast #%s: progress edit failed: %s", self.job.id, e)
+
+    async def _progress_loop(self):
+        while True:
+            await asyncio.sleep(BROADCAST_PROGRESS_INTERVAL)
+            await self._checkpoint()
+            await self.refresh_progress()
+
+    async def run(self):
+        progress = asyncio.create_task(self._progress_loop())
+        try:
+            while self.status != "cancelled":
+                await self._resume.wait()
+                if self.status == "cancelled":
+                    break
+                page = await list_segment_user_ids_after(
+                    self.cursor, BROADCAST_PAGE_SIZE, self.job.segment, self.job.segment_arg
+                )
+                if not page:
+                    self.status = "done"
+                    break
+                self._page, self._done, self._prefix = page, [False] * len(page), 0
+                queue: asyncio.Queue = asyncio.Queue()
+                for index in range(len(page)):
+                    queue.put_nowait(index)
+                workers = min(BROADCAST_WORKERS, len(page))
+                await asyncio.gather(*(self._worker(queue) for _ in range(workers)))
+        finally:
+            progress.cancel()
+            # To'xtatilgan (restart) holatda ham joriy nuqta saqlanadi
+            await self._checkpoint()
+        await set_broadcast_status(self.job.id, self.status)
+        await self.refresh_progress()
+        log.info("broadcast #%s %s: sent=%s failed=%s", self.job.id, self.status, self.sent, self.failed)
+
+    async def pause(self):
+        if self.status != "running":
+            return
+        self.status = "paused"
+        self._resume.clear()
+        await set_broadcast_status(self.job.id, "paused")
+        await self.refresh_progress()
+
+    async def resume(self):
+        if self.status != "paused":
+            return
+        self.status = "running"
+        self._started = time.monotonic()
+        self._done_at_start = self.processed
+        self._resume.set()
+        await set_broadcast_status(self.job.id, "running")
+        await self.refresh_progress()
+
+    async def cancel(self):
+        if self.status in ("done", "cancelled"):
+            return
+        self.status = "cancelled"
+        self._resume.set()
+
+
+class BroadcastManager:
+    def __init__(self, bot: Bot, rate: float = BROADCAST_RATE):
+        self.bot = bot
+        self.limiter = TokenBucket(rate)
+        self._runners: Dict[int, BroadcastRunner] = {}
+
+    def _launch(self, job: BroadcastJob) -> BroadcastRunner:
+        runner = BroadcastRunner(self.bot, job, self.limiter)
+        runner.task = asyncio.create_task(runner.run())
+        runner.task.add_done_callback(lambda _: self._runners.pop(job.id, None))
+        self._runners[job.id] = runner
+        return runner
+
+    def get(self, job_id: int) -> Optional[BroadcastRunner]:
+        return self._runners.get(job_id)
+
+    async def start(
+        self, admin_id: int, from_chat_id: int, message_id: int,
+        segment: str = "all", segment_arg: Optional[int] = None
+    ) -> BroadcastRunner:
+        total = await count_segment(segment, segment_arg)
+        job_id = await create_broadcast_job(admin_id, from_chat_id, message_id, total, segment, segment_arg)
+        msg = await self.bot.send_message(
+            admin_id,
+            f"📢 <b>Reklama #{job_id}</b> — ⏳ boshlanmoqda…",
+            parse_mode="HTML",
+            reply_markup=progress_keyboard(job_id, "running"),
+        )
+        await set_broadcast_progress_message(job_id, msg.chat.id, msg.message_id)
+        return self._launch(await get_broadcast_job(job_id))
+
+    async def resume_unfinished(self) -> int:
+        # Restartdan keyin: to'xtagan joyidan davom etadi (pauzadagilar pauzada qoladi)
+        jobs = await list_unfinished_broadcast_jobs()
+        for job in jobs:
+            if job.id not in self._runners:
+                log.info("broadcast #%s resumed after user_id %s (%s)", job.id, job.last_user_id, job.status)
+                self._launch(job)
+        return len(jobs)
+
+    async def shutdown(self):
+        runners = list(self._runners.values())
+        for runner in runners:
+            runner.task.cancel()
+        await asyncio.gather(*(runner.task for runner in runners), return_exceptions=True)
@@ -0,0 +1,75 @@
+# cache.py - Xotiradagi TTL + LRU kesh
+import time
+from collections import OrderedDict
+from typing import Any, Callable, Hashable, Optional
+
+
+class TTLCache:
+    """
+    Har bir yozuv o'z muddati (TTL) bilan saqlanadi. ``maxsize`` dan
+    oshganda eng uzoq ishlatilmagan yozuv chiqarib yuboriladi.
+    """
+
+    def __init__(self, maxsize: int, clock: Callable[[], float] = time.monotonic):
+        self.maxsize = maxsize
+        self._clock = clock
+        self._data: "OrderedDict[Hashable, tuple[Any, float]]" = OrderedDict()
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+    def __len__(self) -> int:
+        return len(self._data)
+
+    def get(self, key: Hashable, default: Any = None) -> Any:
+        item = self._data.get(key)
+        if item is None:
+            self.misses += 1
+            return default
+        value, expires = item
+        if expires <= self._clock():
+            del self._data[key]
+            self.misses += 1
+            return default
+        self._data.move_to_end(key)
+        self.hits += 1
+        return value
+
+    def set(self, key: Hashable, value: Any, ttl: float):
+        self._data[key] = (value, self._clock() + ttl)
+        self._data.move_to_end(key)
+        while len(self._data) > self.maxsize:
+            self._data.popitem(last=False)
+            self.evictions += 1
+
+    def pop(self, key: Hashable, default: Any = None) -> Any:
+        item = self._data.pop(key, None)
+        return default if item is None else item[0]
+
+    def clear(self):
+        self._data.clear()
+
+    def stats(self) -> dict:
+        lookups = self.hits + self.misses
+        return {
+            "size": len(self._data),
+            "hits": self.hits,
+            "misses": self.misses,
+            "evictions": self.evictions,
+            "hit_rate": self.hits / lookups if lookups else 0.0,
+        }
+
+
+class VersionedCache(TTLCache):
+    """Manba versiyasi o'zgarsa (masalan, kanallar ro'yxati) butunlay tozalanadi."""
+
+    def __init__(self, maxsize: int, version: Callable[[], int], clock: Callable[[], float] = time.monotonic):
+        super().__init__(maxsize, clock)
+        self._version_fn = version
+        self._version: Optional[int] = version()
+
+    def sync(self):
+        current = self._version_fn()
+        if current != self._version:
+            self.clear()
+            self._version = current
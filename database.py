@@ -1,15 +1,27 @@
 # database.py - Soddalashtirilgan versiya (AI va Liga tizimisiz)
 import asyncio
+import bisect
+import gzip
 import aiosqlite
+import heapq
+import logging
+import sqlite3
 import time
 import os
 import shutil
 from datetime import datetime
-from typing import Optional, List, Tuple
+from typing import NamedTuple, Optional, List, Tuple
+from collections import OrderedDict, deque
+from itertools import groupby
 from contextlib import asynccontextmanager
 
+from config import OWNER_ID, OWNER2_ID
+from leaderboard import Leaderboard
+
 DB_NAME = "bot_data.db"
 
+log = logging.getLogger("db")
+
 CREATE_SQL = [
     """
     CREATE TABLE IF NOT EXISTS users (
@@ -171,84 +183,892 @@ async def db_connection():
         await pool.put(conn)
 
 
+async def close_db():
+    global _DB_POOL
+    await _WRITE_BEHIND.stop()
+    await _WRITER.stop()
+    async with _DB_POOL_LOCK:
+        pool, _DB_POOL = _DB_POOL, None
+    if pool is None:
+        return
+    while not pool.empty():
+        conn = pool.get_nowait()
+        try:
+            await conn.close()
+        except Exception:
+            pass
+
+
+def _run_in_transaction(conn: sqlite3.Connection, fn, args):
+    conn.execute("BEGIN IMMEDIATE")
+    try:
+        result = fn(conn, *args)
+        conn.commit()
+    except BaseException:
+        # Commit muvaffaqiyatsiz bo'lsa ham ulanish tranzaksiyada qolib ketmasin
+        if conn.in_transaction:
+            conn.rollback()
+        raise
+    return result
+
+
+def _in_connection_thread(db: aiosqlite.Connection, fn, *args):
+    # aiosqlite==0.20.0 ichki API'si: Connection._execute funksiyani ulanish
+    # thread'ida bajaradi, ._conn — asl sqlite3.Connection. Versiya
+    # yangilansa, faqat shu yerni tekshirish kerak.
+    return db._execute(fn, db._conn, *args)
+
+
+async def run_unit(fn, *args):
+    """
+    ``fn(conn, *args)`` ni ulanishning o'z thread'ida bitta tranzaksiya
+    sifatida bajaradi. ``conn`` — oddiy ``sqlite3.Connection``; ichidagi
+    barcha so'rovlar va commit bitta thread hop'da amalga oshadi.
+    """
+    async with db_connection() as db:
+        # aiosqlite ishchi thread'iga funksiyani to'g'ridan-to'g'ri navbatga qo'yamiz
+        return await _in_connection_thread(db, _run_in_transaction, fn, args)
+
+
+# ---------------- Writer ----------------
+class _DbWriter:
+    """
+    Barcha yozuvchi tranzaksiyalar uchun yagona ulanish va navbat.
+    SQLite bir vaqtda faqat bitta yozuvchiga ruxsat beradi, shuning uchun
+    yozuvlar pool ulanishlari o'rtasida lock uchun kurashmaydi — ular shu
+    navbatda ketma-ket bajariladi. O'qish so'rovlari pool'dan foydalanadi.
+    """
+
+    def __init__(self):
+        self._queue: asyncio.Queue | None = None
+        self._conn: aiosqlite.Connection | None = None
+        self._task: asyncio.Task | None = None
+        self._lock = asyncio.Lock()
+        self._latencies: deque = deque(maxlen=1000)
+        self._per_op: dict[str, list] = {}
+
+    async def _ensure_started(self):
+        if self._task is not None:
+            return
+        async with self._lock:
+            if self._task is None:
+                self._conn = await _create_pooled_connection()
+                self._queue = asyncio.Queue()
+                self._task = asyncio.create_task(self._run())
+
+    async def submit(self, fn, args: tuple):
+        await self._ensure_started()
+        future = asyncio.get_running_loop().create_future()
+        self._queue.put_nowait((fn, args, future, time.perf_counter()))
+        return await future
+
+    async def _run(self):
+        while True:
+            item = await self._queue.get()
+            if item is None:
+                break
+            fn, args, future, enqueued = item
+            try:
+                result = await _in_connection_thread(self._conn, _run_in_transaction, fn, args)
+            except Exception as e:
+                if not future.done():
+                    future.set_exception(e)
+            else:
+                if not future.done():
+                    future.set_result(result)
+            self._record(fn, time.perf_counter() - enqueued)
+
+    def _record(self, fn, elapsed: float):
+        self._latencies.append(elapsed)
+        name = fn.__qualname__.split(".<locals>")[0]
+        entry = self._per_op.setdefault(name, [0, 0.0, 0.0])
+        entry[0] += 1
+        entry[1] += elapsed
+        entry[2] = max(entry[2], elapsed)
+
+    def stats(self) -> dict:
+        recent = sorted(self._latencies)
+        return {
+            "queue_depth": self._queue.qsize() if self._queue is not None else 0,
+            "p50_ms": recent[len(recent) // 2] * 1000 if recent else 0.0,
+            "p99_ms": recent[int(len(recent) * 0.99) - 1] * 1000 if recent else 0.0,
+            # nom -> (soni, o'rtacha ms, maksimal ms)
+            "ops": {
+                name: (count, total / count * 1000, worst * 1000)
+                for name, (count, total, worst) in self._per_op.items()
+            },
+        }
+
+    async def stop(self):
+        async with self._lock:
+            task, conn = self._task, self._conn
+            self._task = self._conn = None
+            if task is None:
+                return
+            self._queue.put_nowait(None)
+            await task
+            self._queue = None
+            await conn.close()
+
+
+_WRITER = _DbWriter()
+
+
+async def run_write(fn, *args):
+    """
+    ``run_unit`` bilan bir xil, lekin yagona yozuvchi navbati orqali.
+    Ma'lumotni o'zgartiradigan barcha funksiyalar shundan foydalanadi.
+    """
+    return await _WRITER.submit(fn, args)
+
+
+def writer_stats() -> dict:
+    return _WRITER.stats()
+
+
+async def _execute_write(sql: str, params: tuple = ()) -> Tuple[int, Optional[int]]:
+    # Bitta so'rovli yozuvlar uchun: (rowcount, lastrowid)
+    def unit(conn: sqlite3.Connection):
+        cur = conn.execute(sql, params)
+        return cur.rowcount, cur.lastrowid
+
+    return await run_write(unit)
+
+
+# ---------------- Write-behind ----------------
+WRITE_BEHIND_DELAY_MS = int(os.getenv("WRITE_BEHIND_DELAY_MS", "200"))
+WRITE_BEHIND_MAX_ROWS = int(os.getenv("WRITE_BEHIND_MAX_ROWS", "100"))
+
+
+def _apply_batch(conn: sqlite3.Connection, rows: list):
+    # Ketma-ket kelgan bir xil so'rovlar bitta executemany bilan
+    for sql, group in groupby(rows, key=lambda row: row[0]):
+        conn.executemany(sql, [row[1] for row in group])
+
+
+class _WriteBehind:
+    """
+    Muhim bo'lmagan yozuvlar (admin loglari, xabar id'lari, username
+    yangilanishi) uchun bufer. Yozuvlar darhol qaytadi va har
+    ``delay`` soniyada yoki ``max_rows`` to'planganda bitta tranzaksiyada
+    yozuvchi navbatiga yuboriladi.
+    """
+
+    def __init__(self, delay_ms: int, max_rows: int):
+        self.delay = delay_ms / 1000
+        self.max_rows = max_rows
+        self._rows: list = []
+        self._wake = asyncio.Event()
+        self._task: asyncio.Task | None = None
+        self._flush_lock = asyncio.Lock()
+        self._sizes: deque = deque(maxlen=1000)
+        self._lags: deque = deque(maxlen=1000)
+        self._flushes = 0
+        self._written = 0
+        self._failed = 0
+
+    def defer(self, sql: str, params: tuple):
+        self._rows.append((sql, params, time.perf_counter()))
+        if len(self._rows) >= self.max_rows:
+            self._wake.set()
+        if self._task is None:
+            self._task = asyncio.get_running_loop().create_task(self._run())
+
+    async def _run(self):
+        try:
+            while self._rows:
+                if len(self._rows) < self.max_rows:
+                    try:
+                        await asyncio.wait_for(self._wake.wait(), timeout=self.delay)
+                    except asyncio.TimeoutError:
+                        pass
+                self._wake.clear()
+                await self.flush()
+        finally:
+            self._task = None
+
+    async def flush(self) -> int:
+        async with self._flush_lock:
+            rows = self._rows[:self.max_rows]
+            del self._rows[:self.max_rows]
+            if not rows:
+                return 0
+            try:
+                await run_write(_apply_batch, rows)
+                written = len(rows)
+            except Exception as e:
+                # Bitta yomon qator butun paketni yo'qotmasin
+                log.warning("write-behind batch of %s failed (%s), retrying row by row", len(rows), e)
+                written = 0
+                for row in rows:
+                    try:
+                        await run_write(_apply_batch, [row])
+                        written += 1
+                    except Exception as row_error:
+                        self._failed += 1
+                        log.error("write-behind row dropped: %s %r: %s", row[0].split()[0], row[1], row_error)
+            self._flushes += 1
+            self._written += written
+            self._sizes.append(len(rows))
+            self._lags.append(time.perf_counter() - rows[0][2])
+            return len(rows)
+
+    def stats(self) -> dict:
+        sizes = list(self._sizes)
+        lags = sorted(self._lags)
+        return {
+            "pending": len(self._rows),
+            "flushes": self._flushes,
+            "rows": self._written,
+            "failed": self._failed,
+            "avg_batch": sum(sizes) / len(sizes) if sizes else 0.0,
+            "max_batch": max(sizes) if sizes else 0,
+            # navbatga tushgan eng eski qatordan commit'gacha
+            "p50_lag_ms": lags[len(lags) // 2] * 1000 if lags else 0.0,
+            "max_lag_ms": lags[-1] * 1000 if lags else 0.0,
+        }
+
+    async def stop(self):
+        task = self._task
+        if task is not None:
+            self._wake.set()
+            await task
+        while await self.flush():
+            pass
+
+
+_WRITE_BEHIND = _WriteBehind(WRITE_BEHIND_DELAY_MS, WRITE_BEHIND_MAX_ROWS)
+
+
+def defer_write(sql: str, params: tuple = ()):
+    """
+    Natijasi kutilmaydigan yozuv: qaytish qiymati yo'q, xatolar logga
+    yoziladi. Bir necha yuz millisekund ichida commit qilinadi.
+    """
+    _WRITE_BEHIND.defer(sql, params)
+
+
+async def flush_deferred_writes() -> int:
+    total = 0
+    while True:
+        flushed = await _WRITE_BEHIND.flush()
+        if not flushed:
+            return total
+        total += flushed
+
+
+def write_behind_stats() -> dict:
+    return _WRITE_BEHIND.stats()
+
+
 async def init_db():
     async with db_connection() as db:
         for sql in CREATE_SQL:
             await db.execute(sql)
         await db.commit()
-    await _ensure_column("withdraw_requests", "game", "TEXT DEFAULT 'ff'")
+    await run_migrations()
+    await load_leaderboard()
+    await load_settings_cache()
+    await load_admin_registry()
+    await load_suspensions()
+    await load_offer_catalog()
+
+
+# ---------------- Migrations ----------------
+# Har bir migratsiya (versiya, nom, qadamlar). Qadam — SQL satri yoki
+# ``async def step(db)`` funksiyasi. Bajarilgan versiya ``PRAGMA user_version``
+# da saqlanadi, shuning uchun ro'yxatga faqat oxiridan qo'shiladi.
+async def _column_names(db: aiosqlite.Connection, table: str) -> list[str]:
+    cur = await db.execute(f"PRAGMA table_info({table})")
+    return [r[1] for r in await cur.fetchall()]
+
+
+def _add_column(table: str, column: str, ddl: str):
+    async def step(db: aiosqlite.Connection):
+        if column not in await _column_names(db, table):
+            await db.execute(f"ALTER TABLE {table} ADD COLUMN {column} {ddl}")
+    step.__name__ = f"add_column_{table}_{column}"
+    return step
+
+
+async def _drop_legacy_user_columns(db: aiosqlite.Connection):
+    # Eski versiyadagi rank_score / rank_level ustunlari (Liga tizimi)
+    cols = await _column_names(db, "users")
+    if "rank_score" not in cols and "rank_level" not in cols:
+        return
+    await db.execute("""
+        CREATE TABLE users_new (
+            user_id     INTEGER PRIMARY KEY,
+            username    TEXT,
+            almaz       INTEGER DEFAULT 0,
+            ref_by      INTEGER,
+            verified    INTEGER DEFAULT 0,
+            phone       TEXT,
+            created_at  INTEGER
+        );
+    """)
+    await db.execute("""
+        INSERT INTO users_new (user_id, username, almaz, ref_by, verified, phone, created_at)
+        SELECT user_id, username, almaz, ref_by, verified, phone, created_at FROM users;
+    """)
+    await db.execute("DROP TABLE users;")
+    await db.execute("ALTER TABLE users_new RENAME TO users;")
+
+
+async def _rebuild_legacy_required_channels(db: aiosqlite.Connection):
+    # Eski required_channels jadvali boshqa ustunlar bilan yaratilgan bo'lishi mumkin
+    if await _column_names(db, "required_channels") == ["username"]:
+        return
+    await db.execute("DROP TABLE IF EXISTS required_channels;")
+    await db.execute("CREATE TABLE required_channels (username TEXT PRIMARY KEY);")
+
+
+_VERIFIED_REFS_SUBQUERY = (
+    "SELECT COUNT(*) FROM referrals r WHERE r.inviter_id = users.user_id AND r.status = 'verified'"
+)
+_BACKFILL_VERIFIED_REFS_SQL = f"UPDATE users SET verified_refs = ({_VERIFIED_REFS_SUBQUERY})"
+
+
+MIGRATIONS = [
+    (1, "withdraw_requests.game", [
+        _add_column("withdraw_requests", "game", "TEXT DEFAULT 'ff'"),
+    ]),
+    (2, "legacy cleanup (fix_db.py)", [
+        _drop_legacy_user_columns,
+        _rebuild_legacy_required_channels,
+        "DROP TABLE IF EXISTS groups;",
+        "DROP TABLE IF EXISTS ai_limits;",
+    ]),
+    (3, "indexes for hot queries", [
+        # count_verified_referrals / count_all_referrals
+        "CREATE INDEX IF NOT EXISTS idx_referrals_inviter_status ON referrals(inviter_id, status);",
+        # get_top_referrers_today (covering: status + verified_at range, inviter_id)
+        "CREATE INDEX IF NOT EXISTS idx_referrals_status_verified ON referrals(status, verified_at, inviter_id);",
+        # get_leaderboard / get_user_rank
+        "CREATE INDEX IF NOT EXISTS idx_users_almaz ON users(COALESCE(almaz,0) DESC, user_id ASC);",
+        # search_user_exec (@username) va ref_by bo'yicha sanash
+        "CREATE INDEX IF NOT EXISTS idx_users_username ON users(username);",
+        "CREATE INDEX IF NOT EXISTS idx_users_ref_by ON users(ref_by);",
+        # list_pending_purchases
+        "CREATE INDEX IF NOT EXISTS idx_purchases_status_created ON purchases(status, created_at);",
+        # get_withdraw_stats
+        "CREATE INDEX IF NOT EXISTS idx_withdraw_requests_status ON withdraw_requests(status);",
+        # get_withdraw_notifications
+        "CREATE INDEX IF NOT EXISTS idx_withdraw_notifications_request ON withdraw_notifications(request_id, chat_id, message_id);",
+        # list_offers
+        "CREATE INDEX IF NOT EXISTS idx_offers_game_cost ON offers(game, achko_cost);",
+    ]),
+    (4, "users.verified_refs counter", [
+        _add_column("users", "verified_refs", "INTEGER NOT NULL DEFAULT 0"),
+        _BACKFILL_VERIFIED_REFS_SQL,
+    ]),
+    (5, "broadcast_jobs", [
+        """
+        CREATE TABLE IF NOT EXISTS broadcast_jobs (
+            id                  INTEGER PRIMARY KEY AUTOINCREMENT,
+            admin_id            INTEGER NOT NULL,
+            from_chat_id        INTEGER NOT NULL,
+            message_id          INTEGER NOT NULL,
+            status              TEXT NOT NULL DEFAULT 'running',
+            last_user_id        INTEGER NOT NULL DEFAULT 0,
+            total               INTEGER NOT NULL DEFAULT 0,
+            sent                INTEGER NOT NULL DEFAULT 0,
+            failed              INTEGER NOT NULL DEFAULT 0,
+            progress_chat_id    INTEGER,
+            progress_message_id INTEGER,
+            created_at          INTEGER,
+            updated_at          INTEGER,
+            finished_at         INTEGER
+        );
+        """,
+        "CREATE INDEX IF NOT EXISTS idx_broadcast_jobs_status ON broadcast_jobs(status);",
+    ]),
+    (6, "users.unreachable", [
+        # NULL — xabar yetib boradi; aks holda sabab (blocked / deactivated / chat_not_found)
+        _add_column("users", "unreachable", "TEXT"),
+        _add_column("users", "unreachable_at", "INTEGER"),
+        # Reklama sahifalari (unreachable IS NULL AND user_id > ?) va sanash uchun
+        "CREATE INDEX IF NOT EXISTS idx_users_unreachable ON users(unreachable, user_id);",
+    ]),
+    (7, "broadcast segments", [
+        _add_column("users", "last_seen_at", "INTEGER"),
+        "UPDATE users SET last_seen_at = COALESCE(created_at, 0);",
+        _add_column("broadcast_jobs", "segment", "TEXT NOT NULL DEFAULT 'all'"),
+        _add_column("broadcast_jobs", "segment_arg", "INTEGER"),
+        # Har bir segment o'z indeksi bo'yicha diapazon sifatida o'qiladi
+        "CREATE INDEX IF NOT EXISTS idx_users_verified ON users(verified, unreachable, user_id);",
+        "CREATE INDEX IF NOT EXISTS idx_users_reachable_almaz ON users(unreachable, COALESCE(almaz,0));",
+        "CREATE INDEX IF NOT EXISTS idx_users_reachable_created ON users(unreachable, created_at);",
+        "CREATE INDEX IF NOT EXISTS idx_users_reachable_last_seen ON users(unreachable, last_seen_at);",
+        # idx_withdraw_requests_status o'rniga: get_withdraw_stats ham shu indeksni ishlatadi
+        "CREATE INDEX IF NOT EXISTS idx_withdraw_requests_status_user ON withdraw_requests(status, user_id);",
+        "DROP INDEX IF EXISTS idx_withdraw_requests_status;",
+    ]),
+    (8, "channel membership state", [
+        """
+        CREATE TABLE IF NOT EXISTS channel_members (
+            channel    TEXT NOT NULL,
+            user_id    INTEGER NOT NULL,
+            status     TEXT NOT NULL,
+            updated_at INTEGER NOT NULL,
+            PRIMARY KEY (channel, user_id)
+        ) WITHOUT ROWID;
+        """,
+        # tracking=1 — bot kanalda admin, chat_member yangilanishlari keladi
+        """
+        CREATE TABLE IF NOT EXISTS tracked_channels (
+            channel    TEXT PRIMARY KEY,
+            chat_id    INTEGER,
+            tracking   INTEGER NOT NULL DEFAULT 0,
+            updated_at INTEGER
+        );
+        """,
+    ]),
+    (9, "fsm storage", [
+        # key — "bot:chat:user:thread:destiny"; data — JSON
+        """
+        CREATE TABLE IF NOT EXISTS fsm_states (
+            key        TEXT PRIMARY KEY,
+            user_id    INTEGER,
+            state      TEXT,
+            data       TEXT,
+            updated_at INTEGER NOT NULL
+        ) WITHOUT ROWID;
+        """,
+        "CREATE INDEX IF NOT EXISTS idx_fsm_states_updated ON fsm_states(updated_at);",
+    ]),
+    (10, "balance ledger", [
+        # Har bir balans o'zgarishi: sabab va bog'liq yozuv (so'rov, referal, admin) id'si
+        """
+        CREATE TABLE IF NOT EXISTS balance_ledger (
+            id         INTEGER PRIMARY KEY AUTOINCREMENT,
+            user_id    INTEGER NOT NULL,
+            delta      INTEGER NOT NULL,
+            reason     TEXT NOT NULL,
+            ref_id     INTEGER,
+            created_at INTEGER NOT NULL
+        );
+        """,
+        "CREATE INDEX IF NOT EXISTS idx_balance_ledger_user ON balance_ledger(user_id, id);",
+        # ledger_id — shu yozuvgacha (u ham kiradi) hisoblangan balans
+        """
+        CREATE TABLE IF NOT EXISTS balance_snapshots (
+            user_id   INTEGER NOT NULL,
+            ledger_id INTEGER NOT NULL,
+            balance   INTEGER NOT NULL,
+            taken_at  INTEGER NOT NULL,
+            PRIMARY KEY (user_id, ledger_id)
+        ) WITHOUT ROWID;
+        """,
+        # Jurnaldan oldingi balanslar boshlang'ich snapshot sifatida
+        """
+        INSERT OR IGNORE INTO balance_snapshots(user_id, ledger_id, balance, taken_at)
+        SELECT user_id, 0, COALESCE(almaz, 0), CAST(strftime('%s', 'now') AS INTEGER)
+        FROM users WHERE COALESCE(almaz, 0) != 0
+        """,
+    ]),
+]
 
+SCHEMA_VERSION = MIGRATIONS[-1][0]
 
-async def _ensure_column(table: str, column: str, ddl: str):
+
+async def get_schema_version() -> int:
     async with db_connection() as db:
-        cur = await db.execute(f"PRAGMA table_info({table})")
-        rows = await cur.fetchall()
-        cols = [r[1] for r in rows]
-        if column not in cols:
-            await db.execute(f"ALTER TABLE {table} ADD COLUMN {column} {ddl}")
+        cur = await db.execute("PRAGMA user_version")
+        row = await cur.fetchone()
+        return int(row[0]) if row else 0
+
+
+async def run_migrations() -> List[Tuple[int, str, float]]:
+    """
+    Bajarilmagan migratsiyalarni tartib bilan qo'llaydi.
+    Har bir migratsiya alohida tranzaksiyada bajariladi va ``user_version``
+    shu tranzaksiya ichida yangilanadi. (versiya, nom, soniya) ro'yxatini qaytaradi.
+    """
+    report: List[Tuple[int, str, float]] = []
+    async with db_connection() as db:
+        for version, name, steps in MIGRATIONS:
+            cur = await db.execute("PRAGMA user_version")
+            current = int((await cur.fetchone())[0])
+            if version <= current:
+                continue
+            started = time.perf_counter()
+            await db.execute("BEGIN IMMEDIATE")
+            for step in steps:
+                if isinstance(step, str):
+                    await db.execute(step)
+                else:
+                    await step(db)
+            await db.execute(f"PRAGMA user_version = {int(version)}")
             await db.commit()
+            elapsed = time.perf_counter() - started
+            log.info("migration %s (%s) applied in %.3fs", version, name, elapsed)
+            report.append((version, name, elapsed))
+    return report
 
 
 # ---------------- Users ----------------
-async def add_user(user_id: int, username: Optional[str] = None, ref_by: Optional[int] = None):
+class UserRow(NamedTuple):
+    user_id: int
+    username: Optional[str]
+    ref_by: Optional[int]
+    almaz: Optional[int]
+    verified: Optional[int]
+    phone: Optional[str]
+
+
+async def add_user(user_id: int, username: Optional[str] = None, ref_by: Optional[int] = None) -> bool:
+    """Yangi foydalanuvchi qo'shilgan bo'lsa True."""
     now = int(time.time())
-    async with db_connection() as db:
-        await db.execute("""
-            INSERT INTO users(user_id, username, created_at)
-            VALUES(?, ?, ?)
-            ON CONFLICT(user_id) DO NOTHING
-        """, (user_id, username, now))
 
-        if username:
-            await db.execute("UPDATE users SET username=? WHERE user_id=?", (username, user_id))
+    def unit(conn: sqlite3.Connection):
+        inserted = conn.execute("""
+            INSERT INTO users(user_id, username, created_at, last_seen_at)
+            VALUES(?, ?, ?, ?)
+            ON CONFLICT(user_id) DO NOTHING
+        """, (user_id, username, now, now)).rowcount
 
         if ref_by and ref_by != user_id:
-            cur = await db.execute("SELECT ref_by FROM users WHERE user_id=?", (user_id,))
-            row = await cur.fetchone()
+            conn.execute("UPDATE users SET ref_by=? WHERE user_id=? AND ref_by IS NULL", (ref_by, user_id))
+        # Botga qaytib yozdi — demak xabar yana yetib boradi
+        conn.execute(
+            "UPDATE users SET unreachable=NULL, unreachable_at=NULL WHERE user_id=? AND unreachable IS NOT NULL",
+            (user_id,)
+        )
+        return inserted
+
+    inserted = await run_write(unit)
+    if inserted:
+        _remember_seen(user_id, now)
+    else:
+        touch_last_seen(user_id)
+    if username and not inserted:
+        # Mavjud foydalanuvchining username'i — shoshilinch emas
+        defer_write(
+            "UPDATE users SET username=? WHERE user_id=? AND username IS NOT ?",
+            (username, user_id, username)
+        )
+    if LEADERBOARD.loaded:
+        LEADERBOARD.add_user(user_id, username)
+    return bool(inserted)
 
-            if row and row[0] is None:
-                await db.execute("UPDATE users SET ref_by=? WHERE user_id=?", (ref_by, user_id))
 
-        await db.commit()
+class Registration(NamedTuple):
+    user: UserRow
+    created: bool              # yangi foydalanuvchi
+    ref_by: Optional[int]      # amaldagi taklif qilgan (yangi yoki avvalgi)
+    referral_created: bool     # referrals jadvaliga yozuv qo'shildi
+
+
+_USER_ROW_COLUMNS = "user_id, username, ref_by, almaz, verified, phone"
 
 
-async def get_user(user_id: int):
+async def register_user(user_id: int, username: Optional[str] = None, ref_id: Optional[int] = None) -> Registration:
+    """
+    /start uchun bitta tranzaksiya: foydalanuvchini qo'shadi, yangi bo'lsa
+    taklif qilganni biriktirib referrals yozuvini ochadi. Mavjud
+    foydalanuvchining ref_by'i o'zgarmaydi.
+    """
+    now = int(time.time())
+    ref_id = ref_id if ref_id and ref_id != user_id else None
+
+    def unit(conn: sqlite3.Connection):
+        row = conn.execute(f"""
+            INSERT INTO users(user_id, username, ref_by, created_at, last_seen_at)
+            VALUES(?, ?, ?, ?, ?)
+            ON CONFLICT(user_id) DO NOTHING
+            RETURNING {_USER_ROW_COLUMNS}
+        """, (user_id, username, ref_id, now, now)).fetchone()
+        if row is not None:
+            referral = False
+            if ref_id is not None:
+                referral = conn.execute("""
+                    INSERT INTO referrals(inviter_id, invited_id, status, created_at) VALUES(?, ?, 'joined', ?)
+                    ON CONFLICT(invited_id) DO NOTHING
+                    RETURNING id
+                """, (ref_id, user_id, now)).fetchone() is not None
+            return UserRow(*row), True, referral
+
+        # Mavjud foydalanuvchi: qator faqat o'zgarish bo'lsa yoziladi
+        row = conn.execute(f"""
+            UPDATE users SET username=COALESCE(?, username), unreachable=NULL, unreachable_at=NULL
+            WHERE user_id=? AND (unreachable IS NOT NULL OR (? IS NOT NULL AND username IS NOT ?))
+            RETURNING {_USER_ROW_COLUMNS}
+        """, (username, user_id, username, username)).fetchone()
+        if row is None:
+            row = conn.execute(f"SELECT {_USER_ROW_COLUMNS} FROM users WHERE user_id=?", (user_id,)).fetchone()
+        return UserRow(*row), False, False
+
+    user, created, referral = await run_write(unit)
+    if created:
+        _remember_seen(user_id, now)
+    else:
+        touch_last_seen(user_id)
+    if LEADERBOARD.loaded:
+        LEADERBOARD.add_user(user_id, username)
+    return Registration(user, created, user.ref_by, referral)
+
+
+# Faollik vaqti soatiga bir martadan ko'p yozilmaydi
+LAST_SEEN_RESOLUTION = int(os.getenv("LAST_SEEN_RESOLUTION", "3600"))
+# Yozilish tartibida saqlanadi: eng eskilari boshida turadi
+_LAST_SEEN: "OrderedDict[int, int]" = OrderedDict()
+LAST_SEEN_MAX = 100_000
+
+
+def _remember_seen(user_id: int, now: int):
+    _LAST_SEEN[user_id] = now
+    _LAST_SEEN.move_to_end(user_id)
+    # Boshidan eskirganlarini (yoki limitdan oshganini) chiqaramiz — to'liq skan yo'q
+    while _LAST_SEEN:
+        uid, ts = next(iter(_LAST_SEEN.items()))
+        if now - ts < LAST_SEEN_RESOLUTION and len(_LAST_SEEN) <= LAST_SEEN_MAX:
+            break
+        del _LAST_SEEN[uid]
+
+
+def touch_last_seen(user_id: int):
+    now = int(time.time())
+    if now - _LAST_SEEN.get(user_id, 0) < LAST_SEEN_RESOLUTION:
+        return
+    _remember_seen(user_id, now)
+    defer_write("UPDATE users SET last_seen_at=? WHERE user_id=?", (now, user_id))
+
+
+async def get_user(user_id: int) -> Optional[UserRow]:
     async with db_connection() as db:
         cur = await db.execute(
             "SELECT user_id, username, ref_by, almaz, verified, phone FROM users WHERE user_id=?",
             (user_id,)
         )
-        return await cur.fetchone()
+        row = await cur.fetchone()
+        return UserRow(*row) if row else None
 
 
-async def add_almaz(user_id: int, amount: int):
-    async with db_connection() as db:
-        await db.execute(
-            "UPDATE users SET almaz = COALESCE(almaz,0) + ? WHERE user_id=?",
+async def add_almaz(
+    user_id: int, amount: int, reason: str = "credit", ref_id: Optional[int] = None
+) -> Optional[int]:
+    """Yangi balansni qaytaradi (foydalanuvchi topilmasa None)."""
+    def unit(conn: sqlite3.Connection):
+        row = conn.execute(
+            "UPDATE users SET almaz = COALESCE(almaz,0) + ? WHERE user_id=? RETURNING almaz",
             (amount, user_id)
+        ).fetchone()
+        if row:
+            _append_ledger(conn, user_id, amount, reason, ref_id)
+        return row
+
+    row = await run_write(unit)
+    if not row:
+        return None
+    if LEADERBOARD.loaded:
+        LEADERBOARD.set_balance(user_id, row[0])
+    return row[0]
+
+
+async def adjust_balance(
+    user_id: int, delta: int, min_zero: bool = True, reason: str = "adjust", ref_id: Optional[int] = None
+) -> bool:
+    return await apply_balance_delta(user_id, delta, min_zero, reason, ref_id) is not None
+
+
+async def apply_balance_delta(
+    user_id: int, delta: int, min_zero: bool = True, reason: str = "adjust", ref_id: Optional[int] = None
+) -> Optional[int]:
+    """adjust_balance bilan bir xil, lekin yangi balansni qaytaradi (rad etilsa None)."""
+    def unit(conn: sqlite3.Connection) -> Optional[int]:
+        row = conn.execute("SELECT COALESCE(almaz,0) FROM users WHERE user_id=?", (user_id,)).fetchone()
+        if not row:
+            return None
+        new_balance = int(row[0]) + delta
+        if min_zero and new_balance < 0:
+            return None
+        conn.execute("UPDATE users SET almaz=? WHERE user_id=?", (new_balance, user_id))
+        _append_ledger(conn, user_id, delta, reason, ref_id)
+        return new_balance
+
+    new_balance = await run_write(unit)
+    if new_balance is not None and LEADERBOARD.loaded:
+        LEADERBOARD.set_balance(user_id, new_balance)
+    return new_balance
+
+
+# ---------------- Balance ledger ----------------
+# Balansni o'zgartiradigan har bir unit o'z tranzaksiyasi ichida jurnalga
+# yozadi — alohida commit yo'q. Sabablar: referral_reward, withdraw,
+# admin_add, admin_remove, credit/adjust (umumiy).
+BALANCE_SNAPSHOT_INTERVAL = int(os.getenv("BALANCE_SNAPSHOT_INTERVAL", "3600"))
+
+
+class LedgerEntry(NamedTuple):
+    id: int
+    delta: int
+    reason: str
+    ref_id: Optional[int]
+    created_at: int
+
+
+def _append_ledger(conn: sqlite3.Connection, user_id: int, delta: int, reason: str, ref_id: Optional[int] = None):
+    if delta:
+        conn.execute(
+            "INSERT INTO balance_ledger(user_id, delta, reason, ref_id, created_at) VALUES(?, ?, ?, ?, ?)",
+            (user_id, delta, reason, ref_id, int(time.time()))
         )
-        await db.commit()
 
 
-async def adjust_balance(user_id: int, delta: int, min_zero: bool = True) -> bool:
+# users.almaz va jurnal bo'yicha balans: so'nggi snapshot + undan keyingi yozuvlar
+_LEDGER_BALANCE_SQL = """
+    SELECT u.user_id, COALESCE(u.almaz, 0) AS stored,
+           COALESCE(s.balance, 0) + COALESCE((
+               SELECT SUM(l.delta) FROM balance_ledger l
+               WHERE l.user_id = u.user_id AND l.id > COALESCE(s.ledger_id, 0)
+           ), 0) AS ledger
+    FROM users u
+    LEFT JOIN balance_snapshots s ON s.user_id = u.user_id AND s.ledger_id = (
+        SELECT MAX(ledger_id) FROM balance_snapshots WHERE user_id = u.user_id
+    )
+"""
+
+
+async def take_balance_snapshots() -> int:
+    """
+    Oxirgi snapshot'dan keyin o'zgargan foydalanuvchilar uchun yangi snapshot
+    yozadi (oldingi snapshot + o'zgarishlar). Yozilganlar sonini qaytaradi.
+    """
+    now = int(time.time())
+
+    def unit(conn: sqlite3.Connection) -> int:
+        watermark = conn.execute("SELECT COALESCE(MAX(ledger_id), 0) FROM balance_snapshots").fetchone()[0]
+        return conn.execute("""
+            INSERT INTO balance_snapshots(user_id, ledger_id, balance, taken_at)
+            SELECT l.user_id, MAX(l.id), SUM(l.delta) + COALESCE((
+                SELECT s.balance FROM balance_snapshots s
+                WHERE s.user_id = l.user_id ORDER BY s.ledger_id DESC LIMIT 1
+            ), 0), ?
+            FROM balance_ledger l
+            WHERE l.id > ?
+            GROUP BY l.user_id
+        """, (now, watermark)).rowcount
+
+    return await run_write(unit)
+
+
+async def balance_as_of(user_id: int, ts: int) -> int:
+    """``ts`` vaqtidagi balans: undan oldingi so'nggi snapshot + keyingi yozuvlar."""
     async with db_connection() as db:
-        await db.execute("BEGIN IMMEDIATE")
-        cur = await db.execute("SELECT COALESCE(almaz,0) FROM users WHERE user_id=?", (user_id,))
+        cur = await db.execute(
+            """
+            SELECT ledger_id, balance FROM balance_snapshots
+            WHERE user_id=? AND taken_at <= ?
+            ORDER BY ledger_id DESC LIMIT 1
+            """,
+            (user_id, ts)
+        )
         row = await cur.fetchone()
-        if not row:
-            await db.rollback()
-            return False
-        balance = int(row[0])
-        new_balance = balance + delta
-        if min_zero and new_balance < 0:
-            await db.rollback()
-            return False
-        await db.execute("UPDATE users SET almaz=? WHERE user_id=?", (new_balance, user_id))
-        await db.commit()
-        return True
+        ledger_id, balance = row if row else (0, 0)
+        cur = await db.execute(
+            "SELECT COALESCE(SUM(delta), 0) FROM balance_ledger WHERE user_id=? AND id > ? AND created_at <= ?",
+            (user_id, ledger_id, ts)
+        )
+        return int(balance) + int((await cur.fetchone())[0])
+
+
+async def get_ledger(user_id: int, limit: int = 20) -> List[LedgerEntry]:
+    async with db_connection() as db:
+        cur = await db.execute(
+            """
+            SELECT id, delta, reason, ref_id, created_at FROM balance_ledger
+            WHERE user_id=? ORDER BY id DESC LIMIT ?
+            """,
+            (user_id, limit)
+        )
+        return [LedgerEntry(*row) for row in await cur.fetchall()]
+
+
+async def reconcile_balances() -> List[Tuple[int, int, int]]:
+    """
+    users.almaz ni jurnal bilan solishtiradi (so'nggi snapshot'dan keyingi
+    yozuvlargina o'qiladi). (user_id, saqlangan, jurnal bo'yicha) ro'yxati.
+    """
+    async with db_connection() as db:
+        cur = await db.execute(f"""
+            SELECT user_id, stored, ledger FROM ({_LEDGER_BALANCE_SQL})
+            WHERE stored != ledger
+            ORDER BY user_id ASC
+        """)
+        return [(r[0], r[1], r[2]) for r in await cur.fetchall()]
+
+
+async def balance_snapshot_loop(interval: int = BALANCE_SNAPSHOT_INTERVAL):
+    while True:
+        await asyncio.sleep(interval)
+        try:
+            await take_balance_snapshots()
+        except Exception as e:
+            log.warning("balance snapshot failed: %s", e)
+
+
+# ---------------- Leaderboard ----------------
+LEADERBOARD = Leaderboard()
+LEADERBOARD_CHECK_INTERVAL = int(os.getenv("LEADERBOARD_CHECK_INTERVAL", "600"))
+
+
+async def _fetch_balances() -> List[Tuple[int, Optional[str], int]]:
+    async with db_connection() as db:
+        cur = await db.execute("SELECT user_id, username, COALESCE(almaz,0) FROM users")
+        return [(r[0], r[1], r[2]) for r in await cur.fetchall()]
+
+
+async def load_leaderboard():
+    started = time.perf_counter()
+    LEADERBOARD.load(await _fetch_balances())
+    log.info("leaderboard loaded: %s users in %.3fs", len(LEADERBOARD), time.perf_counter() - started)
+
+
+async def verify_leaderboard() -> int:
+    """
+    Xotiradagi reytingni SQLite bilan solishtiradi. Farq topilsa,
+    reyting qaytadan yuklanadi. Farqlar sonini qaytaradi.
+    """
+    version = LEADERBOARD.version
+    rows = await _fetch_balances()
+    # O'qish paytida yozilgan balanslar xotirada yangiroq — ularni solishtirmaymiz
+    fresh = LEADERBOARD.changed_since(version)
+    memory = LEADERBOARD.balances()
+    seen = set()
+    stale = []
+    for row in rows:
+        seen.add(row[0])
+        if row[0] not in fresh and memory.get(row[0]) != row[2]:
+            stale.append(row)
+    missing = [user_id for user_id in memory if user_id not in seen and user_id not in fresh]
+    diff_count = len(stale) + len(missing)
+    if not diff_count:
+        return 0
+    if not fresh:
+        log.warning("leaderboard drift: %s mismatches, reloading", diff_count)
+        LEADERBOARD.load(rows)
+    else:
+        # To'liq yuklash yangi qiymatlarni eskisi bilan almashtirardi — faqat farqlar tuzatiladi
+        log.warning("leaderboard drift: %s mismatches, repairing rows", diff_count)
+        for user_id, username, almaz in stale:
+            LEADERBOARD.add_user(user_id, username)
+            LEADERBOARD.set_balance(user_id, almaz)
+    return diff_count
+
+
+async def leaderboard_check_loop(interval: int = LEADERBOARD_CHECK_INTERVAL):
+    while True:
+        await asyncio.sleep(interval)
+        try:
+            await verify_leaderboard()
+        except Exception as e:
+            log.warning("leaderboard check failed: %s", e)
 
 
 async def get_leaderboard(limit: int = 15) -> List[Tuple[str, int]]:
+    if LEADERBOARD.loaded:
+        return LEADERBOARD.top(limit)
     async with db_connection() as db:
         cur = await db.execute("""
             SELECT username, COALESCE(almaz,0) FROM users
@@ -260,6 +1080,8 @@ async def get_leaderboard(limit: int = 15) -> List[Tuple[str, int]]:
 
 
 async def get_user_rank(user_id: int) -> Tuple[int, int]:
+    if LEADERBOARD.loaded:
+        return LEADERBOARD.rank(user_id)
     async with db_connection() as db:
         cur = await db.execute("SELECT COUNT(*) FROM users")
         total_row = await cur.fetchone()
@@ -287,28 +1109,21 @@ async def set_ref_by_if_empty(user_id: int, ref_by: Optional[int]):
     if not ref_by or ref_by == user_id:
         return
 
-    async with db_connection() as db:
-        cur = await db.execute("SELECT ref_by FROM users WHERE user_id=?", (user_id,))
-        row = await cur.fetchone()
+    def unit(conn: sqlite3.Connection):
+        conn.execute("UPDATE users SET ref_by=? WHERE user_id=? AND ref_by IS NULL", (ref_by, user_id))
 
-        if row and row[0] is None:
-            await db.execute("UPDATE users SET ref_by=? WHERE user_id=?", (ref_by, user_id))
-            await db.commit()
+    await run_write(unit)
 
 
 async def set_verified(user_id: int):
-    async with db_connection() as db:
-        await db.execute("UPDATE users SET verified = 1 WHERE user_id=?", (user_id,))
-        await db.commit()
+    await _execute_write("UPDATE users SET verified = 1 WHERE user_id=?", (user_id,))
 
 
 async def set_phone_verified(user_id: int, phone: str):
-    async with db_connection() as db:
-        await db.execute(
-            "UPDATE users SET phone = ?, verified = 1 WHERE user_id=?",
-            (phone, user_id)
-        )
-        await db.commit()
+    await _execute_write(
+        "UPDATE users SET phone = ?, verified = 1 WHERE user_id=?",
+        (phone, user_id)
+    )
 
 
 async def is_verified(user_id: int) -> bool:
@@ -325,7 +1140,54 @@ async def is_verified(user_id: int) -> bool:
 
 
 # ---------------- Admins ----------------
+class _AdminRegistry:
+    """
+    Adminlar to'plami xotirada: a'zolik O(1), xabar oluvchilar ro'yxati
+    (egalar + adminlar, takrorlanmasdan) oldindan tayyorlanadi.
+    add_admin / remove_admin bazaga yozgandan keyin shu yerda ham yangilanadi.
+    """
+
+    def __init__(self, owners: Tuple[int, ...]):
+        self.owners = owners
+        self.loaded = False
+        self._admins: dict[int, Optional[str]] = {}
+        self.recipients: Tuple[int, ...] = owners
+
+    def load(self, rows: List[Tuple[int, Optional[str]]]):
+        self._admins = dict(rows)
+        self._rebuild()
+        self.loaded = True
+
+    def _rebuild(self):
+        self.recipients = tuple(dict.fromkeys(self.owners + tuple(sorted(self._admins))))
+
+    def __contains__(self, user_id: int) -> bool:
+        return user_id in self._admins
+
+    def rows(self) -> List[Tuple[int, Optional[str]]]:
+        return sorted(self._admins.items())
+
+    def add(self, user_id: int, username: Optional[str]):
+        self._admins[user_id] = username
+        self._rebuild()
+
+    def remove(self, user_id: int):
+        self._admins.pop(user_id, None)
+        self._rebuild()
+
+
+ADMINS = _AdminRegistry(tuple(dict.fromkeys((OWNER_ID, OWNER2_ID))))
+
+
+async def load_admin_registry():
+    async with db_connection() as db:
+        cur = await db.execute("SELECT user_id, username FROM admins")
+        ADMINS.load([(r[0], r[1]) for r in await cur.fetchall()])
+
+
 async def list_admins() -> List[Tuple[int, Optional[str]]]:
+    if ADMINS.loaded:
+        return ADMINS.rows()
     async with db_connection() as db:
         cur = await db.execute("SELECT user_id, username FROM admins ORDER BY user_id ASC")
         rows = await cur.fetchall()
@@ -333,30 +1195,41 @@ async def list_admins() -> List[Tuple[int, Optional[str]]]:
 
 
 async def add_admin(user_id: int, username: Optional[str]):
-    async with db_connection() as db:
-        try:
-            await db.execute("INSERT INTO admins(user_id, username) VALUES(?, ?)", (user_id, username))
-            await db.commit()
-            return True
-        except Exception:
-            return False
+    try:
+        await _execute_write("INSERT INTO admins(user_id, username) VALUES(?, ?)", (user_id, username))
+    except Exception:
+        return False
+    ADMINS.add(user_id, username)
+    return True
 
 
 async def remove_admin(user_id: int):
-    async with db_connection() as db:
-        cur = await db.execute("DELETE FROM admins WHERE user_id=?", (user_id,))
-        await db.commit()
-        return cur.rowcount > 0
+    rowcount, _ = await _execute_write("DELETE FROM admins WHERE user_id=?", (user_id,))
+    ADMINS.remove(user_id)
+    return rowcount > 0
 
 
 async def is_admin(user_id: int) -> bool:
+    if ADMINS.loaded:
+        return user_id in ADMINS
     async with db_connection() as db:
         cur = await db.execute("SELECT 1 FROM admins WHERE user_id=?", (user_id,))
         return await cur.fetchone() is not None
 
 
+def notify_recipients() -> Tuple[int, ...]:
+    # Egalar birinchi, keyin adminlar (user_id bo'yicha); takrorlanmaydi
+    return ADMINS.recipients
+
+
 # ---------------- Dynamic texts ----------------
+# load_settings_cache() dan keyin matnlar xotiradan o'qiladi
+_TEXTS: Optional[dict[str, str]] = None
+
+
 async def get_dynamic_text(key: str) -> str:
+    if _TEXTS is not None:
+        return _TEXTS.get(key) or ""
     async with db_connection() as db:
         cur = await db.execute("SELECT content FROM dynamic_texts WHERE key=?", (key,))
         row = await cur.fetchone()
@@ -364,13 +1237,13 @@ async def get_dynamic_text(key: str) -> str:
 
 
 async def update_dynamic_text(key: str, content: str):
-    async with db_connection() as db:
-        await db.execute("""
-            INSERT INTO dynamic_texts(key, content)
-            VALUES(?, ?)
-            ON CONFLICT(key) DO UPDATE SET content=excluded.content
-        """, (key, content))
-        await db.commit()
+    await _execute_write("""
+        INSERT INTO dynamic_texts(key, content)
+        VALUES(?, ?)
+        ON CONFLICT(key) DO UPDATE SET content=excluded.content
+    """, (key, content))
+    if _TEXTS is not None:
+        _TEXTS[key] = content
 
 
 # ---------------- Required channels ----------------
@@ -381,27 +1254,43 @@ async def list_required_channels() -> list[str]:
         return [r[0] for r in rows]
 
 
+# Kanallar ro'yxati o'zgarganda oshadi — obuna keshlari shunga qarab tozalanadi
+_CHANNELS_VERSION = 0
+
+
+def required_channels_version() -> int:
+    return _CHANNELS_VERSION
+
+
 async def add_required_channel(username: str) -> bool:
+    global _CHANNELS_VERSION
     username = username.strip()
     if not username.startswith("@"):
         username = "@" + username
-    async with db_connection() as db:
-        try:
-            await db.execute("INSERT INTO required_channels(username) VALUES(?)", (username,))
-            await db.commit()
-            return True
-        except Exception:
-            return False
+    try:
+        await _execute_write("INSERT INTO required_channels(username) VALUES(?)", (username,))
+    except Exception:
+        return False
+    _CHANNELS_VERSION += 1
+    return True
 
 
 async def remove_required_channel(username: str) -> bool:
+    global _CHANNELS_VERSION
     username = username.strip()
     if not username.startswith("@"):
         username = "@" + username
-    async with db_connection() as db:
-        cur = await db.execute("DELETE FROM required_channels WHERE username=?", (username,))
-        await db.commit()
-        return cur.rowcount > 0
+
+    def unit(conn: sqlite3.Connection) -> int:
+        rowcount = conn.execute("DELETE FROM required_channels WHERE username=?", (username,)).rowcount
+        conn.execute("DELETE FROM channel_members WHERE channel=?", (username,))
+        conn.execute("DELETE FROM tracked_channels WHERE channel=?", (username,))
+        return rowcount
+
+    removed = await run_write(unit) > 0
+    if removed:
+        _CHANNELS_VERSION += 1
+    return removed
 
 
 async def required_channels_count() -> int:
@@ -411,79 +1300,358 @@ async def required_channels_count() -> int:
         return int(row[0]) if row else 0
 
 
+# ---------------- Channel members ----------------
+async def get_subscription_state(user_id: int) -> List[Tuple[str, bool, Optional[str], Optional[int]]]:
+    """
+    Har bir majburiy kanal uchun (kanal, kuzatilyaptimi, status, yangilangan vaqt).
+    Status — oxirgi chat_member yangilanishi yoki get_chat_member natijasi.
+    """
+    async with db_connection() as db:
+        cur = await db.execute(
+            """
+            SELECT rc.username, COALESCE(tc.tracking, 0), cm.status, cm.updated_at
+            FROM required_channels rc
+            LEFT JOIN tracked_channels tc ON tc.channel = rc.username
+            LEFT JOIN channel_members cm ON cm.channel = rc.username AND cm.user_id = ?
+            ORDER BY rc.username ASC
+            """,
+            (user_id,)
+        )
+        return [(r[0], bool(r[1]), r[2], r[3]) for r in await cur.fetchall()]
+
+
+async def record_channel_member(channel: str, user_id: int, status: str, at: Optional[int] = None):
+    # Yangilanishlar tartibsiz kelishi mumkin — eskisi yangisini bosib ketmaydi
+    await _execute_write(
+        """
+        INSERT INTO channel_members(channel, user_id, status, updated_at)
+        VALUES(?, ?, ?, ?)
+        ON CONFLICT(channel, user_id) DO UPDATE SET status=excluded.status, updated_at=excluded.updated_at
+        WHERE excluded.updated_at >= channel_members.updated_at
+        """,
+        (channel, user_id, status, at if at is not None else int(time.time()))
+    )
+
+
+async def list_tracked_channels() -> dict[str, Optional[int]]:
+    async with db_connection() as db:
+        cur = await db.execute("SELECT channel, chat_id FROM tracked_channels WHERE tracking = 1")
+        return {r[0]: r[1] for r in await cur.fetchall()}
+
+
+async def set_channel_tracking(channel: str, chat_id: Optional[int], tracking: bool):
+    await _execute_write(
+        """
+        INSERT INTO tracked_channels(channel, chat_id, tracking, updated_at)
+        VALUES(?, ?, ?, ?)
+        ON CONFLICT(channel) DO UPDATE SET
+            chat_id=COALESCE(excluded.chat_id, tracked_channels.chat_id),
+            tracking=excluded.tracking,
+            updated_at=excluded.updated_at
+        """,
+        (channel, chat_id, int(tracking), int(time.time()))
+    )
+
+
 # ---------------- Suspensions ----------------
+class _SuspensionIndex:
+    """
+    Faol tanaffuslar: user_id -> until_ts lug'ati va muddati bo'yicha
+    min-heap. Tanaffusdagi bo'lmagan foydalanuvchi uchun tekshiruv —
+    bitta dict qidiruvi, I/O yo'q.
+    """
+
+    def __init__(self):
+        self.loaded = False
+        self._until: dict[int, int] = {}
+        # (until_ts, user_id); yangilangan yozuvlarning eskisi pop paytida tashlab ketiladi
+        self._heap: List[Tuple[int, int]] = []
+        self.changed = asyncio.Event()
+
+    def __len__(self) -> int:
+        return len(self._until)
+
+    def load(self, rows: List[Tuple[int, int]]):
+        self._until = {user_id: until_ts for user_id, until_ts in rows}
+        self._heap = [(until_ts, user_id) for user_id, until_ts in rows]
+        heapq.heapify(self._heap)
+        self.loaded = True
+        self.changed.set()
+
+    def set(self, user_id: int, until_ts: int):
+        self._until[user_id] = until_ts
+        heapq.heappush(self._heap, (until_ts, user_id))
+        self.changed.set()
+
+    def until(self, user_id: int) -> Optional[int]:
+        return self._until.get(user_id)
+
+    def next_expiry(self) -> Optional[int]:
+        while self._heap:
+            until_ts, user_id = self._heap[0]
+            if self._until.get(user_id) == until_ts:
+                return until_ts
+            heapq.heappop(self._heap)
+        return None
+
+    def pop_expired(self, now: int) -> List[Tuple[int, int]]:
+        expired = []
+        while self._heap and self._heap[0][0] <= now:
+            until_ts, user_id = heapq.heappop(self._heap)
+            if self._until.get(user_id) == until_ts:
+                del self._until[user_id]
+                expired.append((user_id, until_ts))
+        return expired
+
+
+SUSPENSIONS = _SuspensionIndex()
+SUSPENSION_MAX_SLEEP = 300
+
+
+async def load_suspensions():
+    async with db_connection() as db:
+        cur = await db.execute("SELECT user_id, until_ts FROM suspensions")
+        SUSPENSIONS.load([(r[0], int(r[1] or 0)) for r in await cur.fetchall()])
+
+
 async def set_suspension(user_id: int, seconds: int):
     until_ts = int(time.time()) + max(0, int(seconds))
-    async with db_connection() as db:
-        await db.execute("""
-            INSERT INTO suspensions(user_id, until_ts)
-            VALUES(?, ?)
-            ON CONFLICT(user_id) DO UPDATE SET until_ts=excluded.until_ts
-        """, (user_id, until_ts))
-        await db.commit()
+    await _execute_write("""
+        INSERT INTO suspensions(user_id, until_ts)
+        VALUES(?, ?)
+        ON CONFLICT(user_id) DO UPDATE SET until_ts=excluded.until_ts
+    """, (user_id, until_ts))
+    if SUSPENSIONS.loaded:
+        SUSPENSIONS.set(user_id, until_ts)
 
 
 async def get_suspension_remaining(user_id: int) -> int:
     now = int(time.time())
+    if SUSPENSIONS.loaded:
+        # Muddati o'tganlarni suspension_expiry_loop o'chiradi
+        until_ts = SUSPENSIONS.until(user_id)
+        return max(0, until_ts - now) if until_ts is not None else 0
     async with db_connection() as db:
         cur = await db.execute("SELECT until_ts FROM suspensions WHERE user_id=?", (user_id,))
         row = await cur.fetchone()
-        if not row:
-            return 0
-        remain = row[0] - now
-        if remain <= 0:
-            await db.execute("DELETE FROM suspensions WHERE user_id=?", (user_id,))
-            await db.commit()
-            return 0
-        return remain
+    if not row:
+        return 0
+    remain = row[0] - now
+    if remain <= 0:
+        await _execute_write("DELETE FROM suspensions WHERE user_id=? AND until_ts<=?", (user_id, now))
+        return 0
+    return remain
+
+
+async def purge_expired_suspensions() -> List[int]:
+    expired = SUSPENSIONS.pop_expired(int(time.time()))
+    if not expired:
+        return []
+
+    def unit(conn: sqlite3.Connection):
+        # until_ts sharti: shu orada yangi tanaffus berilgan bo'lsa, u o'chmaydi
+        conn.executemany("DELETE FROM suspensions WHERE user_id=? AND until_ts<=?", expired)
+
+    await run_write(unit)
+    return [user_id for user_id, _ in expired]
+
+
+async def suspension_expiry_loop(on_expired=None):
+    """
+    Eng yaqin muddatgacha uxlaydi (yangi tanaffus qo'shilsa uyg'onadi),
+    muddati o'tganlarni bitta tranzaksiyada o'chiradi va
+    ``on_expired(user_ids)`` ni chaqiradi.
+    """
+    while True:
+        SUSPENSIONS.changed.clear()
+        next_ts = SUSPENSIONS.next_expiry()
+        delay = SUSPENSION_MAX_SLEEP if next_ts is None else min(SUSPENSION_MAX_SLEEP, next_ts - time.time())
+        if delay > 0:
+            try:
+                await asyncio.wait_for(SUSPENSIONS.changed.wait(), timeout=delay)
+                continue
+            except asyncio.TimeoutError:
+                pass
+        try:
+            user_ids = await purge_expired_suspensions()
+            if user_ids and on_expired is not None:
+                await on_expired(user_ids)
+        except Exception as e:
+            log.warning("suspension expiry failed: %s", e)
+
+
+# ---------------- Reachability ----------------
+async def mark_unreachable(user_id: int, reason: str):
+    # Darhol yoziladi: kechiktirilgan belgi /start'dagi tozalashdan keyin
+    # tushib, qaytgan foydalanuvchini yana "yetib bo'lmaydigan" qilib qo'yardi
+    await _execute_write(
+        "UPDATE users SET unreachable=?, unreachable_at=? WHERE user_id=? AND unreachable IS NOT ?",
+        (reason, int(time.time()), user_id, reason)
+    )
+
+
+async def filter_reachable(user_ids: List[int]) -> List[int]:
+    """Tartibni saqlab, yetib bo'lmaydigan deb belgilanganlarni chiqarib tashlaydi."""
+    if not user_ids:
+        return []
+    placeholders = ",".join("?" * len(user_ids))
+    async with db_connection() as db:
+        cur = await db.execute(
+            f"SELECT user_id FROM users WHERE user_id IN ({placeholders}) AND unreachable IS NOT NULL",
+            tuple(user_ids)
+        )
+        unreachable = {r[0] for r in await cur.fetchall()}
+    return [uid for uid in user_ids if uid not in unreachable]
+
+
+async def get_unreachable_stats() -> dict[str, int]:
+    async with db_connection() as db:
+        cur = await db.execute(
+            "SELECT unreachable, COUNT(*) FROM users WHERE unreachable IS NOT NULL GROUP BY unreachable"
+        )
+        return {reason: int(count) for reason, count in await cur.fetchall()}
 
 
 # ---------------- Referrals ----------------
 async def create_referral(inviter_id: int, invited_id: int):
     now = int(time.time())
-    async with db_connection() as db:
-        try:
-            cur = await db.execute(
-                "INSERT INTO referrals(inviter_id, invited_id, status, created_at) VALUES(?, ?, 'joined', ?)",
-                (inviter_id, invited_id, now)
-            )
-            await db.commit()
-            return True
-        except Exception:
-            # already exists or other error -> return False
-            return False
+
+    def unit(conn: sqlite3.Connection) -> bool:
+        # Takroriy yozuv istisnosiz o'tkazib yuboriladi
+        return conn.execute(
+            """
+            INSERT INTO referrals(inviter_id, invited_id, status, created_at) VALUES(?, ?, 'joined', ?)
+            ON CONFLICT(invited_id) DO NOTHING
+            """,
+            (inviter_id, invited_id, now)
+        ).rowcount > 0
+
+    try:
+        return await run_write(unit)
+    except Exception:
+        return False
 
 
 async def mark_referral_verified(invited_id: int):
     now = int(time.time())
-    async with db_connection() as db:
-        cur = await db.execute("SELECT status FROM referrals WHERE invited_id=?", (invited_id,))
-        row = await cur.fetchone()
-        # If already verified — nothing to do
-        if row and row[0] == "verified":
+
+    def unit(conn: sqlite3.Connection) -> bool:
+        # Faqat 'verified' bo'lmagan yozuv o'zgaradi — takroriy chaqiruv False qaytaradi
+        row = conn.execute(
+            """
+            UPDATE referrals SET status='verified', verified_at=?
+            WHERE invited_id=? AND COALESCE(status, '') != 'verified'
+            RETURNING inviter_id
+            """,
+            (now, invited_id)
+        ).fetchone()
+        if not row:
             return False
 
-        # If referral record exists — mark verified and return True
-        if row:
-            await db.execute(
-                "UPDATE referrals SET status='verified', verified_at=? WHERE invited_id=?",
-                (now, invited_id)
-            )
-            await db.commit()
-            return True
+        # Hisoblagich shu tranzaksiya ichida oshiriladi
+        conn.execute(
+            "UPDATE users SET verified_refs = verified_refs + 1 WHERE user_id=?",
+            (row[0],)
+        )
+        return True
+
+    return await run_write(unit)
+
+
+class VerificationResult(NamedTuple):
+    ref_by: Optional[int]
+    rewarded: bool              # shu chaqiruvda mukofot berildimi
+    reward: int
+    inviter_balance: Optional[int]
+    inviter_verified_refs: int
 
-        # No referral record — nothing to mark
-        return False
+
+async def settle_verification(user_id: int, phone: str, reward: Optional[int] = None) -> VerificationResult:
+    """
+    Telefon tasdiqlanishi va taklif qilganga mukofot — bitta tranzaksiyada.
+    Takroriy chaqiruv xavfsiz: referal allaqachon 'verified' bo'lsa,
+    mukofot qayta berilmaydi (rewarded=False).
+    """
+    if reward is None:
+        reward = await get_setting_int("referral_reward", 1)
+    now = int(time.time())
+
+    def unit(conn: sqlite3.Connection) -> VerificationResult:
+        row = conn.execute(
+            "UPDATE users SET phone=?, verified=1 WHERE user_id=? RETURNING ref_by",
+            (phone, user_id)
+        ).fetchone()
+        ref_by = row[0] if row else None
+        if not ref_by or ref_by == user_id:
+            return VerificationResult(None, False, reward, None, 0)
+
+        flipped = conn.execute(
+            """
+            UPDATE referrals SET status='verified', verified_at=?
+            WHERE invited_id=? AND inviter_id=? AND COALESCE(status, '') != 'verified'
+            RETURNING id
+            """,
+            (now, user_id, ref_by)
+        ).fetchone()
+        if flipped:
+            inviter = conn.execute(
+                """
+                UPDATE users SET almaz = COALESCE(almaz,0) + ?, verified_refs = verified_refs + 1
+                WHERE user_id=?
+                RETURNING almaz, verified_refs
+                """,
+                (reward, ref_by)
+            ).fetchone()
+            if inviter:
+                _append_ledger(conn, ref_by, reward, "referral_reward", flipped[0])
+        else:
+            inviter = conn.execute(
+                "SELECT COALESCE(almaz,0), verified_refs FROM users WHERE user_id=?", (ref_by,)
+            ).fetchone()
+        balance, refs = (inviter[0], int(inviter[1] or 0)) if inviter else (None, 0)
+        return VerificationResult(ref_by, flipped is not None and inviter is not None, reward, balance, refs)
+
+    result = await run_write(unit)
+    if result.rewarded and LEADERBOARD.loaded:
+        LEADERBOARD.set_balance(result.ref_by, result.inviter_balance)
+    return result
 
 
 async def count_verified_referrals(inviter_id: int) -> int:
     async with db_connection() as db:
-        cur = await db.execute(
-            "SELECT COUNT(*) FROM referrals WHERE inviter_id=? AND status='verified'",
-            (inviter_id,)
-        )
+        cur = await db.execute("SELECT verified_refs FROM users WHERE user_id=?", (inviter_id,))
         row = await cur.fetchone()
-        return int(row[0]) if row else 0
+        return int(row[0] or 0) if row else 0
+
+
+async def reconcile_verified_refs(fix: bool = False) -> List[Tuple[int, int, int]]:
+    """
+    users.verified_refs ni referrals jadvali bilan solishtiradi.
+    Mos kelmaganlar ro'yxatini (user_id, saqlangan, haqiqiy) qaytaradi;
+    ``fix=True`` bo'lsa, ularni tuzatadi.
+    """
+    async with db_connection() as db:
+        cur = await db.execute(f"""
+            SELECT user_id, verified_refs, actual FROM (
+                SELECT user_id, COALESCE(verified_refs, 0) AS verified_refs,
+                       ({_VERIFIED_REFS_SUBQUERY}) AS actual
+                FROM users
+            )
+            WHERE verified_refs != actual
+            ORDER BY user_id ASC
+        """)
+        mismatches = [(r[0], r[1], r[2]) for r in await cur.fetchall()]
+
+    if fix and mismatches:
+        def unit(conn: sqlite3.Connection):
+            # Qiymat yozuvchi tranzaksiya ichida qayta hisoblanadi
+            conn.executemany(
+                f"UPDATE users SET verified_refs = ({_VERIFIED_REFS_SUBQUERY}) WHERE user_id=?",
+                [(user_id,) for user_id, _, _ in mismatches]
+            )
+
+        await run_write(unit)
+    return mismatches
 
 
 async def count_all_referrals(inviter_id: int) -> int:
@@ -518,56 +1686,118 @@ async def get_top_referrers_today(limit: int = 10) -> List[Tuple[int, Optional[s
         return [(r[0], r[1], r[2]) for r in rows]
 
 # ---------------- Offers ----------------
+class _OfferCatalog:
+    """
+    Takliflar xotirada: har bir o'yin uchun narx bo'yicha tartiblangan
+    ro'yxat. create/update/delete_offer bazaga yozgandan keyin shu yerda
+    ham yangilanadi va ``version`` oshadi (klaviaturalar keshi uchun).
+    """
+
+    def __init__(self):
+        self.loaded = False
+        self.version = 0
+        self._by_id: dict[int, Tuple[int, str, str, int]] = {}
+        self._by_game: dict[str, List[Tuple[int, str, int]]] = {}
+        self._costs: dict[str, List[int]] = {}
+
+    def load(self, rows: List[Tuple[int, str, str, int]]):
+        self._by_id = {r[0]: (r[0], r[1], r[2], int(r[3])) for r in rows}
+        self._rebuild()
+        self.loaded = True
+
+    def _rebuild(self):
+        by_game: dict[str, list] = {}
+        for oid, game, label, cost in sorted(self._by_id.values(), key=lambda r: (r[3], r[0])):
+            by_game.setdefault(game, []).append((oid, label, cost))
+        self._by_game = by_game
+        self._costs = {game: [o[2] for o in offers] for game, offers in by_game.items()}
+        self.version += 1
+
+    def get(self, offer_id: int) -> Optional[Tuple[int, str, str, int]]:
+        return self._by_id.get(offer_id)
+
+    def for_game(self, game: str, max_cost: Optional[int] = None) -> List[Tuple[int, str, int]]:
+        offers = self._by_game.get(game, [])
+        if max_cost is None:
+            return list(offers)
+        return offers[:bisect.bisect_right(self._costs[game], max_cost)] if offers else []
+
+    def set(self, offer_id: int, game: str, label: str, cost: int):
+        self._by_id[offer_id] = (offer_id, game, label, int(cost))
+        self._rebuild()
+
+    def remove(self, offer_id: int):
+        if self._by_id.pop(offer_id, None) is not None:
+            self._rebuild()
+
+
+OFFERS = _OfferCatalog()
+
+
+async def load_offer_catalog():
+    async with db_connection() as db:
+        cur = await db.execute("SELECT id, game, label, achko_cost FROM offers")
+        OFFERS.load([(r[0], r[1], r[2], r[3]) for r in await cur.fetchall()])
+
+
+def offers_version() -> int:
+    return OFFERS.version
+
+
 async def create_offer(game: str, label: str, achko_cost: int):
     now = int(time.time())
-    async with db_connection() as db:
-        cur = await db.execute(
-            "INSERT INTO offers(game, label, achko_cost, created_at) VALUES(?, ?, ?, ?)",
-            (game, label, achko_cost, now)
-        )
-        await db.commit()
-        return cur.lastrowid
+    _, offer_id = await _execute_write(
+        "INSERT INTO offers(game, label, achko_cost, created_at) VALUES(?, ?, ?, ?)",
+        (game, label, achko_cost, now)
+    )
+    if OFFERS.loaded:
+        OFFERS.set(offer_id, game, label, achko_cost)
+    return offer_id
 
 
-async def list_offers(game: str) -> List[Tuple[int, str, int]]:
+async def list_offers(game: str, max_cost: Optional[int] = None) -> List[Tuple[int, str, int]]:
+    """O'yin takliflari narx bo'yicha; ``max_cost`` — faqat shu balansga yetadiganlari."""
+    if OFFERS.loaded:
+        return OFFERS.for_game(game, max_cost)
     async with db_connection() as db:
         cur = await db.execute(
-            "SELECT id, label, achko_cost FROM offers WHERE game=? ORDER BY achko_cost ASC",
-            (game,)
+            "SELECT id, label, achko_cost FROM offers WHERE game=? AND (? IS NULL OR achko_cost <= ?) "
+            "ORDER BY achko_cost ASC",
+            (game, max_cost, max_cost)
         )
         rows = await cur.fetchall()
         return [(r[0], r[1], r[2]) for r in rows]
 
 
 async def get_offer(offer_id: int):
+    if OFFERS.loaded:
+        return OFFERS.get(offer_id)
     async with db_connection() as db:
         cur = await db.execute("SELECT id, game, label, achko_cost FROM offers WHERE id=?", (offer_id,))
         return await cur.fetchone()
 
 
 async def update_offer(offer_id: int, label: str, achko_cost: int):
-    async with db_connection() as db:
-        await db.execute("UPDATE offers SET label=?, achko_cost=? WHERE id=?", (label, achko_cost, offer_id))
-        await db.commit()
+    await _execute_write("UPDATE offers SET label=?, achko_cost=? WHERE id=?", (label, achko_cost, offer_id))
+    offer = OFFERS.get(offer_id)
+    if offer:
+        OFFERS.set(offer_id, offer[1], label, achko_cost)
 
 
 async def delete_offer(offer_id: int):
-    async with db_connection() as db:
-        cur = await db.execute("DELETE FROM offers WHERE id=?", (offer_id,))
-        await db.commit()
-        return cur.rowcount > 0
+    rowcount, _ = await _execute_write("DELETE FROM offers WHERE id=?", (offer_id,))
+    OFFERS.remove(offer_id)
+    return rowcount > 0
 
 
 # ---------------- Purchases ----------------
 async def create_purchase(user_id: int, amount: int, proof_chat_id: int, proof_message_id: int):
     now = int(time.time())
-    async with db_connection() as db:
-        cur = await db.execute(
-            "INSERT INTO purchases(user_id, amount, proof_chat_id, proof_message_id, status, created_at) VALUES(?, ?, ?, ?, 'pending', ?)",
-            (user_id, amount, proof_chat_id, proof_message_id, now)
-        )
-        await db.commit()
-        return cur.lastrowid
+    _, purchase_id = await _execute_write(
+        "INSERT INTO purchases(user_id, amount, proof_chat_id, proof_message_id, status, created_at) VALUES(?, ?, ?, ?, 'pending', ?)",
+        (user_id, amount, proof_chat_id, proof_message_id, now)
+    )
+    return purchase_id
 
 
 async def list_pending_purchases() -> List[Tuple[int, int, int, int]]:
@@ -580,57 +1810,61 @@ async def list_pending_purchases() -> List[Tuple[int, int, int, int]]:
 
 async def update_purchase_status(purchase_id: int, status: str, processed_by: int | None, note: str | None = None):
     now = int(time.time())
-    async with db_connection() as db:
-        if note is not None:
-            await db.execute(
-                "UPDATE purchases SET status=?, processed_at=?, processed_by=?, note=? WHERE id=?",
-                (status, now, processed_by, note, purchase_id)
-            )
-        else:
-            await db.execute(
-                "UPDATE purchases SET status=?, processed_at=?, processed_by=? WHERE id=?",
-                (status, now, processed_by, purchase_id)
-            )
-        await db.commit()
+    if note is not None:
+        await _execute_write(
+            "UPDATE purchases SET status=?, processed_at=?, processed_by=?, note=? WHERE id=?",
+            (status, now, processed_by, note, purchase_id)
+        )
+    else:
+        await _execute_write(
+            "UPDATE purchases SET status=?, processed_at=?, processed_by=? WHERE id=?",
+            (status, now, processed_by, purchase_id)
+        )
 
 
 # ---------------- Atomic withdraw + deduct ----------------
 async def create_withdraw_and_deduct(user_id: int, amount: int, ff_id: str, game: str = "ff"):
     now = int(time.time())
-    async with db_connection() as db:
-        await db.execute("BEGIN IMMEDIATE")
-        cur = await db.execute("SELECT COALESCE(almaz,0) FROM users WHERE user_id=?", (user_id,))
-        row = await cur.fetchone()
+
+    def unit(conn: sqlite3.Connection) -> Optional[Tuple[int, int]]:
+        row = conn.execute("SELECT COALESCE(almaz,0) FROM users WHERE user_id=?", (user_id,)).fetchone()
         if not row:
-            await db.rollback()
             return None
         balance = int(row[0])
         if balance < amount:
-            await db.rollback()
             return None
 
-        await db.execute("UPDATE users SET almaz = almaz - ? WHERE user_id=?", (amount, user_id))
-        cur = await db.execute(
+        conn.execute("UPDATE users SET almaz = almaz - ? WHERE user_id=?", (amount, user_id))
+        cur = conn.execute(
             "INSERT INTO withdraw_requests(user_id, amount, ff_id, game, status, created_at) VALUES(?, ?, ?, ?, 'pending', ?)",
             (user_id, amount, ff_id, game, now)
         )
-        await db.commit()
-        return cur.lastrowid
+        _append_ledger(conn, user_id, -amount, "withdraw", cur.lastrowid)
+        return cur.lastrowid, balance - amount
+
+    result = await run_write(unit)
+    if result is None:
+        return None
+    request_id, new_balance = result
+    if LEADERBOARD.loaded:
+        LEADERBOARD.set_balance(user_id, new_balance)
+    return request_id
 
 
 # ---------------- Withdraw ----------------
 async def create_withdraw_request(user_id: int, amount: int, ff_id: str, game: str = "ff") -> int:
     now = int(time.time())
-    async with db_connection() as db:
-        cur = await db.execute(
+
+    def unit(conn: sqlite3.Connection) -> int:
+        return conn.execute(
             """
             INSERT INTO withdraw_requests(user_id, amount, ff_id, game, status, created_at)
             VALUES(?, ?, ?, ?, 'pending', ?)
             """,
             (user_id, amount, ff_id, game, now)
-        )
-        await db.commit()
-        return cur.lastrowid
+        ).lastrowid
+
+    return await run_write(unit)
 
 
 async def get_withdraw_request(request_id: int):
@@ -646,28 +1880,79 @@ async def get_withdraw_request(request_id: int):
         return await cur.fetchone()
 
 
-async def update_withdraw_status(request_id: int, status: str, processed_by: Optional[int], note: Optional[str]):
-    now = int(time.time())
+class WithdrawCard(NamedTuple):
+    id: int
+    user_id: int
+    amount: int
+    ff_id: Optional[str]
+    game: Optional[str]
+    status: str
+    created_at: Optional[int]
+    processed_at: Optional[int]
+    processed_by: Optional[int]
+    note: Optional[str]
+    username: Optional[str]
+    almaz: int
+    verified_refs: int
+
+
+_WITHDRAW_CARD_SQL = """
+    SELECT w.id, w.user_id, w.amount, w.ff_id, w.game, w.status,
+           w.created_at, w.processed_at, w.processed_by, w.note,
+           u.username, COALESCE(u.almaz, 0), COALESCE(u.verified_refs, 0)
+    FROM withdraw_requests w
+    LEFT JOIN users u ON u.user_id = w.user_id
+    WHERE w.id=?
+"""
+
+
+async def get_withdraw_card(request_id: int) -> Optional[WithdrawCard]:
+    # So'rov + foydalanuvchi + tasdiqlangan referallar — bitta so'rovda
     async with db_connection() as db:
-        if note is not None:
-            await db.execute(
-                """
-                UPDATE withdraw_requests
-                SET status=?, processed_at=?, processed_by=?, note=?
-                WHERE id=?
-                """,
-                (status, now, processed_by, note, request_id)
-            )
-        else:
-            await db.execute(
-                """
-                UPDATE withdraw_requests
-                SET status=?, processed_at=?, processed_by=?
-                WHERE id=?
-                """,
-                (status, now, processed_by, request_id)
-            )
-        await db.commit()
+        cur = await db.execute(_WITHDRAW_CARD_SQL, (request_id,))
+        row = await cur.fetchone()
+        return WithdrawCard(*row) if row else None
+
+
+# Ruxsat etilgan o'tishlar: holat -> qaysi holatlarga o'tish mumkin.
+# Bu yerda yo'q holatlar (approved, rejected, edited) — yakuniy.
+WITHDRAW_TRANSITIONS = {
+    "pending": ("approved", "rejected", "edited"),
+}
+
+
+def _withdraw_sources(target: str) -> Tuple[str, ...]:
+    return tuple(src for src, targets in WITHDRAW_TRANSITIONS.items() if target in targets)
+
+
+async def transition_withdraw(
+    request_id: int, target: str, processed_by: Optional[int], note: Optional[str] = None
+) -> Tuple[bool, Optional[WithdrawCard]]:
+    """
+    So'rovni ``target`` holatiga bitta shartli UPDATE bilan o'tkazadi.
+    (o'tdimi, karta) qaytaradi: bir vaqtda bosilgan tugmalardan faqat
+    bittasi True oladi, qolganlari kartada joriy holatni ko'radi.
+    """
+    sources = _withdraw_sources(target)
+    if not sources:
+        raise ValueError(f"unknown withdraw status: {target}")
+    now = int(time.time())
+    placeholders = ",".join("?" * len(sources))
+
+    def unit(conn: sqlite3.Connection) -> Tuple[bool, Optional[WithdrawCard]]:
+        won = conn.execute(
+            f"""
+            UPDATE withdraw_requests
+            SET status=?, processed_at=?, processed_by=?, note=COALESCE(?, note)
+            WHERE id=? AND status IN ({placeholders})
+            RETURNING id
+            """,
+            (target, now, processed_by, note, request_id, *sources)
+        ).fetchone()
+        row = conn.execute(_WITHDRAW_CARD_SQL, (request_id,)).fetchone()
+        return won is not None, (WithdrawCard(*row) if row else None)
+
+    return await run_write(unit)
 
 
 async def get_withdraw_stats() -> Tuple[int, int, int, int, int]:
@@ -686,15 +1971,15 @@ async def get_withdraw_stats() -> Tuple[int, int, int, int, int]:
 
 
 async def add_withdraw_notification(request_id: int, chat_id: int, message_id: int):
-    async with db_connection() as db:
-        await db.execute(
-            "INSERT INTO withdraw_notifications(request_id, chat_id, message_id) VALUES(?, ?, ?)",
-            (request_id, chat_id, message_id)
-        )
-        await db.commit()
+    defer_write(
+        "INSERT INTO withdraw_notifications(request_id, chat_id, message_id) VALUES(?, ?, ?)",
+        (request_id, chat_id, message_id)
+    )
 
 
 async def get_withdraw_notifications(request_id: int) -> List[Tuple[int, int]]:
+    # Buferdagi xabar id'lari ham ko'rinishi kerak
+    await flush_deferred_writes()
     async with db_connection() as db:
         cur = await db.execute(
             "SELECT chat_id, message_id FROM withdraw_notifications WHERE request_id=?",
@@ -713,52 +1998,379 @@ async def log_admin_action(
     note: Optional[str] = None
 ):
     now = int(time.time())
-    async with db_connection() as db:
-        await db.execute(
-            """
-            INSERT INTO admin_actions(admin_id, action, target_user_id, amount, note, created_at)
-            VALUES(?, ?, ?, ?, ?, ?)
-            """,
-            (admin_id, action, target_user_id, amount, note, now)
-        )
-        await db.commit()
+    defer_write(
+        """
+        INSERT INTO admin_actions(admin_id, action, target_user_id, amount, note, created_at)
+        VALUES(?, ?, ?, ?, ?, ?)
+        """,
+        (admin_id, action, target_user_id, amount, note, now)
+    )
 
 
 # ---------------- Settings ----------------
+# Sozlamalar faqat admin tomonidan o'zgaradi: xotirada saqlanadi,
+# yozuvlar avval bazaga, keyin keshga tushadi (write-through)
+_SETTINGS: Optional[dict[str, str]] = None
+
+
+async def load_settings_cache():
+    global _SETTINGS, _TEXTS
+    async with db_connection() as db:
+        cur = await db.execute("SELECT key, value FROM settings")
+        settings = {r[0]: r[1] for r in await cur.fetchall()}
+        cur = await db.execute("SELECT key, content FROM dynamic_texts")
+        texts = {r[0]: r[1] for r in await cur.fetchall()}
+    _SETTINGS, _TEXTS = settings, texts
+
+
 async def get_setting(key: str) -> str | None:
+    if _SETTINGS is not None:
+        return _SETTINGS.get(key)
     async with db_connection() as db:
         cur = await db.execute("SELECT value FROM settings WHERE key=?", (key,))
         row = await cur.fetchone()
         return row[0] if row else None
 
 
+async def get_setting_int(key: str, default: int) -> int:
+    value = await get_setting(key)
+    try:
+        return int(value)
+    except (TypeError, ValueError):
+        return default
+
+
 async def set_setting(key: str, value: str):
-    async with db_connection() as db:
-        await db.execute("""
-            INSERT INTO settings(key, value)
-            VALUES(?, ?)
-            ON CONFLICT(key) DO UPDATE SET value=excluded.value
-        """, (key, value))
-        await db.commit()
+    await _execute_write("""
+        INSERT INTO settings(key, value)
+        VALUES(?, ?)
+        ON CONFLICT(key) DO UPDATE SET value=excluded.value
+    """, (key, value))
+    if _SETTINGS is not None:
+        _SETTINGS[key] = value
 
 
 async def delete_setting(key: str):
+    await _execute_write("DELETE FROM settings WHERE key=?", (key,))
+    if _SETTINGS is not None:
+        _SETTINGS.pop(key, None)
+
+
+# ---------------- Broadcasts ----------------
+class BroadcastJob(NamedTuple):
+    id: int
+    admin_id: int
+    from_chat_id: int
+    message_id: int
+    status: str
+    last_user_id: int
+    total: int
+    sent: int
+    failed: int
+    progress_chat_id: Optional[int]
+    progress_message_id: Optional[int]
+    created_at: Optional[int]
+    finished_at: Optional[int]
+    segment: str
+    segment_arg: Optional[int]
+
+
+_BROADCAST_JOB_COLUMNS = (
+    "id, admin_id, from_chat_id, message_id, status, last_user_id, total, sent, failed, "
+    "progress_chat_id, progress_message_id, created_at, finished_at, segment, segment_arg"
+)
+
+# segment -> (shart, argument turi). "days" — argument kunlarda, vaqt belgisiga aylantiriladi.
+# Har bir shart indeks bilan qo'llab-quvvatlanadi (migratsiya 3 va 7).
+BROADCAST_SEGMENTS = {
+    "all": (None, None),
+    "verified": ("verified = 1", None),
+    "pending_withdraw": ("user_id IN (SELECT user_id FROM withdraw_requests WHERE status = 'pending')", None),
+    "balance_above": ("COALESCE(almaz,0) > ?", "int"),
+    "joined_days": ("created_at >= ?", "days"),
+    "ref_by": ("ref_by = ?", "int"),
+    "inactive_days": ("last_seen_at < ?", "days"),
+}
+
+
+def _segment_clause(segment: str, arg: Optional[int]) -> Tuple[str, tuple]:
+    condition, kind = BROADCAST_SEGMENTS[segment]
+    if condition is None:
+        return "", ()
+    if kind is None:
+        return f" AND {condition}", ()
+    if arg is None:
+        raise ValueError(f"segment {segment} requires an argument")
+    value = int(time.time()) - int(arg) * 86400 if kind == "days" else int(arg)
+    return f" AND {condition}", (value,)
+
+
+async def count_segment(segment: str = "all", arg: Optional[int] = None) -> int:
+    clause, params = _segment_clause(segment, arg)
     async with db_connection() as db:
-        await db.execute("DELETE FROM settings WHERE key=?", (key,))
-        await db.commit()
+        cur = await db.execute(f"SELECT COUNT(*) FROM users WHERE unreachable IS NULL{clause}", params)
+        return int((await cur.fetchone())[0])
+
+
+async def list_segment_user_ids_after(
+    after_user_id: int, limit: int, segment: str = "all", arg: Optional[int] = None
+) -> List[int]:
+    # Keyset sahifalash: OFFSET'siz, yetib bo'lmaydiganlarsiz
+    clause, params = _segment_clause(segment, arg)
+    async with db_connection() as db:
+        cur = await db.execute(
+            f"""
+            SELECT user_id FROM users
+            WHERE unreachable IS NULL AND user_id > ?{clause}
+            ORDER BY user_id LIMIT ?
+            """,
+            (after_user_id, *params, limit)
+        )
+        return [r[0] for r in await cur.fetchall()]
+
+
+async def create_broadcast_job(
+    admin_id: int, from_chat_id: int, message_id: int, total: int,
+    segment: str = "all", segment_arg: Optional[int] = None
+) -> int:
+    now = int(time.time())
+    _, job_id = await _execute_write(
+        """
+        INSERT INTO broadcast_jobs(admin_id, from_chat_id, message_id, status, total,
+                                   segment, segment_arg, created_at, updated_at)
+        VALUES(?, ?, ?, 'running', ?, ?, ?, ?, ?)
+        """,
+        (admin_id, from_chat_id, message_id, total, segment, segment_arg, now, now)
+    )
+    return job_id
+
+
+async def get_broadcast_job(job_id: int) -> Optional[BroadcastJob]:
+    async with db_connection() as db:
+        cur = await db.execute(f"SELECT {_BROADCAST_JOB_COLUMNS} FROM broadcast_jobs WHERE id=?", (job_id,))
+        row = await cur.fetchone()
+        return BroadcastJob(*row) if row else None
+
+
+async def list_unfinished_broadcast_jobs() -> List[BroadcastJob]:
+    async with db_connection() as db:
+        cur = await db.execute(
+            f"SELECT {_BROADCAST_JOB_COLUMNS} FROM broadcast_jobs WHERE status IN ('running', 'paused') ORDER BY id"
+        )
+        return [BroadcastJob(*row) for row in await cur.fetchall()]
+
+
+async def set_broadcast_progress_message(job_id: int, chat_id: int, message_id: int):
+    await _execute_write(
+        "UPDATE broadcast_jobs SET progress_chat_id=?, progress_message_id=? WHERE id=?",
+        (chat_id, message_id, job_id)
+    )
+
+
+async def save_broadcast_checkpoint(job_id: int, last_user_id: int, sent: int, failed: int):
+    await _execute_write(
+        "UPDATE broadcast_jobs SET last_user_id=?, sent=?, failed=?, updated_at=? WHERE id=?",
+        (last_user_id, sent, failed, int(time.time()), job_id)
+    )
+
+
+async def set_broadcast_status(job_id: int, status: str):
+    now = int(time.time())
+    finished_at = now if status in ("done", "cancelled") else None
+    await _execute_write(
+        "UPDATE broadcast_jobs SET status=?, updated_at=?, finished_at=COALESCE(finished_at, ?) WHERE id=?",
+        (status, now, finished_at, job_id)
+    )
 
 
 # ---------------- Backup ----------------
-async def backup_database() -> str:
-    backups_dir = "backups"
-    if not os.path.exists(backups_dir):
-        os.makedirs(backups_dir)
+BACKUP_DIR = os.getenv("BACKUP_DIR", "backups")
+# Shuncha so'nggi zaxira saqlanadi, eskilari o'chiriladi
+BACKUP_KEEP = int(os.getenv("BACKUP_KEEP", "7"))
+# Avtomatik zaxira oralig'i (soniya); 0 — o'chiq
+BACKUP_INTERVAL = int(os.getenv("BACKUP_INTERVAL", "0"))
+# Har bir qadamda ko'chiriladigan sahifalar soni (4 KB dan)
+BACKUP_STEP_PAGES = int(os.getenv("BACKUP_STEP_PAGES", "1024"))
+# Boshqa ulanish yozsa, qadamli nusxa boshidan boshlanadi. Shuncha qayta
+# boshlanishdan keyin bir martalik (pages=-1) nusxaga o'tiladi
+BACKUP_MAX_RESTARTS = int(os.getenv("BACKUP_MAX_RESTARTS", "3"))
 
-    timestamp = datetime.now().strftime("%Y%m%d_%H%M%S")
-    backup_path = os.path.join(backups_dir, f"backup_{timestamp}.db")
+
+class _BackupRestarts(Exception):
+    pass
+
+
+_BACKUP_LOCK = asyncio.Lock()
+
+
+class BackupResult(NamedTuple):
+    path: str
+    size: int           # siqilgan fayl hajmi, bayt
+    db_size: int        # siqilmagan nusxa hajmi, bayt
+    duration: float     # soniya
+    pages: int
+    restarts: int       # yozuvlar tufayli qadamli nusxa qayta boshlangan
+    removed: int        # retention bo'yicha o'chirilgan eski zaxiralar
+
+
+def _copy_database(src: sqlite3.Connection, dst: sqlite3.Connection, step_pages: int, max_restarts: int) -> Tuple[int, int]:
+    """
+    Qadamma-qadam ko'chiradi; yozuvlar tufayli nusxa ``max_restarts`` martadan
+    ko'p qayta boshlansa, WAL snapshot'idan bitta qadamda oladi (yozuvchilar
+    to'xtamaydi). (sahifalar, qayta boshlanishlar) qaytaradi.
+    """
+    pages = restarts = 0
+    last_remaining = None
+
+    def progress(status, remaining, total):
+        nonlocal pages, restarts, last_remaining
+        pages = total
+        if last_remaining is not None and remaining > last_remaining:
+            restarts += 1
+            if restarts > max_restarts:
+                raise _BackupRestarts()
+        last_remaining = remaining
+
+    try:
+        src.backup(dst, pages=step_pages, progress=progress)
+    except _BackupRestarts:
+        log.warning("backup restarted %s times under writes, copying in one step", restarts)
+        src.backup(dst, pages=-1, progress=progress)
+    return pages, restarts
+
+
+def _backup_to(path: str, step_pages: int, max_restarts: int) -> Tuple[int, int, int]:
+    """
+    Bazani sqlite3 backup API orqali ``path`` ga ko'chiradi (WAL'dagi commit
+    qilingan sahifalar ham kiradi), nusxani integrity_check bilan tekshiradi
+    va gzip'laydi. (sahifalar, qayta boshlanishlar, siqilmagan hajm) qaytaradi.
+    """
+    raw_path = path[:-len(".gz")] + ".tmp"
 
     try:
-        shutil.copy(DB_NAME, backup_path)
-        return backup_path
-    except Exception as e:
-        return f"Backup xatosi: {e}"
+        src = sqlite3.connect(DB_NAME, timeout=DB_TIMEOUT)
+        dst = sqlite3.connect(raw_path)
+        try:
+            pages, restarts = _copy_database(src, dst, step_pages, max_restarts)
+            # Nusxa bitta mustaqil fayl bo'lishi uchun WAL rejimidan chiqariladi
+            dst.execute("PRAGMA journal_mode=DELETE")
+            check = dst.execute("PRAGMA integrity_check").fetchone()[0]
+        finally:
+            dst.close()
+            src.close()
+        if check != "ok":
+            raise sqlite3.DatabaseError(f"integrity_check: {check}")
+
+        db_size = os.path.getsize(raw_path)
+        with open(raw_path, "rb") as f_in, gzip.open(path + ".part", "wb", compresslevel=6) as f_out:
+            shutil.copyfileobj(f_in, f_out, 1024 * 1024)
+        os.replace(path + ".part", path)
+        return pages, restarts, db_size
+    finally:
+        for leftover in (raw_path, path + ".part"):
+            if os.path.exists(leftover):
+                os.remove(leftover)
+
+
+def _prune_backups(backups_dir: str, keep: int) -> int:
+    # Faqat shu funksiya yaratgan .db.gz fayllar — qo'lda olingan .db nusxalarga tegilmaydi
+    names = sorted(n for n in os.listdir(backups_dir) if n.startswith("backup_") and n.endswith(".db.gz"))
+    stale = names[:-keep] if keep > 0 else []
+    for name in stale:
+        os.remove(os.path.join(backups_dir, name))
+    return len(stale)
+
+
+async def backup_database(
+    backups_dir: str = BACKUP_DIR, keep: int = BACKUP_KEEP, step_pages: int = BACKUP_STEP_PAGES,
+    max_restarts: int = BACKUP_MAX_RESTARTS,
+) -> BackupResult:
+    """
+    Onlayn zaxira: ko'chirish, tekshirish va siqish alohida thread'da,
+    event loop bloklanmaydi. Xatoda istisno ko'tariladi.
+    """
+    async with _BACKUP_LOCK:
+        os.makedirs(backups_dir, exist_ok=True)
+        timestamp = datetime.now().strftime("%Y%m%d_%H%M%S")
+        path = os.path.join(backups_dir, f"backup_{timestamp}.db.gz")
+        suffix = 1
+        while os.path.exists(path):
+            path = os.path.join(backups_dir, f"backup_{timestamp}_{suffix}.db.gz")
+            suffix += 1
+
+        started = time.perf_counter()
+        pages, restarts, db_size = await asyncio.to_thread(_backup_to, path, step_pages, max_restarts)
+        duration = time.perf_counter() - started
+        removed = await asyncio.to_thread(_prune_backups, backups_dir, keep)
+        size = os.path.getsize(path)
+        log.info("backup %s: %s pages (%s restarts), %s -> %s bytes in %.2fs",
+                 path, pages, restarts, db_size, size, duration)
+        return BackupResult(path, size, db_size, duration, pages, restarts, removed)
+
+
+async def backup_loop(interval: int = BACKUP_INTERVAL):
+    while True:
+        await asyncio.sleep(interval)
+        try:
+            await backup_database()
+        except Exception as e:
+            log.warning("scheduled backup failed: %s", e)
+
+
+# ---------------- CLI ----------------
+async def _table_counts() -> List[Tuple[str, int]]:
+    async with db_connection() as db:
+        cur = await db.execute("SELECT name FROM sqlite_master WHERE type='table' ORDER BY name")
+        tables = [r[0] for r in await cur.fetchall()]
+        counts = []
+        for table in tables:
+            cur = await db.execute(f"SELECT COUNT(*) FROM {table}")
+            counts.append((table, int((await cur.fetchone())[0])))
+        return counts
+
+
+async def _cli(argv: List[str]):
+    command = argv[0] if argv else "migrate"
+    if command == "migrate":
+        async with db_connection() as db:
+            for sql in CREATE_SQL:
+                await db.execute(sql)
+            await db.commit()
+        report = await run_migrations()
+        if not report:
+            print(f"✅ Baza allaqachon so'nggi versiyada (v{SCHEMA_VERSION}).")
+        for version, name, elapsed in report:
+            print(f"✅ v{version} {name}: {elapsed * 1000:.1f} ms")
+    elif command == "check":
+        print(f"📊 Sxema versiyasi: v{await get_schema_version()} (kod: v{SCHEMA_VERSION})")
+        for table, count in await _table_counts():
+            print(f"   • {table}: {count} ta yozuv")
+    elif command == "reconcile":
+        fix = "--fix" in argv[1:]
+        mismatches = await reconcile_verified_refs(fix=fix)
+        for user_id, stored, actual in mismatches:
+            print(f"⚠️ {user_id}: verified_refs={stored}, referrals={actual}")
+        if not mismatches:
+            print("✅ verified_refs hisoblagichlari referrals bilan mos.")
+        elif fix:
+            print(f"🔧 {len(mismatches)} ta foydalanuvchi tuzatildi.")
+        else:
+            print(f"ℹ️ {len(mismatches)} ta nomuvofiqlik. Tuzatish uchun: python database.py reconcile --fix")
+        drift = await reconcile_balances()
+        for user_id, stored, ledger in drift:
+            print(f"⚠️ {user_id}: almaz={stored}, jurnal={ledger}")
+        if not drift:
+            print("✅ Balanslar jurnal bilan mos.")
+    elif command == "backup":
+        result = await backup_database()
+        print(f"💾 {result.path}: {result.size / 1024:.1f} KB ({result.db_size / 1024:.1f} KB), {result.duration:.2f} s")
+    elif command == "snapshot":
+        print(f"📸 {await take_balance_snapshots()} ta foydalanuvchi uchun snapshot yozildi.")
+    else:
+        print("Foydalanish: python database.py [migrate|check|reconcile [--fix]|snapshot|backup]")
+    await close_db()
+
+
+if __name__ == "__main__":
+    import sys
+    asyncio.run(_cli(sys.argv[1:]))
@@ -0,0 +1,191 @@
+# fsm_storage.py - SQLite'da saqlanadigan FSM holatlari (xotiradagi nusxa bilan)
+import asyncio
+import json
+import logging
+import os
+import time
+from typing import Any, Dict, Optional
+
+from aiogram.fsm.state import State
+from aiogram.fsm.storage.base import BaseStorage, StateType, StorageKey
+
+from database import db_connection, run_write
+
+log = logging.getLogger("fsm")
+
+# O'zgarishlar shu oraliqda bitta tranzaksiyada yoziladi
+FSM_FLUSH_INTERVAL = float(os.getenv("FSM_FLUSH_INTERVAL", "2"))
+# Shuncha vaqt tegilmagan holat eskirgan hisoblanadi (standart — 7 kun)
+FSM_STATE_TTL = int(os.getenv("FSM_STATE_TTL", str(7 * 24 * 3600)))
+# Xotirada shuncha vaqt ishlatilmagan (saqlangan) yozuvlar chiqarib yuboriladi
+FSM_HOT_IDLE = int(os.getenv("FSM_HOT_IDLE", "1800"))
+FSM_PURGE_INTERVAL = 3600
+
+
+class _Record:
+    __slots__ = ("user_id", "state", "data", "updated_at", "touched")
+
+    def __init__(self, user_id: int, state: Optional[str] = None, data: Optional[dict] = None, updated_at: int = 0):
+        self.user_id = user_id
+        self.state = state
+        self.data = data or {}
+        self.updated_at = updated_at
+        self.touched = time.monotonic()
+
+    @property
+    def empty(self) -> bool:
+        return self.state is None and not self.data
+
+
+def _storage_key(key: StorageKey) -> str:
+    return f"{key.bot_id}:{key.chat_id}:{key.user_id}:{key.thread_id or ''}:{key.destiny}"
+
+
+def _apply_flush(conn, upserts: list, deletes: list, purge_before: Optional[int]):
+    if upserts:
+        conn.executemany("""
+            INSERT INTO fsm_states(key, user_id, state, data, updated_at) VALUES(?, ?, ?, ?, ?)
+            ON CONFLICT(key) DO UPDATE SET
+                state=excluded.state, data=excluded.data, updated_at=excluded.updated_at
+        """, upserts)
+    if deletes:
+        conn.executemany("DELETE FROM fsm_states WHERE key=?", deletes)
+    if purge_before is not None:
+        conn.execute("DELETE FROM fsm_states WHERE updated_at < ?", (purge_before,))
+
+
+class SQLiteStorage(BaseStorage):
+    """
+    FSM holatlari ``fsm_states`` jadvalida saqlanadi, o'qish va yozish esa
+    xotiradagi nusxada bajariladi. O'zgargan kalitlar yig'ilib, har
+    ``flush_interval`` soniyada bitta tranzaksiyada yoziladi — bir kalitga
+    ketma-ket bir nechta update_data bitta qatorga aylanadi.
+    """
+
+    def __init__(self, flush_interval: float = FSM_FLUSH_INTERVAL, ttl: int = FSM_STATE_TTL):
+        self.flush_interval = flush_interval
+        self.ttl = ttl
+        self._hot: dict[str, _Record] = {}
+        self._dirty: set[str] = set()
+        self._task: asyncio.Task | None = None
+        self._wake = asyncio.Event()
+        self._flush_lock = asyncio.Lock()
+        self._last_purge = 0.0
+        self.loads = 0
+        self.flushes = 0
+        self.written = 0
+
+    async def _record(self, key: StorageKey) -> _Record:
+        k = _storage_key(key)
+        rec = self._hot.get(k)
+        if rec is None:
+            self.loads += 1
+            async with db_connection() as db:
+                cur = await db.execute("SELECT state, data, updated_at FROM fsm_states WHERE key=?", (k,))
+                row = await cur.fetchone()
+            loaded = _Record(key.user_id)
+            if row:
+                loaded = _Record(key.user_id, row[0], json.loads(row[1]) if row[1] else {}, row[2])
+            # Kutish paytida yozilgan bo'lsa, xotiradagi yangiroq nusxa qoladi
+            rec = self._hot.setdefault(k, loaded)
+        rec.touched = time.monotonic()
+        if not rec.empty and rec.updated_at and time.time() - rec.updated_at > self.ttl:
+            rec.state, rec.data = None, {}
+            self._mark(k, rec)
+        return rec
+
+    def _mark(self, k: str, rec: _Record):
+        rec.updated_at = int(time.time())
+        self._dirty.add(k)
+        if self._task is None:
+            self._task = asyncio.get_running_loop().create_task(self._run())
+
+    async def set_state(self, key: StorageKey, state: StateType = None) -> None:
+        rec = await self._record(key)
+        rec.state = state.state if isinstance(state, State) else state
+        self._mark(_storage_key(key), rec)
+
+    async def get_state(self, key: StorageKey) -> Optional[str]:
+        return (await self._record(key)).state
+
+    async def set_data(self, key: StorageKey, data: Dict[str, Any]) -> None:
+        rec = await self._record(key)
+        rec.data = dict(data)
+        self._mark(_storage_key(key), rec)
+
+    async def get_data(self, key: StorageKey) -> Dict[str, Any]:
+        return dict((await self._record(key)).data)
+
+    async def update_data(self, key: StorageKey, data: Dict[str, Any]) -> Dict[str, Any]:
+        rec = await self._record(key)
+        rec.data.update(data)
+        self._mark(_storage_key(key), rec)
+        return dict(rec.data)
+
+    async def _run(self):
+        try:
+            while self._dirty:
+                try:
+                    await asyncio.wait_for(self._wake.wait(), timeout=self.flush_interval)
+                except asyncio.TimeoutError:
+                    pass
+                if not await self.flush() and self._wake.is_set():
+                    break
+        finally:
+            self._task = None
+
+    async def flush(self) -> int:
+        async with self._flush_lock:
+            keys = list(self._dirty)
+            self._dirty.clear()
+            upserts, deletes = [], []
+            for k in keys:
+                rec = self._hot.get(k)
+                if rec is None or rec.empty:
+                    deletes.append((k,))
+                else:
+                    data = json.dumps(rec.data, ensure_ascii=False, default=str) if rec.data else None
+                    upserts.append((k, rec.user_id, rec.state, data, rec.updated_at))
+
+            purge_before = None
+            now = time.monotonic()
+            if now - self._last_purge >= FSM_PURGE_INTERVAL:
+                purge_before = int(time.time()) - self.ttl
+            if not keys and purge_before is None:
+                return 0
+            try:
+                await run_write(_apply_flush, upserts, deletes, purge_before)
+            except Exception as e:
+                # Keyingi safar qayta urinamiz — xotiradagi holat yo'qolmaydi
+                log.warning("fsm flush of %s keys failed: %s", len(keys), e)
+                self._dirty.update(keys)
+                return 0
+            self.flushes += 1
+            self.written += len(keys)
+            if purge_before is not None:
+                self._last_purge = now
+                self._evict_idle(now)
+            return len(keys)
+
+    def _evict_idle(self, now: float):
+        idle = [k for k, rec in self._hot.items() if k not in self._dirty and now - rec.touched > FSM_HOT_IDLE]
+        for k in idle:
+            del self._hot[k]
+
+    def stats(self) -> dict:
+        return {
+            "hot": len(self._hot),
+            "dirty": len(self._dirty),
+            "loads": self.loads,
+            "flushes": self.flushes,
+            "rows": self.written,
+        }
+
+    async def close(self) -> None:
+        self._wake.set()
+        task = self._task
+        if task is not None:
+            await task
+        while self._dirty:
+            if not await self.flush():
+                break
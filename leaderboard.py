@@ -0,0 +1,194 @@
+# leaderboard.py - Xotiradagi reyting (order-statistic skip list)
+import random
+from typing import Iterable, List, Optional, Tuple
+
+_MAX_LEVEL = 24
+
+
+class _Node:
+    __slots__ = ("key", "next", "width")
+
+    def __init__(self, key, level: int):
+        self.key = key
+        self.next: List[Optional["_Node"]] = [None] * level
+        # width[i] — next[i] ga o'tganda nechta pozitsiya oldinga siljiymiz
+        self.width: List[int] = [1] * level
+
+
+class IndexableSkipList:
+    """
+    Kalitlari tartiblangan skip list. Qo'shish, o'chirish va
+    "kalitdan kichik elementlar soni" so'rovi O(log n) da bajariladi.
+    """
+
+    def __init__(self, sorted_keys: Iterable = ()):
+        self._head = _Node(None, _MAX_LEVEL)
+        self._size = 0
+        self._bulk_load(sorted_keys)
+
+    def __len__(self) -> int:
+        return self._size
+
+    @staticmethod
+    def _random_level() -> int:
+        level = 1
+        while level < _MAX_LEVEL and random.getrandbits(1):
+            level += 1
+        return level
+
+    def _bulk_load(self, sorted_keys: Iterable):
+        # Tartiblangan kalitlardan O(n) da qurish (startup uchun)
+        last = [self._head] * _MAX_LEVEL
+        last_pos = [0] * _MAX_LEVEL
+        pos = 0
+        for key in sorted_keys:
+            pos += 1
+            node = _Node(key, self._random_level())
+            for i in range(len(node.next)):
+                last[i].next[i] = node
+                last[i].width[i] = pos - last_pos[i]
+                last[i] = node
+                last_pos[i] = pos
+        self._size = pos
+        for i in range(_MAX_LEVEL):
+            last[i].width[i] = pos + 1 - last_pos[i]
+
+    def _path(self, key):
+        update = [self._head] * _MAX_LEVEL
+        ranks = [0] * _MAX_LEVEL
+        node, pos = self._head, 0
+        for i in reversed(range(_MAX_LEVEL)):
+            nxt = node.next[i]
+            while nxt is not None and nxt.key < key:
+                pos += node.width[i]
+                node = nxt
+                nxt = node.next[i]
+            update[i] = node
+            ranks[i] = pos
+        return update, ranks, pos
+
+    def insert(self, key):
+        update, ranks, pos = self._path(key)
+        node = _Node(key, self._random_level())
+        level = len(node.next)
+        for i in range(_MAX_LEVEL):
+            prev = update[i]
+            if i < level:
+                node.next[i] = prev.next[i]
+                prev.next[i] = node
+                node.width[i] = prev.width[i] - (pos - ranks[i])
+                prev.width[i] = pos - ranks[i] + 1
+            else:
+                prev.width[i] += 1
+        self._size += 1
+
+    def remove(self, key):
+        update, _, _ = self._path(key)
+        target = update[0].next[0]
+        if target is None or target.key != key:
+            raise KeyError(key)
+        for i in range(_MAX_LEVEL):
+            prev = update[i]
+            if prev.next[i] is target:
+                prev.width[i] += target.width[i] - 1
+                prev.next[i] = target.next[i]
+            else:
+                prev.width[i] -= 1
+        self._size -= 1
+
+    def count_less(self, key) -> int:
+        node, pos = self._head, 0
+        for i in reversed(range(_MAX_LEVEL)):
+            nxt = node.next[i]
+            while nxt is not None and nxt.key < key:
+                pos += node.width[i]
+                node = nxt
+                nxt = node.next[i]
+        return pos
+
+    def head(self, limit: int) -> List:
+        out = []
+        node = self._head.next[0]
+        while node is not None and len(out) < limit:
+            out.append(node.key)
+            node = node.next[0]
+        return out
+
+
+class Leaderboard:
+    """
+    Balanslar bo'yicha reyting. Tartib ``ORDER BY almaz DESC, user_id ASC``
+    bilan bir xil: kalit — (-almaz, user_id).
+    """
+
+    def __init__(self):
+        self.loaded = False
+        self._list = IndexableSkipList()
+        self._balances: dict[int, int] = {}
+        self._names: dict[int, Optional[str]] = {}
+        # Har bir o'zgarish versiyani oshiradi; user_id -> oxirgi o'zgarish versiyasi
+        self.version = 0
+        self._touched: dict[int, int] = {}
+
+    def _touch(self, user_id: int):
+        self.version += 1
+        self._touched[user_id] = self.version
+
+    def changed_since(self, version: int) -> set:
+        """``version`` dan keyin o'zgargan foydalanuvchilar."""
+        if version == self.version:
+            return set()
+        return {user_id for user_id, v in self._touched.items() if v > version}
+
+    def load(self, rows: Iterable[Tuple[int, Optional[str], int]]):
+        balances: dict[int, int] = {}
+        names: dict[int, Optional[str]] = {}
+        for user_id, username, almaz in rows:
+            balances[user_id] = int(almaz or 0)
+            names[user_id] = username
+        keys = sorted((-almaz, user_id) for user_id, almaz in balances.items())
+        self._list = IndexableSkipList(keys)
+        self._balances = balances
+        self._names = names
+        self._touched = {}
+        self.version += 1
+        self.loaded = True
+
+    def __len__(self) -> int:
+        return len(self._balances)
+
+    def balances(self) -> dict[int, int]:
+        return self._balances
+
+    def add_user(self, user_id: int, username: Optional[str] = None):
+        if user_id not in self._balances:
+            self._balances[user_id] = 0
+            self._list.insert((0, user_id))
+            self._touch(user_id)
+        if username:
+            self._names[user_id] = username
+
+    def set_balance(self, user_id: int, almaz: int):
+        almaz = int(almaz or 0)
+        old = self._balances.get(user_id)
+        if old == almaz:
+            return
+        if old is not None:
+            self._list.remove((-old, user_id))
+        self._list.insert((-almaz, user_id))
+        self._balances[user_id] = almaz
+        self._touch(user_id)
+
+    def rank(self, user_id: int) -> Tuple[int, int]:
+        total = len(self._balances)
+        if total == 0:
+            return 0, 0
+        almaz = self._balances.get(user_id)
+        if almaz is None:
+            return 1, total
+        # (-almaz,) barcha (-almaz, user_id) kalitlaridan kichik —
+        # ya'ni faqat balansi qat'iy kattalar sanaladi
+        return self._list.count_less((-almaz,)) + 1, total
+
+    def top(self, limit: int) -> List[Tuple[Optional[str], int]]:
+        return [(self._names.get(user_id), -neg) for neg, user_id in self._list.head(limit)]
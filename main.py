@@ -3,38 +3,46 @@ import asyncio
 import os
 import time
 import logging
-from typing import Optional
+from typing import NamedTuple, Optional
 
-from aiogram import Bot, Dispatcher, F
+from aiogram import BaseMiddleware, Bot, Dispatcher, F
 from aiogram.enums import ContentType
 from aiogram.filters import Command, StateFilter
 from aiogram.fsm.context import FSMContext
 from aiogram.fsm.state import StatesGroup, State
 from aiogram.types import (
-    Message, CallbackQuery, InlineKeyboardButton, InlineKeyboardMarkup,
+    Message, CallbackQuery, ChatMemberUpdated, InlineKeyboardButton, InlineKeyboardMarkup,
     ReplyKeyboardMarkup, KeyboardButton, ReplyKeyboardRemove, BotCommand
 )
 from dotenv import load_dotenv
 
+from broadcast import BroadcastManager, SEGMENT_LABELS, segment_keyboard, segment_title, unreachable_reason
+from cache import VersionedCache
+from fsm_storage import SQLiteStorage
+from text_router import TextDispatchTable
+from user_session import UserSession
 from config import OWNER_ID, OWNER2_ID, REQUIRED_CHANNELS_DEFAULT
 from database import (
-    init_db, add_user, get_user, add_almaz, get_leaderboard,
-    get_ref_by, set_ref_by_if_empty, is_verified, set_verified, set_phone_verified,
-    list_admins, add_admin, remove_admin, is_admin,
+    init_db, close_db, get_user, get_leaderboard, set_ref_by_if_empty,
+    list_admins, add_admin, remove_admin, is_admin, notify_recipients,
     get_dynamic_text, update_dynamic_text,
     list_required_channels, add_required_channel, remove_required_channel, required_channels_count,
-    set_suspension, get_suspension_remaining,
-    create_referral, mark_referral_verified, count_verified_referrals, count_all_referrals,
+    set_suspension, get_suspension_remaining, suspension_expiry_loop,
+    settle_verification, count_verified_referrals, count_all_referrals,
     get_top_referrers_today,
-    create_withdraw_request, get_withdraw_request, update_withdraw_status,
+    create_withdraw_request, get_withdraw_request, transition_withdraw,
+    WithdrawCard, get_withdraw_card,
     get_withdraw_stats,
     add_withdraw_notification, get_withdraw_notifications,
-    backup_database,
-    get_setting, set_setting, delete_setting,
-    list_offers, get_offer, create_withdraw_and_deduct,
+    backup_database, backup_loop, BACKUP_INTERVAL,
+    get_setting, get_setting_int, set_setting, delete_setting,
+    list_offers, get_offer, offers_version, create_withdraw_and_deduct,
     create_purchase, update_purchase_status, list_pending_purchases,
     create_offer, update_offer, delete_offer, get_user_rank,
-    adjust_balance, log_admin_action,
+    log_admin_action, leaderboard_check_loop, balance_snapshot_loop, writer_stats, write_behind_stats,
+    mark_unreachable, filter_reachable, get_unreachable_stats, count_segment, touch_last_seen,
+    get_subscription_state, record_channel_member, list_tracked_channels, set_channel_tracking,
+    required_channels_version, UserRow,
 )
 
 PROOF_CHANNEL_SETTING_KEY = "proof_channel_id"
@@ -51,7 +59,10 @@ if not BOT_TOKEN:
     raise RuntimeError("BOT_TOKEN .env dan topilmadi")
 
 bot = Bot(BOT_TOKEN)
-dp = Dispatcher()
+# FSM holatlari qayta ishga tushirishdan keyin ham saqlanadi
+fsm_storage = SQLiteStorage()
+dp = Dispatcher(storage=fsm_storage)
+broadcasts = BroadcastManager(bot)
 
 
 def normalize_proof_channel_value(raw: str) -> str | None:
@@ -150,6 +161,8 @@ class TextEdit(StatesGroup):
 
 
 class Broadcast(StatesGroup):
+    SEGMENT = State()
+    SEGMENT_ARG = State()
     WAITING = State()
 
 
@@ -268,12 +281,33 @@ def is_owner(user_id: int) -> bool:
     return user_id == OWNER_ID or user_id == OWNER2_ID
 
 
+async def admin_recipients() -> list[int]:
+    # Egalar + adminlar (oldindan tayyorlangan); botni bloklaganlar o'tkazib yuboriladi
+    return await filter_reachable(list(notify_recipients()))
+
+
+async def note_delivery_failure(chat_id: int, error: Exception):
+    reason = unreachable_reason(error)
+    if reason:
+        await mark_unreachable(chat_id, reason)
+
+
+# Tanaffus tugaganda foydalanuvchiga xabar berish (0 — o'chirilgan)
+SUSPENSION_NOTIFY = os.getenv("SUSPENSION_NOTIFY", "1") != "0"
+
+
+async def notify_suspension_over(user_ids: list[int]):
+    if not SUSPENSION_NOTIFY:
+        return
+    for uid in user_ids:
+        try:
+            await bot.send_message(uid, "✅ Tanaffus tugadi! Botdan yana foydalanishingiz mumkin.", reply_markup=main_menu)
+        except Exception as e:
+            await note_delivery_failure(uid, e)
+
+
 async def get_referral_reward() -> int:
-    v = await get_setting("referral_reward")
-    try:
-        return int(v)
-    except:
-        return 1
+    return await get_setting_int("referral_reward", 1)
 
 
 # =================== MENUS ===================
@@ -336,49 +370,191 @@ async def _get_required_channels():
     return current
 
 
-async def check_subscription(user_id: int) -> list[str]:
-    not_sub = []
-    channels = await _get_required_channels()
+SUBSCRIBED_STATUSES = ("member", "administrator", "creator")
+# Kuzatilayotgan kanalda ham lokal yozuv shu muddatdan keyin qayta tekshiriladi
+# (bot o'chiq turgan paytda yangilanishlar yo'qolgan bo'lishi mumkin)
+CHANNEL_MEMBER_MAX_AGE = int(os.getenv("CHANNEL_MEMBER_MAX_AGE", str(7 * 86400)))
+
+# get_chat_member natijalari: (user_id, kanal) -> status.
+# Obuna bo'lganlar uzoqroq, obuna bo'lmaganlar qisqa muddat saqlanadi.
+SUB_CACHE_TTL = float(os.getenv("SUB_CACHE_TTL", "300"))
+SUB_CACHE_NEGATIVE_TTL = float(os.getenv("SUB_CACHE_NEGATIVE_TTL", "15"))
+SUB_CACHE_SIZE = int(os.getenv("SUB_CACHE_SIZE", "50000"))
+subscription_cache = VersionedCache(SUB_CACHE_SIZE, required_channels_version)
+
+
+def _chat_ref(channel: str) -> str | int:
+    ref = channel.strip()
+    bare = ref.lstrip("@")
+    if bare.lstrip("-").isdigit():
+        return int(bare)
+    return ref
+
+
+def _channel_key_for_chat(chat, channels: list[str]) -> Optional[str]:
+    candidates = {f"@{chat.id}".lower(), str(chat.id)}
+    if chat.username:
+        candidates.add(f"@{chat.username}".lower())
     for ch in channels:
-        chat_ref: Optional[str | int] = ch.strip()
+        if ch.lower() in candidates:
+            return ch
+    return None
+
+
+async def fetch_member_status(channel: str, user_id: int) -> Optional[str]:
+    try:
+        member = await bot.get_chat_member(_chat_ref(channel), user_id)
+        return member.status
+    except Exception as e:
+        log.warning("get_chat_member %s/%s failed: %s", channel, user_id, e)
+        return None
+
+
+async def check_subscription(user_id: int, fresh: bool = False) -> list[str]:
+    """
+    Obuna bo'lmagan kanallar ro'yxati. Kuzatilayotgan kanallar uchun javob
+    lokal jadvaldan olinadi; noma'lum juftliklar Bot API orqali parallel
+    tekshiriladi va natija saqlanadi. ``fresh`` — "obuna emas" degan lokal
+    javoblarni ham qayta tekshirish ("✅ Tekshirish" tugmasi uchun).
+    """
+    state = await get_subscription_state(user_id)
+    if not state:
+        await _get_required_channels()
+        state = await get_subscription_state(user_id)
+
+    subscription_cache.sync()
+    now = int(time.time())
+    not_sub: set[str] = set()
+    unknown: list[str] = []
+    for channel, tracked, status, updated_at in state:
+        known = tracked and status is not None and now - (updated_at or 0) < CHANNEL_MEMBER_MAX_AGE
+        if not known:
+            status = subscription_cache.get((user_id, channel))
+            known = status is not None
+        if known and (status in SUBSCRIBED_STATUSES or not fresh):
+            if status not in SUBSCRIBED_STATUSES:
+                not_sub.add(channel)
+        else:
+            unknown.append(channel)
+
+    statuses = await asyncio.gather(*(fetch_member_status(ch, user_id) for ch in unknown))
+    for channel, status in zip(unknown, statuses):
+        if status is None:
+            not_sub.add(channel)
+            continue
+        subscribed = status in SUBSCRIBED_STATUSES
+        subscription_cache.set(
+            (user_id, channel), status, SUB_CACHE_TTL if subscribed else SUB_CACHE_NEGATIVE_TTL
+        )
+        await record_channel_member(channel, user_id, status)
+        if not subscribed:
+            not_sub.add(channel)
+    return [channel for channel, *_ in state if channel in not_sub]
+
+
+async def sync_channel_tracking(channels: Optional[list[str]] = None):
+    # Bot admin bo'lgan kanallardan chat_member yangilanishlari keladi
+    channels = channels if channels is not None else await _get_required_channels()
+    for channel in channels:
         try:
-            if chat_ref.startswith("@"):
-                chat_ref = chat_ref
-            else:
-                try:
-                    chat_ref = int(chat_ref)
-                except ValueError:
-                    chat_ref = chat_ref
-            member = await bot.get_chat_member(chat_ref, user_id)
-            if member.status not in ("member", "administrator", "creator"):
-                not_sub.append(ch)
-        except Exception:
-            not_sub.append(ch)
-    return not_sub
-
-
-async def guard_common(message: Message) -> bool:
-    if message.chat.type != "private":
-        return False
+            me = await bot.get_chat_member(_chat_ref(channel), bot.id)
+            tracking = me.status in ("administrator", "creator")
+        except Exception as e:
+            log.warning("channel %s tracking check failed: %s", channel, e)
+            tracking = False
+        await set_channel_tracking(channel, None, tracking)
+        if not tracking:
+            log.warning("bot is not an admin in %s — subscription checks fall back to get_chat_member", channel)
+
+
+# ---------------- Guard middleware ----------------
+class UserContext(NamedTuple):
+    user_id: int
+    user: Optional[UserRow]    # users jadvalidagi qator (yo'q bo'lsa None)
+    is_admin: bool
+    suspended: int             # tanaffus tugashigacha qolgan soniya
+    not_sub: list[str]         # obuna bo'linmagan kanallar
+
+
+# Obuna/tanaffus tekshiruvisiz o'tadigan buyruq va callback'lar
+GUARD_EXEMPT_COMMANDS = {"/start", "/help"}
+GUARD_EXEMPT_CALLBACKS = {"check_subs"}
+
+
+def _command_token(text: Optional[str]) -> Optional[str]:
+    # "/start ref_5" va "/start@bot" -> "/start"; "/startx" o'zgarmaydi
+    parts = (text or "").split(maxsplit=1)
+    return parts[0].split("@", 1)[0] if parts else None
 
-    remain = await get_suspension_remaining(message.from_user.id)
+
+async def resolve_user_context(users: UserSession, user_id: int, enforce: bool = True) -> UserContext:
+    admin = await is_owner_or_admin(user_id)
+    user = await users.get(user_id)
+    if admin or not enforce:
+        return UserContext(user_id, user, admin, 0, [])
+    touch_last_seen(user_id)
+    remain = await get_suspension_remaining(user_id)
     if remain > 0:
-        await message.answer(
+        return UserContext(user_id, user, admin, remain, [])
+    return UserContext(user_id, user, admin, 0, await check_subscription(user_id))
+
+
+class GuardMiddleware(BaseMiddleware):
+    """
+    Har bir yangilanish uchun bir marta: foydalanuvchi qatori, admin
+    belgisi, tanaffus va obuna holati. Natija handlerlarga ``user_ctx``,
+    yangilanish doirasidagi qatorlar kesh ``users`` sifatida beriladi;
+    bloklangan yangilanish filtrlarga yetib bormaydi.
+    """
+
+    async def __call__(self, handler, event, data):
+        user = data.get("event_from_user")
+        if user is None:
+            return await handler(event, data)
+
+        if isinstance(event, CallbackQuery):
+            chat = event.message.chat if event.message else None
+            exempt = event.data in GUARD_EXEMPT_CALLBACKS
+        else:
+            chat = event.chat
+            exempt = _command_token(event.text) in GUARD_EXEMPT_COMMANDS
+        enforce = not exempt and chat is not None and chat.type == "private"
+
+        users = data["users"] = UserSession()
+        ctx = await resolve_user_context(users, user.id, enforce)
+        data["user_ctx"] = ctx
+        if ctx.suspended > 0:
+            return await self._reject_suspended(event, ctx.suspended)
+        if ctx.not_sub:
+            return await self._reject_not_subscribed(event, ctx.not_sub)
+        return await handler(event, data)
+
+    @staticmethod
+    async def _reject_suspended(event, remain: int):
+        text = (
             "😴 Siz hozircha tanaffusdasiz.\n"
-            f"⏰ {remain} soniyadan so'ng bot qayta faollashadi.",
-            parse_mode="HTML"
+            f"⏰ {remain} soniyadan so'ng bot qayta faollashadi."
         )
-        return True
+        if isinstance(event, CallbackQuery):
+            return await event.answer(text, show_alert=True)
+        return await event.answer(text, parse_mode="HTML")
 
-    not_sub = await check_subscription(message.from_user.id)
-    if not_sub:
-        await message.answer(
+    @staticmethod
+    async def _reject_not_subscribed(event, not_sub: list[str]):
+        text = (
             "🔒 <b>Obuna talab qilinadi</b>\n\n"
-            "Quyidagi kanallarimizga a'zo bo'ling, so'ng <b>✅ Tekshirish</b> tugmasini bosing.",
-            parse_mode="HTML", reply_markup=sub_required_markup(not_sub)
+            "Quyidagi kanallarimizga a'zo bo'ling, so'ng <b>✅ Tekshirish</b> tugmasini bosing."
         )
-        return True
-    return False
+        if isinstance(event, CallbackQuery):
+            await event.answer()
+            if event.message is None:
+                return
+            event = event.message
+        return await event.answer(text, parse_mode="HTML", reply_markup=sub_required_markup(not_sub))
+
+
+dp.message.outer_middleware(GuardMiddleware())
+dp.callback_query.outer_middleware(GuardMiddleware())
 
 
 async def set_menu_state(state: FSMContext | None, current: str, prev: str | None):
@@ -412,25 +588,21 @@ async def go_back_menu(message: Message, state: FSMContext):
     return await render_menu(prev, message, state)
 
 
-async def open_withdraw_menu(message: Message, state: FSMContext, prev_menu: str):
+async def open_withdraw_menu(message: Message, state: FSMContext, prev_menu: str,
+                             users: Optional[UserSession] = None):
+    users = users or UserSession()
     user_id = message.from_user.id
-    user = await get_user(user_id)
+    user = await users.get(user_id)
     if not user:
         return await message.answer("Avval ro'yxatdan o'ting.")
-    balance = user[3] if len(user) > 3 and user[3] is not None else 0
+    balance = user.almaz or 0
 
     await state.set_state(WithdrawStates.CHOOSE_GAME)
     await state.update_data(withdraw_prev_menu=prev_menu)
     await set_menu_state(state, "withdraw", prev_menu)
 
-    try:
-        ff_offers = await list_offers("ff")
-    except Exception:
-        ff_offers = []
-    try:
-        pubg_offers = await list_offers("pubg")
-    except Exception:
-        pubg_offers = []
+    ff_offers = await list_offers("ff")
+    pubg_offers = await list_offers("pubg")
     if balance <= 0:
         kb = InlineKeyboardMarkup(
             inline_keyboard=[[InlineKeyboardButton(text="⬅️ Orqaga", callback_data="wd_back_prev")]]
@@ -465,57 +637,137 @@ async def open_withdraw_menu(message: Message, state: FSMContext, prev_menu: str
     )
 
 
-async def send_game_offers(message: Message, state: FSMContext, game: str, prev_menu: str):
+# ---------------- Takliflar klaviaturalari ----------------
+# Takliflar o'zgarmaguncha (offers_version) tayyor klaviaturalar qayta ishlatiladi
+OFFER_VIEW_TTL = 24 * 3600
+offer_views = VersionedCache(256, offers_version)
+
+
+def _offer_view(key: tuple, build):
+    offer_views.sync()
+    view = offer_views.get(key)
+    if view is None:
+        view = build()
+        offer_views.set(key, view, OFFER_VIEW_TTL)
+    return view
+
+
+def back_only_markup(callback_data: str) -> InlineKeyboardMarkup:
+    return _offer_view(("back", callback_data), lambda: InlineKeyboardMarkup(
+        inline_keyboard=[[InlineKeyboardButton(text="⬅️ Orqaga", callback_data=callback_data)]]
+    ))
+
+
+async def offers_markup(game: str, balance: int, back_data: str) -> Optional[InlineKeyboardMarkup]:
+    # Balansga yetadigan takliflar — narx bo'yicha tartiblangan ro'yxatning boshi
+    offers = await list_offers(game, max_cost=balance)
+    if not offers:
+        return None
+
+    def build():
+        buttons = [
+            [InlineKeyboardButton(text=f"{label} — {cost} so'm", callback_data=f"wd_offer:{oid}")]
+            for oid, label, cost in offers
+        ]
+        buttons.append([InlineKeyboardButton(text="⬅️ Orqaga", callback_data=back_data)])
+        return InlineKeyboardMarkup(inline_keyboard=buttons)
+
+    return _offer_view(("offers", game, len(offers), back_data), build)
+
+
+async def send_game_offers(message: Message, state: FSMContext, game: str, prev_menu: str, balance: int):
     await state.set_state(WithdrawStates.CHOOSE_GAME)
     await state.update_data(withdraw_prev_menu=prev_menu)
     await set_menu_state(state, "withdraw", prev_menu)
-    try:
-        offers = await list_offers(game)
-    except Exception:
-        offers = []
 
-    if not offers:
-        kb = InlineKeyboardMarkup(
-            inline_keyboard=[[InlineKeyboardButton(text="⬅️ Orqaga", callback_data="wd_back_prev")]]
+    if not await list_offers(game):
+        return await message.answer("Hozircha takliflar yo'q.", reply_markup=back_only_markup("wd_back_prev"))
+    kb = await offers_markup(game, balance, "wd_back_prev")
+    if kb is None:
+        return await message.answer(
+            "⚠️ Balansingiz hozircha bironta taklifga ham yetmaydi.",
+            reply_markup=back_only_markup("wd_back_prev")
         )
-        return await message.answer("Hozircha takliflar yo'q.", reply_markup=kb)
-
-    buttons = [[InlineKeyboardButton(text=f"{label} — {cost} som", callback_data=f"wd_offer:{oid}")] for oid, label, cost in offers]
-    buttons.append([InlineKeyboardButton(text="⬅️ Orqaga", callback_data="wd_back_prev")])
-    kb = InlineKeyboardMarkup(inline_keyboard=buttons)
     await message.answer("Iltimos, yechib olmoqchi bo'lgan taklifni tanlang:", reply_markup=kb)
 
 
-async def update_withdraw_admin_messages(request_id: int, status_label: str):
-    notifications = await get_withdraw_notifications(request_id)
-    req = await get_withdraw_request(request_id)
-    if not req:
-        return
-    r_id, user_id, amount, ff_id, game, status, created_at, processed_at, processed_by, note = req
-    user = await get_user(user_id)
-    username = user[1] if user else None
-    almaz = user[3] if user and len(user) > 3 and user[3] is not None else 0
-    refs = await count_verified_referrals(user_id)
-    game_label = format_game_label(game)
-    id_label = "Free Fire ID" if (game or "ff") == "ff" else "PUBG ID"
-
-    created_str = time.strftime("%Y-%m-%d %H:%M", time.localtime(created_at or int(time.time())))
-    processed_str = time.strftime("%Y-%m-%d %H:%M", time.localtime(processed_at)) if processed_at else "—"
-    note_part = f"\n📝 Izoh: {note}" if note else ""
-
-    base_text = (
-        "🧾 <b>Pul yechish so'rovi</b>\n\n"
-        f"👤 Foydalanuvchi: @{username or 'Anonim'} (ID: <code>{user_id}</code>)\n"
-        f"💎 Joriy balans: <b>{almaz} som</b>\n"
-        f"🔥 Yechmoqchi bo'lgan miqdor: <b>{amount} som</b>\n"
-        f"👥 Umumiy tasdiqlangan takliflar: <b>{refs}</b>\n"
-        f"🎮 O'yin: <b>{game_label}</b>\n"
-        f"🎮 {id_label}: <code>{ff_id}</code>\n"
-        f"🕒 So'rov vaqti: {created_str}\n"
-        f"🕒 Qayta ishlangan: {processed_str}"
-        f"{note_part}\n\n"
-        f"{status_label}"
-    )
+class WithdrawCardView:
+    """Pul yechish so'rovi uchun admin va isbotlar kanali xabarlari."""
+
+    __slots__ = ("card", "game_label", "id_label", "mention")
+
+    def __init__(self, card: WithdrawCard):
+        self.card = card
+        self.game_label = format_game_label(card.game)
+        self.id_label = "Free Fire ID" if (card.game or "ff") == "ff" else "PUBG ID"
+        self.mention = f"@{card.username}" if card.username else f"ID: {card.user_id}"
+
+    @staticmethod
+    def _fmt_time(ts: int | None, fmt: str = "%Y-%m-%d %H:%M") -> str:
+        return time.strftime(fmt, time.localtime(ts or int(time.time())))
+
+    def admin_new(self) -> str:
+        c = self.card
+        return (
+            "🧾 <b>Yangi Pul yechish so'rovi</b>\n\n"
+            f"👤 Foydalanuvchi: @{c.username or 'Anonim'} (ID: <code>{c.user_id}</code>)\n"
+            f"💎 Joriy balans: <b>{c.almaz} so'm</b>\n"
+            f"🔥 Yechmoqchi: <b>{c.amount} so'm</b>\n"
+            f"👥 Umumiy tasdiqlangan takliflar: <b>{c.verified_refs}</b>\n"
+            f"🎮 O'yin: <b>{self.game_label}</b>\n"
+            f"🎮 {self.id_label}: <code>{c.ff_id}</code>\n"
+            f"🕒 So'rov vaqti: {self._fmt_time(c.created_at)}\n\n"
+            "Quyidagi tugmalar orqali so'rovni boshqaring 👇"
+        )
+
+    def admin_status(self, status_label: str) -> str:
+        c = self.card
+        processed_str = self._fmt_time(c.processed_at) if c.processed_at else "—"
+        note_part = f"\n📝 Izoh: {c.note}" if c.note else ""
+        return (
+            "🧾 <b>Pul yechish so'rovi</b>\n\n"
+            f"👤 Foydalanuvchi: @{c.username or 'Anonim'} (ID: <code>{c.user_id}</code>)\n"
+            f"💎 Joriy balans: <b>{c.almaz} som</b>\n"
+            f"🔥 Yechmoqchi bo'lgan miqdor: <b>{c.amount} som</b>\n"
+            f"👥 Umumiy tasdiqlangan takliflar: <b>{c.verified_refs}</b>\n"
+            f"🎮 O'yin: <b>{self.game_label}</b>\n"
+            f"🎮 {self.id_label}: <code>{c.ff_id}</code>\n"
+            f"🕒 So'rov vaqti: {self._fmt_time(c.created_at)}\n"
+            f"🕒 Qayta ishlangan: {processed_str}"
+            f"{note_part}\n\n"
+            f"{status_label}"
+        )
+
+    def proof_request(self) -> str:
+        c = self.card
+        return (
+            "🧾 <b>Yangi yechib olish so'rovi</b>\n\n"
+            f"👤 Foydalanuvchi: {self.mention} (ID: <code>{c.user_id}</code>)\n"
+            f"🎮 O'yin: <b>{self.game_label}</b>\n"
+            f"🎮 {self.id_label}: <code>{c.ff_id}</code>\n"
+            f"💎 Miqdor: <b>{c.amount} so'm</b>\n"
+            f"🕒 So'rov vaqti: {self._fmt_time(c.created_at)}\n"
+            "⏳ Holat: <b>Kutilmoqda</b>"
+        )
+
+    def proof_receipt(self) -> str:
+        c = self.card
+        ff_value = c.ff_id or "Ko'rsatilmagan"
+        return (
+            "✅ <b>Pul yechish tasdiqlandi</b>\n\n"
+            f"👤 Foydalanuvchi: {self.mention} (ID: <code>{c.user_id}</code>)\n"
+            f"🎮 O'yin: <b>{self.game_label}</b>\n"
+            f"🎮 {self.id_label}: <code>{ff_value}</code>\n"
+            f"💎 Miqdor: <b>{c.amount} so'm</b>\n"
+            f"👥 Umumiy tasdiqlangan takliflari: <b>{c.verified_refs}</b>\n"
+            f"🆔 So'rov ID: <code>{c.id}</code>\n"
+            f"🕒 Tasdiqlangan vaqt: {self._fmt_time(None, '%d.%m.%Y %H:%M:%S')}"
+        )
+
+
+async def update_withdraw_admin_messages(view: WithdrawCardView, status_label: str):
+    notifications = await get_withdraw_notifications(view.card.id)
+    base_text = view.admin_status(status_label)
 
     for chat_id, message_id in notifications:
         try:
@@ -530,101 +782,28 @@ async def update_withdraw_admin_messages(request_id: int, status_label: str):
             log.warning("withdraw msg edit failed: %s", e)
 
 
-async def send_proof_receipt(request_id: int, user_id: int, amount: int, ff_id: Optional[str], game: str | None):
+async def send_to_proof_channel(text: str):
     channel_value = await get_proof_channel_value()
     chat_id = resolve_proof_chat_id(channel_value)
     if not chat_id:
         return
-
-    user = await get_user(user_id)
-    username = user[1] if user else None
-    mention = f"@{username}" if username else f"ID: {user_id}"
-    verified_refs = await count_verified_referrals(user_id)
-    ff_value = ff_id or "Ko'rsatilmagan"
-    now = time.strftime("%d.%m.%Y %H:%M:%S", time.localtime())
-    game_label = format_game_label(game)
-    id_label = "Free Fire ID" if (game or "ff") == "ff" else "PUBG ID"
-
-    text = (
-        "✅ <b>Pul yechish tasdiqlandi</b>\n\n"
-        f"👤 Foydalanuvchi: {mention} (ID: <code>{user_id}</code>)\n"
-        f"🎮 O'yin: <b>{game_label}</b>\n"
-        f"🎮 {id_label}: <code>{ff_value}</code>\n"
-        f"💎 Miqdor: <b>{amount} so'm</b>\n"
-        f"👥 Umumiy tasdiqlangan takliflari: <b>{verified_refs}</b>\n"
-        f"🆔 So'rov ID: <code>{request_id}</code>\n"
-        f"🕒 Tasdiqlangan vaqt: {now}"
-    )
-
     try:
-        await bot.send_message(
-            chat_id=chat_id,
-            text=text,
-            parse_mode="HTML",
-            disable_web_page_preview=True
-        )
+        await bot.send_message(chat_id=chat_id, text=text, parse_mode="HTML", disable_web_page_preview=True)
     except Exception as exc:
         log.warning("Isbotlar kanaliga yuborib bo'lmadi (%s): %s", channel_value, exc)
 
 
-async def send_withdraw_request_to_proof_channel(request_id: int):
-    channel_value = await get_proof_channel_value()
-    chat_id = resolve_proof_chat_id(channel_value)
-    if not chat_id:
-        return
-
-    req = await get_withdraw_request(request_id)
-    if not req:
-        return
-
-    _, user_id, amount, ff_id, game, status, created_at, _, _, _ = req
-    user = await get_user(user_id)
-    username = user[1] if user else None
-    mention = f"@{username}" if username else f"ID: {user_id}"
-    game_label = format_game_label(game)
-    id_label = "Free Fire ID" if (game or "ff") == "ff" else "PUBG ID"
-    created_str = time.strftime("%Y-%m-%d %H:%M", time.localtime(created_at or int(time.time())))
+async def send_proof_receipt(view: WithdrawCardView):
+    await send_to_proof_channel(view.proof_receipt())
 
-    text = (
-        "🧾 <b>Yangi yechib olish so'rovi</b>\n\n"
-        f"👤 Foydalanuvchi: {mention} (ID: <code>{user_id}</code>)\n"
-        f"🎮 O'yin: <b>{game_label}</b>\n"
-        f"🎮 {id_label}: <code>{ff_id}</code>\n"
-        f"💎 Miqdor: <b>{amount} so'm</b>\n"
-        f"🕒 So'rov vaqti: {created_str}\n"
-        "⏳ Holat: <b>Kutilmoqda</b>"
-    )
 
-    try:
-        await bot.send_message(chat_id=chat_id, text=text, parse_mode="HTML", disable_web_page_preview=True)
-    except Exception as exc:
-        log.warning("Isbotlar kanaliga yuborib bo'lmadi (%s): %s", channel_value, exc)
+async def send_withdraw_request_to_proof_channel(view: WithdrawCardView):
+    await send_to_proof_channel(view.proof_request())
 
 
-async def notify_admins_about_withdraw(request_id: int):
-    req = await get_withdraw_request(request_id)
-    if not req:
-        return
-    r_id, user_id, amount, ff_id, game, status, created_at, processed_at, processed_by, note = req
-    user = await get_user(user_id)
-    username = user[1] if user else None
-    almaz = user[3] if user and len(user) > 3 and user[3] is not None else 0
-    refs = await count_verified_referrals(user_id)
-    created_str = time.strftime("%Y-%m-%d %H:%M", time.localtime(created_at or int(time.time())))
-    game_label = format_game_label(game)
-    id_label = "Free Fire ID" if (game or "ff") == "ff" else "PUBG ID"
-
-    text = (
-        "🧾 <b>Yangi Pul yechish so'rovi</b>\n\n"
-        f"👤 Foydalanuvchi: @{username or 'Anonim'} (ID: <code>{user_id}</code>)\n"
-        f"💎 Joriy balans: <b>{almaz} so'm</b>\n"
-        f"🔥 Yechmoqchi: <b>{amount} so'm</b>\n"
-        f"👥 Umumiy tasdiqlangan takliflar: <b>{refs}</b>\n"
-        f"🎮 O'yin: <b>{game_label}</b>\n"
-        f"🎮 {id_label}: <code>{ff_id}</code>\n"
-        f"🕒 So'rov vaqti: {created_str}\n\n"
-        "Quyidagi tugmalar orqali so'rovni boshqaring 👇"
-    )
+async def notify_admins_about_withdraw(view: WithdrawCardView):
+    request_id = view.card.id
+    text = view.admin_new()
 
     kb = InlineKeyboardMarkup(
         inline_keyboard=[
@@ -636,38 +815,57 @@ async def notify_admins_about_withdraw(request_id: int):
         ]
     )
 
-    admin_ids = [OWNER_ID, OWNER2_ID]
-    extra_admins = await list_admins()
-    for uid, _ in extra_admins:
-        if uid not in admin_ids:
-            admin_ids.append(uid)
-
-    for chat_id in admin_ids:
+    for chat_id in await admin_recipients():
         try:
             msg = await bot.send_message(chat_id, text, parse_mode="HTML", reply_markup=kb)
             await add_withdraw_notification(request_id, chat_id, msg.message_id)
         except Exception as e:
             log.warning("failed to send withdraw notify to %s: %s", chat_id, e)
+            await note_delivery_failure(chat_id, e)
+
+
+# ============== Kanal a'zoligi yangilanishlari ==============
+@dp.chat_member()
+async def on_channel_member(update: ChatMemberUpdated):
+    channel = _channel_key_for_chat(update.chat, await list_required_channels())
+    if channel is None:
+        return
+    at = int(update.date.timestamp())
+    subscription_cache.pop((update.new_chat_member.user.id, channel))
+    await record_channel_member(channel, update.new_chat_member.user.id, update.new_chat_member.status, at)
+    if channel not in await list_tracked_channels():
+        await set_channel_tracking(channel, update.chat.id, True)
+
+
+@dp.my_chat_member()
+async def on_bot_membership(update: ChatMemberUpdated):
+    channel = _channel_key_for_chat(update.chat, await list_required_channels())
+    if channel is None:
+        return
+    tracking = update.new_chat_member.status in ("administrator", "creator")
+    await set_channel_tracking(channel, update.chat.id, tracking)
+    log.info("channel %s tracking=%s", channel, tracking)
 
 
 # ============== CALLBACK: obunani qayta tekshirish ==============
 @dp.callback_query(F.data == "check_subs")
-async def recheck_subs(cb: CallbackQuery, state: FSMContext):
-    not_sub = await check_subscription(cb.from_user.id)
+async def recheck_subs(cb: CallbackQuery, state: FSMContext, users: UserSession):
+    not_sub = await check_subscription(cb.from_user.id, fresh=True)
     if not_sub:
         return await cb.message.edit_text(
             "⚠️ Hali barcha kanallarga obuna bo'lmagansiz.\nQuyidagilarga obuna bo'ling va qayta tekshiring.",
             reply_markup=sub_required_markup(not_sub)
         )
     await cb.message.edit_text("✅ Obuna tasdiqlandi! Davom etamiz…")
-    await cmd_start(cb.message, state)
+    await cmd_start(cb.message, state, users)
 
 
 # ============== /start ==============
 @dp.message(Command("start"))
-async def cmd_start(message: Message, state: FSMContext):
+async def cmd_start(message: Message, state: FSMContext, users: Optional[UserSession] = None):
     if message.chat.type != "private":
         return
+    users = users or UserSession()
 
     user_id = message.from_user.id
 
@@ -697,42 +895,28 @@ async def cmd_start(message: Message, state: FSMContext):
     if ref_id:
         await state.update_data(referral_id=ref_id)
 
-    existing_before = await get_user(user_id)
-    is_new_user = existing_before is None
-
-    if is_new_user:
-        await add_user(user_id, message.from_user.username, ref_id)
-        
-        if ref_id:
-            actual_ref = await get_ref_by(user_id)
-            if actual_ref and actual_ref == ref_id:
-                try:
-                    created = await create_referral(ref_id, user_id)
-                    if created:
-                        try:
-                            invited_label = format_user_short(
-                                message.from_user.first_name,
-                                message.from_user.username
-                            )
-                            reward = await get_referral_reward()
-
-                            await bot.send_message(
-                                ref_id,
-                                "🧲 <b>A’lo! Yangi foydalanuvchi jalb qilindi</b>\n\n"
-                                f"🎮 Siz taklif qilgan <b>{invited_label}</b> botga muvaffaqiyatli qo‘shildi.\n\n"
-                                "⏳ Endi faqat <b>2 ta qadam</b> qoldi:\n"
-                                "• Kanalga a’zo bo‘lish\n"
-                                "• Telefon raqamni tasdiqlash\n\n"
-                                f"💎 Ushbu jarayon yakunlangach, siz <b>{reward} so'm</b>ga ega bo‘lasiz.\n"
-                                "⚡ Do‘stlaringiz harakati — sizning foydangiz!",
-                                parse_mode="HTML"
-                            )
-                        except Exception as e:
-                            log.warning("Referral 1-xabar error: %s", e)
-                except Exception as e:
-                    log.warning("Referral creation error: %s", e)
-    else:
-        await add_user(user_id, message.from_user.username, None)
+    registered = await users.register(user_id, message.from_user.username, ref_id)
+    if registered.referral_created:
+        try:
+            invited_label = format_user_short(
+                message.from_user.first_name,
+                message.from_user.username
+            )
+            reward = await get_referral_reward()
+
+            await bot.send_message(
+                registered.ref_by,
+                "🧲 <b>A’lo! Yangi foydalanuvchi jalb qilindi</b>\n\n"
+                f"🎮 Siz taklif qilgan <b>{invited_label}</b> botga muvaffaqiyatli qo‘shildi.\n\n"
+                "⏳ Endi faqat <b>2 ta qadam</b> qoldi:\n"
+                "• Kanalga a’zo bo‘lish\n"
+                "• Telefon raqamni tasdiqlash\n\n"
+                f"💎 Ushbu jarayon yakunlangach, siz <b>{reward} so'm</b>ga ega bo‘lasiz.\n"
+                "⚡ Do‘stlaringiz harakati — sizning foydangiz!",
+                parse_mode="HTML"
+            )
+        except Exception as e:
+            log.warning("Referral 1-xabar error: %s", e)
 
     not_sub = await check_subscription(user_id)
     if not_sub:
@@ -755,7 +939,7 @@ async def cmd_start(message: Message, state: FSMContext):
         )
         return
 
-    verified = await is_verified(user_id)
+    verified = await users.is_verified(user_id)
     if not verified:
         await state.set_state(VerifyStates.PHONE)
         await message.answer(
@@ -790,7 +974,7 @@ async def cmd_start(message: Message, state: FSMContext):
 
 # ==================== TELEFON VERIFICATION ====================
 @dp.message(VerifyStates.PHONE, F.content_type == ContentType.CONTACT)
-async def phone_contact_ok(message: Message, state: FSMContext):
+async def phone_contact_ok(message: Message, state: FSMContext, users: UserSession):
     user_id = message.from_user.id
     contact = message.contact
 
@@ -805,52 +989,36 @@ async def phone_contact_ok(message: Message, state: FSMContext):
     phone = phone if phone.startswith("+") else "+" + phone
     
 
-    await set_phone_verified(user_id, phone)
-    await set_verified(user_id)
+    # Tasdiqlash + taklif qilganga mukofot — bitta tranzaksiyada (takrorlansa ham bir marta)
+    settled = await settle_verification(user_id, phone, await get_referral_reward())
+    users.forget(user_id)
+    users.forget(settled.ref_by)
 
-    ref_by = await get_ref_by(user_id)
     # ---------------- 2-XABAR + BONUS (faqat 1 marta) ----------------
-    if ref_by and ref_by != user_id:
-        # mark_referral_verified returns True only when we actually transitioned to verified
-        did_verify = await mark_referral_verified(user_id)
-        if did_verify:
-            # Step 2: Add achko reward (with error handling)
-            try:
-                reward = await get_referral_reward()
-                await add_almaz(ref_by, reward)
-            except Exception as e:
-                log.warning("So'm qo'shishda xatolik: %s", e)
-
-            # Step 3: Update rank (with error handling)
-            try:
-                await update_user_rank(ref_by, with_notification=True)
-            except Exception as e:
-                log.warning("Rank yangilashda xatolik: %s", e)
-
-            # Step 4: Send 2nd message (SEPARATE try-catch to ensure it runs)
-            try:
-                total = await count_verified_referrals(ref_by)
-                invited_label = format_user_short(
-                    message.from_user.first_name or "Foydalanuvchi",
-                    message.from_user.username
-                )
+    if settled.rewarded:
+        ref_by, reward = settled.ref_by, settled.reward
+        try:
+            invited_label = format_user_short(
+                message.from_user.first_name or "Foydalanuvchi",
+                message.from_user.username
+            )
 
-                txt = (
-                    "🎊 <b>Mukofot tayyor! Zo‘r ishladingiz</b>\n\n"
-                    f"✅ Siz taklif qilgan <b>{invited_label}</b> barcha tekshiruvlardan muvaffaqiyatli o‘tdi.\n\n"
-                    f"💎 Hisobingizga <b>{reward} so'm</b> muvaffaqiyatli qo‘shildi!\n"
-                    f"👥 Tasdiqlangan takliflaringiz soni: <b>{total}</b>\n\n"
-                    "🔥 Qanchalik ko‘p do‘st taklif qilsangiz — shunchalik tez kuchli mukofotlarga yetasiz.\n"
-                    "🚀 Davom eting, imkoniyat siz tomonda!"
+            txt = (
+                "🎊 <b>Mukofot tayyor! Zo‘r ishladingiz</b>\n\n"
+                f"✅ Siz taklif qilgan <b>{invited_label}</b> barcha tekshiruvlardan muvaffaqiyatli o‘tdi.\n\n"
+                f"💎 Hisobingizga <b>{reward} so'm</b> muvaffaqiyatli qo‘shildi!\n"
+                f"👥 Tasdiqlangan takliflaringiz soni: <b>{settled.inviter_verified_refs}</b>\n\n"
+                "🔥 Qanchalik ko‘p do‘st taklif qilsangiz — shunchalik tez kuchli mukofotlarga yetasiz.\n"
+                "🚀 Davom eting, imkoniyat siz tomonda!"
 
-                )
+            )
 
-                await bot.send_message(ref_by, txt, parse_mode="HTML")
-                log.info(f"✅ 2-xabar muvaffaqiyatli yuborildi: {ref_by}")
+            await bot.send_message(ref_by, txt, parse_mode="HTML")
+            log.info(f"✅ 2-xabar muvaffaqiyatli yuborildi: {ref_by}")
 
-            except Exception as e:
-                # Even if message fails, achko is already added
-                log.error(f"❌ 2-xabar yuborishda xatolik (ref_by={ref_by}): {e}")
+        except Exception as e:
+            # Even if message fails, achko is already added
+            log.error(f"❌ 2-xabar yuborishda xatolik (ref_by={ref_by}): {e}")
 
     await state.clear()
 
@@ -891,17 +1059,17 @@ async def user_help(message: Message):
 
 # ============== Profil / Reyting / achko / News / Buy ==============
 @dp.message(F.text == "👤 Mening Profilim")
-async def show_profile(message: Message, state: FSMContext):
-    if await guard_common(message):
-        return
-    user = await get_user(message.from_user.id)
+async def show_profile(message: Message, state: FSMContext, users: Optional[UserSession] = None):
+    # render_menu orqali chaqirilganda sessiya berilmaydi
+    users = users or UserSession()
+    user = await users.get(message.from_user.id)
     if not user:
-        await add_user(message.from_user.id, message.from_user.username or "Noma'lum")
-        user = await get_user(message.from_user.id)
+        await users.add_user(message.from_user.id, message.from_user.username or "Noma'lum")
+        user = await users.get(message.from_user.id)
 
-    almaz = user[3] if len(user) > 3 and user[3] is not None else 0
+    almaz = user.almaz or 0
     total_refs = await count_verified_referrals(message.from_user.id)
-    username = user[1] or (message.from_user.username or "Anonim")
+    username = user.username or (message.from_user.username or "Anonim")
 
     rank, total_users = await get_user_rank(message.from_user.id)
 
@@ -921,8 +1089,6 @@ async def show_profile(message: Message, state: FSMContext):
 
 @dp.message(F.text.in_(["🏆 Reyting", "🏅 Top Foydalanuvchilar"]))
 async def show_leaderboard_handler(message: Message, state: FSMContext):
-    if await guard_common(message):
-        return
     leaders = await get_leaderboard(limit=15)
     if not leaders:
         return await message.answer("📉 Hozircha reyting bo'sh.")
@@ -935,21 +1101,19 @@ async def show_leaderboard_handler(message: Message, state: FSMContext):
 
 
 @dp.message(F.text == "🕷️ Free Fire")
-async def free_fire_menu(message: Message, state: FSMContext):
-    if await guard_common(message):
-        return
+async def free_fire_menu(message: Message, state: FSMContext, user_ctx: UserContext):
     data = await state.get_data()
     prev_menu = data.get("menu_current") or "main"
-    await send_game_offers(message, state, "ff", prev_menu)
+    balance = (user_ctx.user.almaz or 0) if user_ctx.user else 0
+    await send_game_offers(message, state, "ff", prev_menu, balance)
 
 
 @dp.message(F.text == "〽️ PUBG")
-async def pubg_menu(message: Message, state: FSMContext):
-    if await guard_common(message):
-        return
+async def pubg_menu(message: Message, state: FSMContext, user_ctx: UserContext):
     data = await state.get_data()
     prev_menu = data.get("menu_current") or "main"
-    await send_game_offers(message, state, "pubg", prev_menu)
+    balance = (user_ctx.user.almaz or 0) if user_ctx.user else 0
+    await send_game_offers(message, state, "pubg", prev_menu, balance)
 
 
 @dp.callback_query(F.data == PROOF_CHANNEL_BUTTON)
@@ -970,9 +1134,6 @@ async def proof_channel_button_handler(cb: CallbackQuery):
 
 @dp.message(F.text.in_(["💸 Pul ishlash", "💎 Almaz Topish"]))
 async def earn_almaz(message: Message, state: FSMContext):
-    if await guard_common(message):
-        return
-
     me = await bot.get_me()
     bot_username = me.username
     user_id = message.from_user.id
@@ -1007,8 +1168,6 @@ async def earn_almaz(message: Message, state: FSMContext):
 
 @dp.message(F.text == "📣 Yangiliklar & Bonuslar")
 async def show_news(message: Message, state: FSMContext):
-    if await guard_common(message):
-        return
     content = await get_dynamic_text("news")
     if not content:
         return await message.answer("🔭 Hozircha yangiliklar yo'q.")
@@ -1031,8 +1190,6 @@ async def show_news(message: Message, state: FSMContext):
 
 @dp.message(F.text.in_(["🛒 achko do'koni", "🛒 Almaz Do'koni"]))
 async def buy_almaz(message: Message, state: FSMContext):
-    if await guard_common(message):
-        return
     text = await get_dynamic_text("almaz_buy")
     if not text:
         text = (
@@ -1045,8 +1202,6 @@ async def buy_almaz(message: Message, state: FSMContext):
 
 @dp.message(F.text.in_(["💰 Pul Toldirish", "➕ achko sotib olish", "➕ Achko sotib olish"]))
 async def purchase_prompt(message: Message, state: FSMContext):
-    if await guard_common(message):
-        return
     await state.set_state(PurchaseStates.WAITING_PROOF)
     template = await get_dynamic_text("achko_purchase")
     card_number, card_holder = await get_payment_info()
@@ -1122,20 +1277,15 @@ async def purchase_receive_proof(message: Message, state: FSMContext):
         reply_markup=main_menu
     )
     # notify admins
-    admins = [OWNER_ID, OWNER2_ID]
-    extra = await list_admins()
-    for uid, _ in extra:
-        if uid not in admins:
-            admins.append(uid)
-    for aid in admins:
+    for aid in await admin_recipients():
         try:
             await bot.copy_message(chat_id=aid, from_chat_id=message.chat.id, message_id=message.message_id)
             await bot.send_message(
                 aid,
                 f"🧾 Yangi sotib olish talabi: ID {user_id} — summa: ko'rsatilmagan — purchase_id: {purchase_id}"
             )
-        except Exception:
-            pass
+        except Exception as e:
+            await note_delivery_failure(aid, e)
 
 
 @dp.callback_query(F.data == "copy_card")
@@ -1159,19 +1309,17 @@ async def purchase_invalid_proof(message: Message, state: FSMContext):
 
 # ============== achko YECHIB OLISH ==============
 @dp.message(F.text.in_(["💳 Pulni yechib olish", "💳 Almazni yechish"]))
-async def withdraw_start_message(message: Message, state: FSMContext):
-    if await guard_common(message):
-        return
+async def withdraw_start_message(message: Message, state: FSMContext, users: UserSession):
     data = await state.get_data()
     prev_menu = data.get("menu_current") or "main"
-    await open_withdraw_menu(message, state, prev_menu)
+    await open_withdraw_menu(message, state, prev_menu, users)
 
 
 @dp.callback_query(F.data == "withdraw_start")
-async def withdraw_start_cb(cb: CallbackQuery, state: FSMContext):
+async def withdraw_start_cb(cb: CallbackQuery, state: FSMContext, users: UserSession):
     data = await state.get_data()
     prev_menu = data.get("menu_current") or "main"
-    await open_withdraw_menu(cb.message, state, prev_menu)
+    await open_withdraw_menu(cb.message, state, prev_menu, users)
     await cb.answer()
 
 
@@ -1185,21 +1333,20 @@ async def withdraw_back_prev(cb: CallbackQuery, state: FSMContext):
 
 
 @dp.callback_query(F.data == "wd_back_menu")
-async def withdraw_back_menu(cb: CallbackQuery, state: FSMContext):
+async def withdraw_back_menu(cb: CallbackQuery, state: FSMContext, users: UserSession):
     data = await state.get_data()
     prev_menu = data.get("withdraw_prev_menu") or "main"
-    await open_withdraw_menu(cb.message, state, prev_menu)
+    await open_withdraw_menu(cb.message, state, prev_menu, users)
     await cb.answer()
 
 
 @dp.callback_query(F.data.startswith("wd_amount:"))
-async def withdraw_choose_amount(cb: CallbackQuery, state: FSMContext):
-    user_id = cb.from_user.id
-    user = await get_user(user_id)
+async def withdraw_choose_amount(cb: CallbackQuery, state: FSMContext, user_ctx: UserContext):
+    user = user_ctx.user
     if not user:
         await cb.answer("Foydalanuvchi topilmadi.", show_alert=True)
         return
-    balance = user[3] if len(user) > 3 and user[3] is not None else 0
+    balance = user.almaz or 0
     try:
         amount = int(cb.data.split(":")[1])
     except ValueError:
@@ -1223,31 +1370,20 @@ async def withdraw_choose_amount(cb: CallbackQuery, state: FSMContext):
 
 
 @dp.callback_query(F.data.startswith("wd_game:"))
-async def withdraw_game_selected(cb: CallbackQuery, state: FSMContext):
+async def withdraw_game_selected(cb: CallbackQuery, state: FSMContext, user_ctx: UserContext):
     game = cb.data.split(":", 1)[1]
-    # load offers for this game
-    try:
-        offers = await list_offers(game)
-    except Exception:
-        offers = []
-
-    buttons = []
-    if offers:
-        for oid, label, cost in offers:
-            buttons.append([InlineKeyboardButton(text=f"{label} — {cost} so'm", callback_data=f"wd_offer:{oid}")])
-
-    if not buttons:
+    balance = (user_ctx.user.almaz or 0) if user_ctx.user else 0
+    kb = await offers_markup(game, balance, "wd_back_menu")
+    if kb is None:
         await cb.answer("Hozircha takliflar yo'q yoki balans yetarli emas.", show_alert=True)
         return
 
-    buttons.append([InlineKeyboardButton(text="⬅️ Orqaga", callback_data="wd_back_menu")])
-    kb = InlineKeyboardMarkup(inline_keyboard=buttons)
     await cb.message.answer("Iltimos, yechib olmoqchi bo'lgan taklifni tanlang:", reply_markup=kb)
     await cb.answer()
 
 
 @dp.callback_query(F.data.startswith("wd_offer:"))
-async def withdraw_offer_selected(cb: CallbackQuery, state: FSMContext):
+async def withdraw_offer_selected(cb: CallbackQuery, state: FSMContext, user_ctx: UserContext):
     try:
         offer_id = int(cb.data.split(":", 1)[1])
     except Exception:
@@ -1258,8 +1394,10 @@ async def withdraw_offer_selected(cb: CallbackQuery, state: FSMContext):
         return await cb.answer("Taklif topilmadi.", show_alert=True)
 
     _, game, label, achko_cost = offer
-    user = await get_user(cb.from_user.id)
-    balance = user[3] if len(user) > 3 and user[3] is not None else 0
+    user = user_ctx.user
+    if not user:
+        return await cb.answer("Foydalanuvchi topilmadi.", show_alert=True)
+    balance = user.almaz or 0
     if balance < achko_cost:
         return await cb.answer("Balansingiz yetarli emas.", show_alert=True)
 
@@ -1276,7 +1414,7 @@ async def withdraw_offer_selected(cb: CallbackQuery, state: FSMContext):
 
 
 @dp.message(WithdrawStates.WAITING_FF_ID)
-async def withdraw_receive_ff_id(message: Message, state: FSMContext):
+async def withdraw_receive_ff_id(message: Message, state: FSMContext, users: UserSession):
     user_id = message.from_user.id
     data = await state.get_data()
     amount = data.get("withdraw_amount")
@@ -1286,7 +1424,7 @@ async def withdraw_receive_ff_id(message: Message, state: FSMContext):
     if ff_id == "⬅️ Orqaga":
         prev_menu = data.get("withdraw_prev_menu") or "main"
         await state.clear()
-        return await open_withdraw_menu(message, state, prev_menu)
+        return await open_withdraw_menu(message, state, prev_menu, users)
 
     if not amount or not ff_id:
         await message.answer("❌ Noto'g'ri ma'lumot. /start yuborib qayta urinib ko'ring.")
@@ -1314,8 +1452,11 @@ async def withdraw_receive_ff_id(message: Message, state: FSMContext):
         parse_mode="HTML"
     )
 
-    await notify_admins_about_withdraw(req_id)
-    await send_withdraw_request_to_proof_channel(req_id)
+    card = await get_withdraw_card(req_id)
+    if card:
+        view = WithdrawCardView(card)
+        await notify_admins_about_withdraw(view)
+        await send_withdraw_request_to_proof_channel(view)
 
 
 # ============== Withdraw admin callbacklari ==============
@@ -1330,23 +1471,18 @@ async def withdraw_approve(cb: CallbackQuery):
         await cb.answer("Noto'g'ri so'rov.", show_alert=True)
         return
 
-    req = await get_withdraw_request(req_id)
-    if not req:
+    # Summa so'rov yaratilganda yechilgan — bu yerda faqat holat o'zgaradi
+    ok, card = await transition_withdraw(req_id, "approved", cb.from_user.id)
+    if not card:
         await cb.answer("So'rov topilmadi yoki o'chirib yuborilgan.", show_alert=True)
         return
-
-    r_id, user_id, amount, ff_id, game, status, created_at, processed_at, processed_by, note = req
-    if status != "pending":
-        await cb.answer(f"Bu so'rov allaqachon '{status}' holatida.", show_alert=True)
+    if not ok:
+        await cb.answer(f"Bu so'rov allaqachon '{card.status}' holatida.", show_alert=True)
         return
 
-    user = await get_user(user_id)
-    balance = user[3] if user and len(user) > 3 and user[3] is not None else 0
-    # If balance still has amount, deduct now (old-style requests).
-    if balance >= amount:
-        await add_almaz(user_id, -amount)
-    await update_withdraw_status(req_id, "approved", cb.from_user.id, None)
-    await update_withdraw_admin_messages(req_id, "✅ Tasdiqlandi")
+    user_id, amount = card.user_id, card.amount
+    view = WithdrawCardView(card)
+    await update_withdraw_admin_messages(view, "✅ Tasdiqlandi")
 
     try:
         await bot.send_message(
@@ -1359,7 +1495,7 @@ async def withdraw_approve(cb: CallbackQuery):
     except Exception:
         pass
 
-    await send_proof_receipt(req_id, user_id, amount, ff_id, game)
+    await send_proof_receipt(view)
     await cb.answer("So'rov tasdiqlandi.")
 
 
@@ -1374,22 +1510,19 @@ async def withdraw_reject(cb: CallbackQuery):
         await cb.answer("Noto'g'ri so'rov.", show_alert=True)
         return
 
-    req = await get_withdraw_request(req_id)
-    if not req:
+    ok, card = await transition_withdraw(req_id, "rejected", cb.from_user.id)
+    if not card:
         await cb.answer("So'rov topilmadi yoki o'chirib yuborilgan.", show_alert=True)
         return
-
-    r_id, user_id, amount, ff_id, game, status, created_at, processed_at, processed_by, note = req
-    if status != "pending":
-        await cb.answer(f"Bu so'rov allaqachon '{status}' holatida.", show_alert=True)
+    if not ok:
+        await cb.answer(f"Bu so'rov allaqachon '{card.status}' holatida.", show_alert=True)
         return
 
-    await update_withdraw_status(req_id, "rejected", cb.from_user.id, None)
-    await update_withdraw_admin_messages(req_id, "❌ Rad etildi")
+    await update_withdraw_admin_messages(WithdrawCardView(card), "❌ Rad etildi")
 
     try:
         await bot.send_message(
-            user_id,
+            card.user_id,
             "❌ Pul yechish bo'yicha so'rovingiz rad etildi.\n\n"
             "Bunga turli sabablar bo'lishi mumkin (qoidabuzarlik, noto'g'ri ma'lumot va hokazo).\n"
             "Agar bu xatolik deb o'ylasangiz, qo'llab-quvvatlashga murojaat qilishingiz mumkin.",
@@ -1443,28 +1576,25 @@ async def withdraw_edit_send(message: Message, state: FSMContext):
         return
 
     note = (message.text or "").strip()
-    req = await get_withdraw_request(int(req_id))
-    if not req:
+    ok, card = await transition_withdraw(int(req_id), "edited", message.from_user.id, note)
+    if not card:
         await state.clear()
         await message.answer("❌ So'rov bazadan topilmadi.", reply_markup=admin_menu)
         return
-
-    r_id, user_id, amount, ff_id, game, status, created_at, processed_at, processed_by, old_note = req
-    if status != "pending":
+    if not ok:
         await state.clear()
-        await message.answer(f"ℹ️ Bu so'rov allaqachon '{status}' holatiga o'tkazilgan.", reply_markup=admin_menu)
+        await message.answer(f"ℹ️ Bu so'rov allaqachon '{card.status}' holatiga o'tkazilgan.", reply_markup=admin_menu)
         return
 
     try:
         await bot.send_message(
-            user_id,
+            card.user_id,
             f"✏️ Pul yechish so'rovi bo'yicha xabar:\n\n{note}"
         )
     except Exception:
         pass
 
-    await update_withdraw_status(int(req_id), "edited", message.from_user.id, note)
-    await update_withdraw_admin_messages(int(req_id), "✏️ Tahrirlandi")
+    await update_withdraw_admin_messages(WithdrawCardView(card), "✏️ Tahrirlandi")
 
     await state.clear()
     await message.answer(
@@ -1686,11 +1816,63 @@ async def save_dynamic_text(message: Message, state: FSMContext):
 async def ask_broadcast(message: Message, state: FSMContext):
     if not await is_owner_or_admin(message.from_user.id):
         return
-    await message.answer("📢 Reklama xabarini yuboring (matn yoki media).", reply_markup=back_kb)
+    await message.answer("🎯 Reklama kimlarga yuborilsin?", reply_markup=back_kb)
+    await message.answer("Auditoriyani tanlang:", reply_markup=segment_keyboard())
+    await state.set_state(Broadcast.SEGMENT)
+
+
+async def ask_broadcast_content(message: Message, state: FSMContext, segment: str, arg: Optional[int]):
+    audience = await count_segment(segment, arg)
+    if audience == 0:
+        await message.answer(
+            f"🎯 {segment_title(segment, arg)}: bu auditoriyada foydalanuvchi yo'q. Boshqasini tanlang.",
+            reply_markup=segment_keyboard()
+        )
+        await state.set_state(Broadcast.SEGMENT)
+        return
+    await state.update_data(bc_segment=segment, bc_segment_arg=arg)
     await state.set_state(Broadcast.WAITING)
+    await message.answer(
+        f"🎯 {segment_title(segment, arg)}: <b>{audience}</b> ta foydalanuvchi.\n"
+        "📢 Endi reklama xabarini yuboring (matn yoki media).",
+        parse_mode="HTML", reply_markup=back_kb
+    )
+
+
+@dp.callback_query(F.data.startswith("bc_seg:"), StateFilter(Broadcast.SEGMENT))
+async def broadcast_segment_chosen(cb: CallbackQuery, state: FSMContext):
+    if not await is_owner_or_admin(cb.from_user.id):
+        await cb.answer("Sizda bu amal uchun ruxsat yo'q.", show_alert=True)
+        return
+    segment = cb.data.split(":", 1)[1]
+    if segment not in SEGMENT_LABELS:
+        await cb.answer("Noto'g'ri so'rov.", show_alert=True)
+        return
+    await cb.answer()
+    prompt = SEGMENT_LABELS[segment][1]
+    if prompt:
+        await state.update_data(bc_segment=segment)
+        await state.set_state(Broadcast.SEGMENT_ARG)
+        await cb.message.answer(prompt, reply_markup=back_kb)
+        return
+    await ask_broadcast_content(cb.message, state, segment, None)
 
 
-@dp.message(F.text == "⬅️ Orqaga", StateFilter(Broadcast.WAITING))
+@dp.message(StateFilter(Broadcast.SEGMENT_ARG), F.text != "⬅️ Orqaga")
+async def broadcast_segment_arg(message: Message, state: FSMContext):
+    if not await is_owner_or_admin(message.from_user.id):
+        return
+    try:
+        arg = int((message.text or "").strip())
+        if arg < 0:
+            raise ValueError
+    except ValueError:
+        return await message.answer("❗ Musbat butun son kiriting.")
+    segment = (await state.get_data()).get("bc_segment", "all")
+    await ask_broadcast_content(message, state, segment, arg)
+
+
+@dp.message(F.text == "⬅️ Orqaga", StateFilter(Broadcast.SEGMENT, Broadcast.SEGMENT_ARG, Broadcast.WAITING))
 async def cancel_broadcast(message: Message, state: FSMContext):
     if not await is_owner_or_admin(message.from_user.id):
         return
@@ -1709,29 +1891,39 @@ async def cancel_broadcast(message: Message, state: FSMContext):
 async def handle_broadcast(message: Message, state: FSMContext):
     if not await is_owner_or_admin(message.from_user.id):
         return
+    data = await state.get_data()
+    segment, arg = data.get("bc_segment", "all"), data.get("bc_segment_arg")
     await state.clear()
-    await message.answer("🚀 Reklama yuborilmoqda… ⏳")
+    await set_menu_state(state, "admin", "main")
+    await message.answer("🚀 Reklama navbatga qo'yildi. Jarayon quyidagi xabarda ko'rinadi.", reply_markup=admin_menu)
+    await broadcasts.start(message.from_user.id, message.chat.id, message.message_id, segment, arg)
 
-    from database import DB_NAME
-    import aiosqlite
-    async with aiosqlite.connect(DB_NAME) as db:
-        cur = await db.execute("SELECT user_id FROM users")
-        users = [r[0] for r in await cur.fetchall()]
 
-    total, success, failed = len(users), 0, 0
-    for uid in users:
-        try:
-            await bot.copy_message(chat_id=uid, from_chat_id=message.chat.id, message_id=message.message_id)
-            success += 1
-            await asyncio.sleep(0.03)
-        except Exception:
-            failed += 1
+@dp.callback_query(F.data.startswith(("bc_pause:", "bc_resume:", "bc_cancel:")))
+async def broadcast_control(cb: CallbackQuery):
+    if not await is_owner_or_admin(cb.from_user.id):
+        await cb.answer("Sizda bu amal uchun ruxsat yo'q.", show_alert=True)
+        return
+    action, _, raw_id = cb.data.partition(":")
+    try:
+        job_id = int(raw_id)
+    except ValueError:
+        await cb.answer("Noto'g'ri so'rov.", show_alert=True)
+        return
 
-    await message.answer(
-        f"✅ Reklama yakunlandi!\n📬 Yuborilgan: <b>{success}</b>\n❌ Yetkazilmagan: <b>{failed}</b>\n👥 Jami: <b>{total}</b>",
-        parse_mode="HTML", reply_markup=admin_menu
-    )
-    await set_menu_state(state, "admin", "main")
+    runner = broadcasts.get(job_id)
+    if not runner:
+        await cb.answer("Bu reklama allaqachon yakunlangan.", show_alert=True)
+        return
+    if action == "bc_pause":
+        await runner.pause()
+        await cb.answer("⏸ Pauza qilindi.")
+    elif action == "bc_resume":
+        await runner.resume()
+        await cb.answer("▶️ Davom ettirilmoqda.")
+    else:
+        await runner.cancel()
+        await cb.answer("⛔ Bekor qilinmoqda…")
 
 
 @dp.message(F.text == "🧩 Majburiy kanallar")
@@ -1750,6 +1942,12 @@ async def channels_menu(message: Message, state: FSMContext):
     await message.answer(text, parse_mode="HTML", reply_markup=kb)
 
 
+offers_admin_kb = ReplyKeyboardMarkup(keyboard=[
+    [KeyboardButton(text="➕ Taklif qo'shish"), KeyboardButton(text="➖ Taklif o'chirish")],
+    [KeyboardButton(text="⬅️ Orqaga")]
+], resize_keyboard=True)
+
+
 @dp.message(F.text == "🎯 Withdraw takliflar")
 async def offers_menu(message: Message, state: FSMContext):
     if not await is_owner_or_admin(message.from_user.id):
@@ -1757,14 +1955,15 @@ async def offers_menu(message: Message, state: FSMContext):
     # show offers for both games
     ff_offers = await list_offers("ff")
     pubg_offers = await list_offers("pubg")
-    text = "🎯 <b>Withdraw takliflar</b>\n\n"
-    text += "<b>Free Fire:</b>\n" + ("\n".join(f"• {o[1]} — {o[2]} som (ID: {o[0]})" for o in ff_offers) if ff_offers else "– Hozircha yo'q.")
-    text += "\n\n<b>PUBG:</b>\n" + ("\n".join(f"• {o[1]} — {o[2]} som (ID: {o[0]})" for o in pubg_offers) if pubg_offers else "– Hozircha yo'q.")
 
-    kb = ReplyKeyboardMarkup(keyboard=[
-        [KeyboardButton(text="➕ Taklif qo'shish"), KeyboardButton(text="➖ Taklif o'chirish")],
-        [KeyboardButton(text="⬅️ Orqaga")]
-    ], resize_keyboard=True)
+    def build():
+        text = "🎯 <b>Withdraw takliflar</b>\n\n"
+        text += "<b>Free Fire:</b>\n" + ("\n".join(f"• {o[1]} — {o[2]} som (ID: {o[0]})" for o in ff_offers) if ff_offers else "– Hozircha yo'q.")
+        text += "\n\n<b>PUBG:</b>\n" + ("\n".join(f"• {o[1]} — {o[2]} som (ID: {o[0]})" for o in pubg_offers) if pubg_offers else "– Hozircha yo'q.")
+        return text
+
+    text = _offer_view(("admin",), build)
+    kb = offers_admin_kb
 
     await set_menu_state(state, "offers", "admin")
     await message.answer(text, parse_mode="HTML", reply_markup=kb)
@@ -1854,6 +2053,8 @@ async def channel_add(message: Message, state: FSMContext):
     await state.clear()
     await set_menu_state(state, "admin", "main")
     if ok:
+        # add_required_channel bilan bir xil kalit
+        await sync_channel_tracking([ch if ch.startswith("@") else "@" + ch])
         await message.answer("✅ Kanal qo'shildi.", reply_markup=admin_menu)
     else:
         await message.answer("ℹ️ Bu kanal allaqachon mavjud.", reply_markup=admin_menu)
@@ -1977,7 +2178,7 @@ async def achko_remove_prompt(message: Message, state: FSMContext):
 
 
 @dp.message(StateFilter(AdjustAchko.ADD))
-async def achko_add_exec(message: Message, state: FSMContext):
+async def achko_add_exec(message: Message, state: FSMContext, users: UserSession):
     if not await is_owner_or_admin(message.from_user.id):
         return
     text = (message.text or "").strip()
@@ -1997,17 +2198,16 @@ async def achko_add_exec(message: Message, state: FSMContext):
     if amount <= 0:
         return await message.answer("⚠️ Miqdor musbat bo'lishi kerak.")
 
-    user = await get_user(user_id)
+    user = await users.get(user_id)
     if not user:
         return await message.answer("❌ Bunday foydalanuvchi bazada topilmadi.")
 
-    ok = await adjust_balance(user_id, amount, min_zero=False)
+    ok = await users.adjust_balance(user_id, amount, min_zero=False, reason="admin_add", ref_id=message.from_user.id)
     if not ok:
         return await message.answer("❌ Balansni yangilashda xatolik.")
 
     await log_admin_action(message.from_user.id, "achko_add", user_id, amount, None)
-    updated = await get_user(user_id)
-    balance = updated[3] if updated and len(updated) > 3 and updated[3] is not None else 0
+    balance = await users.balance(user_id)
     await state.clear()
 
     try:
@@ -2028,7 +2228,7 @@ async def achko_add_exec(message: Message, state: FSMContext):
 
 
 @dp.message(StateFilter(AdjustAchko.REMOVE))
-async def achko_remove_exec(message: Message, state: FSMContext):
+async def achko_remove_exec(message: Message, state: FSMContext, users: UserSession):
     if not await is_owner_or_admin(message.from_user.id):
         return
     text = (message.text or "").strip()
@@ -2048,17 +2248,16 @@ async def achko_remove_exec(message: Message, state: FSMContext):
     if amount <= 0:
         return await message.answer("⚠️ Miqdor musbat bo'lishi kerak.")
 
-    user = await get_user(user_id)
+    user = await users.get(user_id)
     if not user:
         return await message.answer("❌ Bunday foydalanuvchi bazada topilmadi.")
 
-    ok = await adjust_balance(user_id, -amount, min_zero=True)
+    ok = await users.adjust_balance(user_id, -amount, min_zero=True, reason="admin_remove", ref_id=message.from_user.id)
     if not ok:
         return await message.answer("❌ Balans yetarli emas yoki xatolik yuz berdi.")
 
     await log_admin_action(message.from_user.id, "achko_remove", user_id, amount, None)
-    updated = await get_user(user_id)
-    balance = updated[3] if updated and len(updated) > 3 and updated[3] is not None else 0
+    balance = await users.balance(user_id)
     await state.clear()
 
     try:
@@ -2082,17 +2281,19 @@ async def achko_remove_exec(message: Message, state: FSMContext):
 async def create_backup(message: Message, state: FSMContext):
     if not await is_owner_or_admin(message.from_user.id):
         return
-    result = await backup_database()
-    if result.startswith("Backup xatosi"):
-        await set_menu_state(state, "admin", "main")
-        await message.answer(f"❌ {result}", reply_markup=admin_menu)
-    else:
-        await set_menu_state(state, "admin", "main")
-        await message.answer(
-            f"✅ Baza muvaffaqiyatli zaxiralandi!\n📁 Fayl: <code>{result}</code>",
-            parse_mode="HTML",
-            reply_markup=admin_menu
-        )
+    await set_menu_state(state, "admin", "main")
+    try:
+        result = await backup_database()
+    except Exception as e:
+        await message.answer(f"❌ Backup xatosi: {e}", reply_markup=admin_menu)
+        return
+    await message.answer(
+        f"✅ Baza muvaffaqiyatli zaxiralandi!\n📁 Fayl: <code>{result.path}</code>\n"
+        f"📦 Hajmi: {result.size / 1024:.1f} KB (siqilmagan {result.db_size / 1024:.1f} KB)\n"
+        f"⏱ Vaqt: {result.duration:.2f} s",
+        parse_mode="HTML",
+        reply_markup=admin_menu
+    )
 
 
 @dp.message(F.text.in_(["🔧 Referal mukofoti (so'm)", "🔧 Referal almaz qiymati"]))
@@ -2156,6 +2357,29 @@ async def show_stats(message: Message):
     text += f"• Rad etilgan: <b>{rejected}</b>\n"
     text += f"• Hozirda kutilayotgan: <b>{pending}</b>\n"
 
+    writer = writer_stats()
+    text += "\n🗄 <b>DB yozuv navbati</b>:\n"
+    text += f"• Navbatda: <b>{writer['queue_depth']}</b>\n"
+    text += f"• Kechikish p50/p99: <b>{writer['p50_ms']:.1f} / {writer['p99_ms']:.1f} ms</b>\n"
+    deferred = write_behind_stats()
+    text += f"• Kechiktirilgan yozuvlar: <b>{deferred['pending']}</b> kutmoqda, "
+    text += f"o'rtacha paket <b>{deferred['avg_batch']:.1f}</b>, kechikish max <b>{deferred['max_lag_ms']:.0f} ms</b>\n"
+
+    fsm = fsm_storage.stats()
+    text += f"• FSM holatlari: <b>{fsm['hot']}</b> xotirada, <b>{fsm['dirty']}</b> yozilmagan, "
+    text += f"<b>{fsm['rows']}</b> qator / <b>{fsm['flushes']}</b> flush\n"
+
+    cache = subscription_cache.stats()
+    text += f"\n🔔 <b>Obuna keshi</b>: <b>{cache['hits']}</b> hit / <b>{cache['misses']}</b> miss "
+    text += f"({cache['hit_rate'] * 100:.0f}%), <b>{cache['size']}</b> yozuv\n"
+
+    unreachable = await get_unreachable_stats()
+    if unreachable:
+        text += "\n🚫 <b>Xabar yetmaydigan foydalanuvchilar</b>:\n"
+        text += f"• Botni bloklagan: <b>{unreachable.get('blocked', 0)}</b>\n"
+        text += f"• Akkaunti o'chirilgan: <b>{unreachable.get('deactivated', 0)}</b>\n"
+        text += f"• Chat topilmadi: <b>{unreachable.get('chat_not_found', 0)}</b>\n"
+
     await message.answer(text, parse_mode="HTML")
 
     if top:
@@ -2171,7 +2395,7 @@ async def show_stats(message: Message):
 
 
 @dp.callback_query(F.data.startswith("topuser:"))
-async def top_user_profile(cb: CallbackQuery):
+async def top_user_profile(cb: CallbackQuery, users: UserSession):
     if not await is_owner_or_admin(cb.from_user.id):
         await cb.answer("Siz admin emassiz.", show_alert=True)
         return
@@ -2181,20 +2405,20 @@ async def top_user_profile(cb: CallbackQuery):
         await cb.answer("Noto'g'ri ID.", show_alert=True)
         return
 
-    user = await get_user(uid)
+    user = await users.get(uid)
     if not user:
         await cb.answer("Foydalanuvchi topilmadi.", show_alert=True)
         return
 
-    almaz = user[3] if len(user) > 3 and user[3] is not None else 0
-    phone = user[5] if len(user) > 5 else None
+    almaz = user.almaz or 0
+    phone = user.phone
     total_refs_verified = await count_verified_referrals(uid)
     remain = await get_suspension_remaining(uid)
 
     txt = (
         "🔎 <b>Foydalanuvchi profili</b>\n\n"
         f"🆔 ID: <code>{uid}</code>\n"
-        f"👤 Username: @{user[1] or 'Anonim'}\n"
+        f"👤 Username: @{user.username or 'Anonim'}\n"
         f"📞 Telefon: {phone or '–'}\n"
         f"💎 Balans: {almaz}\n so'm"
         f"🤝 Tasdiqlangan takliflar: {total_refs_verified}\n"
@@ -2338,7 +2562,22 @@ async def admin_exit_to_main(message: Message, state: FSMContext):
 async def main():
     await init_db()
     await setup_bot_commands()
-    await dp.start_polling(bot)
+    asyncio.create_task(leaderboard_check_loop())
+    asyncio.create_task(suspension_expiry_loop(notify_suspension_over))
+    asyncio.create_task(balance_snapshot_loop())
+    if BACKUP_INTERVAL > 0:
+        asyncio.create_task(backup_loop())
+    await broadcasts.resume_unfinished()
+    await sync_channel_tracking()
+    # Barcha handlerlar ro'yxatdan o'tgan — matnli tugmalar jadvali quriladi
+    TextDispatchTable(dp.message).install()
+    try:
+        await dp.start_polling(bot)
+    finally:
+        # Reklamalar joriy nuqtani saqlaydi, keyin FSM, bufer va ulanishlar yopiladi
+        await broadcasts.shutdown()
+        await fsm_storage.close()
+        await close_db()
 
 
 if __name__ == "__main__":
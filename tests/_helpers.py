@@ -0,0 +1,48 @@
+# _helpers.py - test skriptlari uchun umumiy yordamchilar
+import os
+import sys
+
+import aiosqlite
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+
+from database import DB_NAME
+
+
+def remove_db(name: str = DB_NAME):
+    """Baza fayli va uning WAL/SHM yo'ldoshlarini o'chiradi."""
+    for suffix in ("", "-wal", "-shm"):
+        if os.path.exists(name + suffix):
+            os.remove(name + suffix)
+
+
+class HopCounter:
+    """
+    aiosqlite ishchi thread'iga har bir murojaatni (Connection._execute)
+    sanaydi — "bazaga bormadi" degan tekshiruvlar uchun.
+    """
+
+    def __init__(self):
+        self.count = 0
+        self._orig = None
+
+    def install(self) -> "HopCounter":
+        if self._orig is None:
+            orig = self._orig = aiosqlite.Connection._execute
+            counter = self
+
+            async def counting_execute(conn, fn, *args, **kwargs):
+                counter.count += 1
+                return await orig(conn, fn, *args, **kwargs)
+
+            aiosqlite.Connection._execute = counting_execute
+        return self
+
+    def uninstall(self):
+        if self._orig is not None:
+            aiosqlite.Connection._execute = self._orig
+            self._orig = None
+
+    def reset(self):
+        self.count = 0
@@ -0,0 +1,44 @@
+import os
+import sys
+import asyncio
+
+ROOT = os.path.dirname(os.path.dirname(__file__))
+sys.path.insert(0, ROOT)
+
+from _helpers import remove_db, HopCounter
+from config import OWNER_ID, OWNER2_ID
+from database import (
+    ADMINS, init_db, close_db, add_admin, remove_admin, is_admin, list_admins,
+    notify_recipients, load_admin_registry,
+)
+
+HOPS = HopCounter().install()
+
+
+async def run():
+    remove_db()
+    await init_db()
+
+    print("owners only:", notify_recipients() == (OWNER_ID, OWNER2_ID))
+    await add_admin(500, "b")
+    await add_admin(100, "a")
+    await add_admin(OWNER_ID, "owner")
+    print("second add rejected:", await add_admin(100, "a") is False)
+    print("recipients:", notify_recipients() == (OWNER_ID, OWNER2_ID, 100, 500))
+
+    HOPS.reset()
+    checks = [await is_admin(100), await is_admin(7), len(await list_admins())]
+    print("checks:", checks, "db hops:", HOPS.count)
+
+    await remove_admin(500)
+    print("after remove:", notify_recipients() == (OWNER_ID, OWNER2_ID, 100), await is_admin(500))
+
+    rows = ADMINS.rows()
+    await load_admin_registry()
+    print("registry matches db:", rows == ADMINS.rows())
+
+    await close_db()
+    remove_db()
+
+
+asyncio.run(run())
@@ -0,0 +1,94 @@
+import os
+import sys
+import gzip
+import time
+import shutil
+import asyncio
+import sqlite3
+import tempfile
+
+ROOT = os.path.dirname(os.path.dirname(__file__))
+sys.path.insert(0, ROOT)
+
+from _helpers import remove_db
+from database import DB_NAME, init_db, close_db, run_write, backup_database
+
+BACKUP_DIR = os.path.join(tempfile.gettempdir(), "bot_backup_test")
+
+
+def restore(path: str) -> sqlite3.Connection:
+    conn = sqlite3.connect(":memory:")
+    conn.deserialize(gzip.decompress(open(path, "rb").read()))
+    return conn
+
+
+async def run():
+    remove_db()
+    shutil.rmtree(BACKUP_DIR, ignore_errors=True)
+    await init_db()
+
+    def fill(conn, start, count):
+        conn.executemany(
+            "INSERT INTO users(user_id, username, almaz, created_at) VALUES(?, ?, ?, 0)",
+            [(uid, f"user{uid}" * 8, uid % 1000) for uid in range(start, start + count)]
+        )
+
+    await run_write(fill, 1, 100_000)
+
+    # Yozuvlar WAL'da turibdi — zaxirada ham bo'lishi kerak
+    wal_size = os.path.getsize(DB_NAME + "-wal") if os.path.exists(DB_NAME + "-wal") else 0
+    print("wal has data:", wal_size > 0)
+
+    # Zaxira davomida event loop va yozuvlar ishlashda davom etadi
+    stalls = []
+    stop = asyncio.Event()
+
+    async def ticker():
+        while not stop.is_set():
+            started = time.perf_counter()
+            await asyncio.sleep(0.005)
+            stalls.append(time.perf_counter() - started - 0.005)
+
+    async def writer():
+        # Zaxira tugaguncha to'xtovsiz yozuvlar — qadamli nusxa qayta-qayta boshlanadi
+        i = 0
+        while not stop.is_set():
+            await run_write(fill, 200_000 + i, 1)
+            await asyncio.sleep(0.001)
+            i += 1
+
+    async def backup():
+        try:
+            return await backup_database(BACKUP_DIR, keep=2, step_pages=16, max_restarts=2)
+        finally:
+            stop.set()
+
+    tick = asyncio.create_task(ticker())
+    result, _ = await asyncio.wait_for(asyncio.gather(backup(), writer()), timeout=60)
+    await tick
+    print("max loop stall < 50 ms:", max(stalls) < 0.05, "ticks:", len(stalls) > 0)
+    print("finished under constant writes, restarts capped:", result.restarts == 3)
+    print("compressed:", result.path.endswith(".db.gz"), "smaller:", result.size < result.db_size,
+          "pages:", result.pages > 0, "duration:", result.duration > 0)
+
+    copy = restore(result.path)
+    print("integrity:", copy.execute("PRAGMA integrity_check").fetchone()[0],
+          "users >= 100000:", copy.execute("SELECT COUNT(*) FROM users").fetchone()[0] >= 100_000)
+    copy.close()
+
+    # Retention: faqat so'nggi 2 tasi qoladi, qo'lda olingan .db nusxaga tegilmaydi
+    legacy = os.path.join(BACKUP_DIR, "backup_20200101_000000.db")
+    open(legacy, "wb").close()
+    second = await backup_database(BACKUP_DIR, keep=2)
+    third = await backup_database(BACKUP_DIR, keep=2)
+    left = sorted(n for n in os.listdir(BACKUP_DIR) if n.endswith(".gz"))
+    print("legacy .db kept:", os.path.exists(legacy))
+    print("removed:", third.removed, "left:", len(left), "latest kept:",
+          os.path.basename(second.path) in left and os.path.basename(third.path) in left)
+
+    await close_db()
+    shutil.rmtree(BACKUP_DIR, ignore_errors=True)
+    remove_db()
+
+
+asyncio.run(run())
@@ -0,0 +1,65 @@
+import os
+import sys
+import time
+import asyncio
+import sqlite3
+
+ROOT = os.path.dirname(os.path.dirname(__file__))
+sys.path.insert(0, ROOT)
+
+from _helpers import remove_db
+import database
+from database import (
+    DB_NAME, init_db, close_db, add_user, get_user, create_referral, add_almaz, adjust_balance,
+    create_withdraw_and_deduct, settle_verification, set_setting,
+    take_balance_snapshots, balance_as_of, get_ledger, reconcile_balances,
+)
+
+
+async def run():
+    remove_db()
+
+    # Jurnaldan oldingi balans — v9 bazaga migratsiya boshlang'ich snapshot yozadi
+    await init_db()
+    await close_db()
+    conn = sqlite3.connect(DB_NAME)
+    conn.execute("INSERT INTO users(user_id, username, almaz) VALUES(1, 'old', 500)")
+    conn.execute("DROP TABLE balance_ledger")
+    conn.execute("DROP TABLE balance_snapshots")
+    conn.execute("PRAGMA user_version = 9")
+    conn.commit()
+    conn.close()
+    await init_db()
+    await set_setting("referral_reward", "100")
+    print("legacy balance reconciled:", await reconcile_balances() == [], "as of now:", await balance_as_of(1, int(time.time())))
+
+    await add_user(2, "invited", 1)
+    await create_referral(1, 2)
+    await settle_verification(2, "+998")
+    await add_almaz(1, 50)
+    await adjust_balance(1, -30, reason="admin_remove", ref_id=99)
+    print("rejected adjust:", await adjust_balance(1, -10_000), "entries:", len(await get_ledger(1)))
+    request_id = await create_withdraw_and_deduct(1, 200, "123")
+    entries = await get_ledger(1)
+    print("ledger:", [(e.delta, e.reason, e.ref_id) for e in reversed(entries)])
+    print("withdraw ref:", entries[0].ref_id == request_id, "balance:", (await get_user(1)).almaz, "(expected 420)")
+    print("reconcile:", await reconcile_balances())
+
+    print("snapshots written:", await take_balance_snapshots(), "again:", await take_balance_snapshots())
+    await add_almaz(1, 80)
+    print("after snapshot reconcile:", await reconcile_balances(), "balance:", (await get_user(1)).almaz)
+
+    # Jurnalni chetlab o'zgartirilgan balans aniqlanadi
+    await database._execute_write("UPDATE users SET almaz = almaz + 7 WHERE user_id=2")
+    print("drift:", await reconcile_balances())
+
+    # Ko'p parallel o'zgarish — har biriga bitta yozuv, commitlar soni oshmaydi
+    await asyncio.gather(*(add_almaz(2, 1) for _ in range(50)))
+    print("parallel entries:", len(await get_ledger(2, limit=1000)), "(expected 50)")
+    print("past balance:", await balance_as_of(1, 0), "(expected 0)")
+
+    await close_db()
+    remove_db()
+
+
+asyncio.run(run())
@@ -0,0 +1,172 @@
+import os
+import sys
+import asyncio
+from collections import Counter
+
+ROOT = os.path.dirname(os.path.dirname(__file__))
+sys.path.insert(0, ROOT)
+
+from _helpers import remove_db
+os.environ.setdefault("BROADCAST_PAGE_SIZE", "100")
+os.environ.setdefault("BROADCAST_PROGRESS_INTERVAL", "0.05")
+
+from aiogram.exceptions import TelegramBadRequest, TelegramForbiddenError, TelegramRetryAfter
+from aiogram.methods import CopyMessage
+
+import database
+from broadcast import BroadcastManager, unreachable_reason
+from database import (
+    init_db, close_db, db_connection, get_broadcast_job, add_user,
+    flush_deferred_writes, get_unreachable_stats, count_segment,
+    mark_unreachable, register_user, filter_reachable,
+)
+
+USERS = 1000
+
+
+class FakeMessage:
+    def __init__(self, chat_id: int, message_id: int):
+        self.chat = type("Chat", (), {"id": chat_id})()
+        self.message_id = message_id
+
+
+class FakeBot:
+    def __init__(self):
+        self.delivered = Counter()
+        self.attempts = Counter()
+        self.edits = 0
+        self.flooded = False
+
+    async def copy_message(self, chat_id, from_chat_id, message_id):
+        await asyncio.sleep(0)
+        self.attempts[chat_id] += 1
+        method = CopyMessage(chat_id=chat_id, from_chat_id=from_chat_id, message_id=message_id)
+        if chat_id == 500 and not self.flooded:
+            self.flooded = True
+            raise TelegramRetryAfter(method=method, message="Too Many Requests", retry_after=1)
+        if chat_id % 100 == 0:
+            raise TelegramForbiddenError(method=method, message="bot was blocked by the user")
+        self.delivered[chat_id] += 1
+
+    async def send_message(self, chat_id, text, **kwargs):
+        return FakeMessage(chat_id, 1)
+
+    async def edit_message_text(self, text, **kwargs):
+        self.edits += 1
+
+
+async def run():
+    remove_db()
+    await init_db()
+    async with db_connection() as db:
+        await db.executemany(
+            "INSERT INTO users(user_id, created_at) VALUES(?, 0)",
+            [(uid,) for uid in range(1, USERS + 1)]
+        )
+        await db.commit()
+
+    bot = FakeBot()
+    manager = BroadcastManager(bot, rate=2000)
+    runner = await manager.start(1, 1, 42)
+
+    # Pauza: yuborish to'xtaydi
+    await asyncio.sleep(0.1)
+    await runner.pause()
+    await asyncio.sleep(0.05)
+    paused_at = runner.processed
+    await asyncio.sleep(0.2)
+    print("paused mid-way:", 0 < paused_at < USERS, "stays paused:", runner.processed == paused_at)
+    await runner.resume()
+
+    # "Restart": vazifa to'xtatiladi, yangi manager bazadan davom ettiradi
+    await asyncio.sleep(0.1)
+    await manager.shutdown()
+    job = await get_broadcast_job(runner.job.id)
+    print("status after shutdown:", job.status, "checkpoint saved:", job.last_user_id > 0)
+
+    manager = BroadcastManager(bot, rate=2000)
+    print("resumed jobs:", await manager.resume_unfinished())
+    await asyncio.gather(*(r.task for r in list(manager._runners.values())))
+
+    job = await get_broadcast_job(runner.job.id)
+    duplicates = sum(n - 1 for n in bot.delivered.values() if n > 1)
+    print("final status:", job.status)
+    print("every reachable user got it:", len(bot.delivered) == USERS - USERS // 100)
+    print("duplicates after restart <= workers:", duplicates <= 8)
+    print("blocked users counted as failed:", job.failed >= USERS // 100)
+    print("flood control honoured:", bot.flooded)
+    print("progress edits:", bot.edits > 0)
+
+    # Bloklaganlar belgilandi va keyingi reklamada so'rov yuborilmaydi
+    await flush_deferred_writes()
+    print("unreachable after first run:", await get_unreachable_stats())
+    bot.attempts.clear()
+    runner = await manager.start(1, 1, 44)
+    await runner.task
+    print("blocked users skipped:", not any(bot.attempts[uid] for uid in range(100, USERS + 1, 100)),
+          "total:", runner.total, "failed:", runner.failed)
+    # /start qayta bosilganda (add_user) yana yetib boriladi
+    await add_user(100, "back")
+    print("reachable after /start:", await count_segment())
+
+    # Reklama belgilagan zahoti /start bosildi — belgi keyinroq qaytib tushmaydi
+    await mark_unreachable(200, "blocked")
+    await register_user(200, "back")
+    await asyncio.sleep(database.WRITE_BEHIND_DELAY_MS / 1000 * 2)
+    await flush_deferred_writes()
+    print("unblocked right after mark stays reachable:", await filter_reachable([200]) == [200])
+
+    # Segmentlar: faqat shartga mos (va yetib boriladigan) foydalanuvchilar
+    async with db_connection() as db:
+        await db.execute("UPDATE users SET verified = user_id % 2 = 0, almaz = user_id % 50, ref_by = user_id % 7")
+        await db.execute(
+            "UPDATE users SET created_at = strftime('%s','now') - CASE WHEN user_id > 100 THEN 86400 * 30 ELSE 0 END"
+        )
+        await db.execute(
+            "UPDATE users SET last_seen_at = strftime('%s','now') - CASE WHEN user_id % 3 = 0 THEN 86400 * 20 ELSE 0 END"
+        )
+        await db.executemany(
+            "INSERT INTO withdraw_requests(user_id, amount, ff_id, status, created_at) VALUES(?, 1, '1', ?, 0)",
+            [(uid, "pending" if uid % 25 == 0 else "approved") for uid in range(1, USERS + 1) if uid % 25 in (0, 1)]
+        )
+        await db.commit()
+    comeback = {100, 200}
+    for segment, arg, expected in (
+        ("verified", None, lambda uid: uid % 2 == 0),
+        ("balance_above", 40, lambda uid: uid % 50 > 40),
+        ("joined_days", 7, lambda uid: uid <= 100),
+        ("ref_by", 3, lambda uid: uid % 7 == 3),
+        ("pending_withdraw", None, lambda uid: uid % 25 == 0),
+        ("inactive_days", 14, lambda uid: uid % 3 == 0),
+    ):
+        expected_ids = {uid for uid in range(1, USERS + 1) if expected(uid) and (uid % 100 or uid in comeback)}
+        bot.attempts.clear()
+        runner = await manager.start(1, 1, 45, segment, arg)
+        await runner.task
+        print(f"segment {segment}: total={runner.total} matches={set(bot.attempts) == expected_ids}")
+        # Qaytganlar hali ham bloklagan — urinishdan keyin yana belgilanadi
+        comeback -= set(bot.attempts)
+
+    method = CopyMessage(chat_id=1, from_chat_id=1, message_id=1)
+    print("classify:", [
+        unreachable_reason(TelegramForbiddenError(method=method, message="Forbidden: bot was blocked by the user")),
+        unreachable_reason(TelegramForbiddenError(method=method, message="Forbidden: user is deactivated")),
+        unreachable_reason(TelegramBadRequest(method=method, message="Bad Request: chat not found")),
+        unreachable_reason(TelegramBadRequest(method=method, message="Bad Request: message to copy not found")),
+    ])
+
+    # Bekor qilish
+    manager = BroadcastManager(bot, rate=200)
+    runner = await manager.start(1, 1, 43)
+    await asyncio.sleep(0.3)
+    await runner.cancel()
+    await runner.task
+    job = await get_broadcast_job(runner.job.id)
+    print("cancelled:", job.status, "stopped early:", job.sent + job.failed < USERS,
+          "finished_at set:", job.finished_at is not None)
+
+    await close_db()
+    remove_db()
+
+
+asyncio.run(run())
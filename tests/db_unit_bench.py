@@ -0,0 +1,145 @@
+"""
+Yozuv unit'lari mikrobenchmarki: eski (har bir so'rov alohida await,
+pool ulanishlari lock uchun kurashadi) va yangi (butun tranzaksiya bitta
+thread hop'da, yagona yozuvchi navbati orqali) balans/withdraw funksiyalari.
+
+    python tests/db_unit_bench.py [operatsiyalar_soni] [parallel_vazifalar]
+"""
+import os
+import sys
+import time
+import asyncio
+import statistics
+
+ROOT = os.path.dirname(os.path.dirname(__file__))
+sys.path.insert(0, ROOT)
+
+from _helpers import remove_db, HopCounter
+import database
+from database import init_db, close_db, db_connection
+
+OPS = int(sys.argv[1]) if len(sys.argv) > 1 else 2000
+CONCURRENCY = int(sys.argv[2]) if len(sys.argv) > 2 else 50
+USERS = 200
+
+HOPS = HopCounter().install()
+
+
+# ---- Eski implementatsiyalar (run_unit dan oldingi) ----
+async def legacy_adjust_balance(user_id: int, delta: int, min_zero: bool = True) -> bool:
+    async with db_connection() as db:
+        await db.execute("BEGIN IMMEDIATE")
+        cur = await db.execute("SELECT COALESCE(almaz,0) FROM users WHERE user_id=?", (user_id,))
+        row = await cur.fetchone()
+        if not row:
+            await db.rollback()
+            return False
+        new_balance = int(row[0]) + delta
+        if min_zero and new_balance < 0:
+            await db.rollback()
+            return False
+        await db.execute("UPDATE users SET almaz=? WHERE user_id=?", (new_balance, user_id))
+        await db.commit()
+        return True
+
+
+async def legacy_create_withdraw_and_deduct(user_id: int, amount: int, ff_id: str, game: str = "ff"):
+    now = int(time.time())
+    async with db_connection() as db:
+        await db.execute("BEGIN IMMEDIATE")
+        cur = await db.execute("SELECT COALESCE(almaz,0) FROM users WHERE user_id=?", (user_id,))
+        row = await cur.fetchone()
+        if not row or int(row[0]) < amount:
+            await db.rollback()
+            return None
+        await db.execute("UPDATE users SET almaz = almaz - ? WHERE user_id=?", (amount, user_id))
+        cur = await db.execute(
+            "INSERT INTO withdraw_requests(user_id, amount, ff_id, game, status, created_at) VALUES(?, ?, ?, ?, 'pending', ?)",
+            (user_id, amount, ff_id, game, now)
+        )
+        await db.commit()
+        return cur.lastrowid
+
+
+async def legacy_add_user(user_id: int, username=None, ref_by=None):
+    now = int(time.time())
+    async with db_connection() as db:
+        await db.execute(
+            "INSERT INTO users(user_id, username, created_at) VALUES(?, ?, ?) ON CONFLICT(user_id) DO NOTHING",
+            (user_id, username, now)
+        )
+        if username:
+            await db.execute("UPDATE users SET username=? WHERE user_id=?", (username, user_id))
+        if ref_by and ref_by != user_id:
+            cur = await db.execute("SELECT ref_by FROM users WHERE user_id=?", (user_id,))
+            row = await cur.fetchone()
+            if row and row[0] is None:
+                await db.execute("UPDATE users SET ref_by=? WHERE user_id=?", (ref_by, user_id))
+        await db.commit()
+
+
+CASES = [
+    ("adjust_balance", legacy_adjust_balance, database.adjust_balance, lambda i: (i % USERS + 1, 1)),
+    ("create_withdraw_and_deduct", legacy_create_withdraw_and_deduct, database.create_withdraw_and_deduct,
+     lambda i: (i % USERS + 1, 1, "123")),
+    ("add_user", legacy_add_user, database.add_user, lambda i: (100000 + i, f"u{i}", 1)),
+]
+
+
+async def measure(fn, make_args):
+    latencies = []
+    sem = asyncio.Semaphore(CONCURRENCY)
+
+    async def one(i):
+        async with sem:
+            started = time.perf_counter()
+            await fn(*make_args(i))
+            latencies.append(time.perf_counter() - started)
+
+    HOPS.reset()
+    started = time.perf_counter()
+    await asyncio.gather(*(one(i) for i in range(OPS)))
+    wall = time.perf_counter() - started
+    latencies.sort()
+    return {
+        "hops": HOPS.count / OPS,
+        "mean_ms": statistics.mean(latencies) * 1000,
+        "p95_ms": latencies[int(len(latencies) * 0.95) - 1] * 1000,
+        "ops_s": OPS / wall,
+    }
+
+
+async def reset_users():
+    async with db_connection() as db:
+        await db.execute("DELETE FROM users")
+        await db.execute("DELETE FROM withdraw_requests")
+        await db.executemany(
+            "INSERT INTO users(user_id, username, almaz, created_at) VALUES(?, ?, ?, 0)",
+            [(uid, f"user{uid}", 10 ** 6) for uid in range(1, USERS + 1)]
+        )
+        await db.commit()
+    await database.load_leaderboard()
+
+
+async def run():
+    remove_db()
+    await init_db()
+
+    print(f"ops={OPS} concurrency={CONCURRENCY} pool={database.DB_POOL_SIZE}")
+    print(f"{'operation':<28} {'variant':<8} {'hops/op':>8} {'mean ms':>9} {'p95 ms':>9} {'ops/s':>9}")
+    for name, legacy, unit, make_args in CASES:
+        for variant, fn in (("legacy", legacy), ("unit", unit)):
+            await reset_users()
+            r = await measure(fn, make_args)
+            print(f"{name:<28} {variant:<8} {r['hops']:>8.1f} {r['mean_ms']:>9.2f} {r['p95_ms']:>9.2f} {r['ops_s']:>9.0f}")
+
+    stats = database.writer_stats()
+    print(f"writer queue_depth={stats['queue_depth']} p50={stats['p50_ms']:.2f}ms p99={stats['p99_ms']:.2f}ms")
+    for name, (count, avg_ms, max_ms) in stats["ops"].items():
+        print(f"  {name:<28} n={count:<6} avg={avg_ms:.2f}ms max={max_ms:.2f}ms")
+
+    await close_db()
+    remove_db()
+
+
+asyncio.run(run())
@@ -0,0 +1,72 @@
+import os
+import sys
+import asyncio
+
+ROOT = os.path.dirname(os.path.dirname(__file__))
+sys.path.insert(0, ROOT)
+
+from _helpers import remove_db
+from aiogram.fsm.state import State, StatesGroup
+from aiogram.fsm.storage.base import StorageKey
+
+from database import init_db, close_db, db_connection
+from fsm_storage import SQLiteStorage
+
+
+class Verify(StatesGroup):
+    PHONE = State()
+
+
+KEY = StorageKey(bot_id=1, chat_id=10, user_id=10)
+
+
+async def db_rows():
+    async with db_connection() as db:
+        cur = await db.execute("SELECT key, state, data FROM fsm_states ORDER BY key")
+        return await cur.fetchall()
+
+
+async def run():
+    remove_db()
+    await init_db()
+
+    # /start oqimi: referral_id, holat va menyu bosishlari — hammasi xotirada
+    storage = SQLiteStorage(flush_interval=0.05)
+    await storage.update_data(KEY, {"referral_id": 5})
+    await storage.set_state(KEY, Verify.PHONE)
+    for i in range(20):
+        await storage.update_data(KEY, {"menu_current": f"m{i}", "menu_prev": "main"})
+    print("rows before flush:", len(await db_rows()))
+    await asyncio.sleep(0.15)
+    print("after flush:", storage.stats())
+
+    # Qayta ishga tushirish: yangi storage bazadan o'qiydi
+    restarted = SQLiteStorage(flush_interval=0.05)
+    print("state after restart:", await restarted.get_state(KEY))
+    print("data after restart:", await restarted.get_data(KEY))
+    await restarted.get_data(KEY)
+    print("db loads:", restarted.loads)
+
+    # state.clear() qatorni o'chiradi; close() yozilmaganlarni yozib chiqadi
+    await restarted.set_state(KEY, None)
+    await restarted.set_data(KEY, {})
+    other = StorageKey(bot_id=1, chat_id=11, user_id=11)
+    await restarted.update_data(other, {"withdraw_amount": 100})
+    await restarted.close()
+    print("rows after clear + close:", [(r[0], r[2]) for r in await db_rows()])
+
+    # Eskirgan holat o'qilmaydi va keyingi flush'da o'chiriladi
+    async with db_connection() as db:
+        await db.execute("UPDATE fsm_states SET updated_at = updated_at - 100")
+        await db.commit()
+    expired = SQLiteStorage(flush_interval=0.05, ttl=50)
+    print("expired data:", await expired.get_data(other))
+    await expired.close()
+    print("rows after expiry:", len(await db_rows()))
+
+    await storage.close()
+    await close_db()
+    remove_db()
+
+
+asyncio.run(run())
@@ -0,0 +1,119 @@
+import os
+import sys
+import asyncio
+from datetime import datetime
+
+ROOT = os.path.dirname(os.path.dirname(__file__))
+sys.path.insert(0, ROOT)
+from _helpers import remove_db
+os.environ.setdefault("BOT_TOKEN", "123456:ABCDEF")
+
+from aiogram.methods import AnswerCallbackQuery, EditMessageText, SendMessage
+from aiogram.types import CallbackQuery, Chat, Message, Update, User
+
+import main
+import user_session
+from config import OWNER_ID
+from database import init_db, close_db, add_user, add_required_channel, set_suspension
+
+# (kanal, user_id) -> status
+MEMBERS = {("@chan", 1): "member", ("@chan", 3): "member"}
+SENT = []
+GET_USER_CALLS = []
+_orig_get_user = user_session.get_user
+
+
+class FakeMember:
+    def __init__(self, status):
+        self.status = status
+
+
+async def fake_get_chat_member(chat_id, user_id):
+    if user_id == main.bot.id:
+        return FakeMember("administrator")
+    return FakeMember(MEMBERS.get((chat_id, user_id), "left"))
+
+
+async def fake_make_request(bot, method, timeout=None):
+    # API ga hech narsa yuborilmaydi — faqat nima yuborilishi yoziladi
+    SENT.append(method)
+    return True
+
+
+async def counting_get_user(user_id):
+    GET_USER_CALLS.append(user_id)
+    return await _orig_get_user(user_id)
+
+
+_update_id = 0
+
+
+def _next_id() -> int:
+    global _update_id
+    _update_id += 1
+    return _update_id
+
+
+def message_update(user_id: int, text: str) -> Update:
+    user = User(id=user_id, is_bot=False, first_name="u", username=f"u{user_id}")
+    msg = Message(
+        message_id=_next_id(), date=datetime.now(),
+        chat=Chat(id=user_id, type="private"), from_user=user, text=text,
+    )
+    return Update(update_id=_update_id, message=msg)
+
+
+def callback_update(user_id: int, data: str) -> Update:
+    user = User(id=user_id, is_bot=False, first_name="u")
+    msg = Message(message_id=_next_id(), date=datetime.now(), chat=Chat(id=user_id, type="private"), text="x")
+    cb = CallbackQuery(id=str(_update_id), from_user=user, chat_instance="ci", message=msg, data=data)
+    return Update(update_id=_update_id, callback_query=cb)
+
+
+async def feed(update: Update) -> str:
+    SENT.clear()
+    GET_USER_CALLS.clear()
+    await main.dp.feed_update(main.bot, update)
+    replies = []
+    for method in SENT:
+        if isinstance(method, (SendMessage, EditMessageText)):
+            replies.append(method.text.split("\n")[0])
+        elif isinstance(method, AnswerCallbackQuery):
+            replies.append(f"alert:{(method.text or '').split(chr(10))[0]}")
+    return " | ".join(replies)
+
+
+async def run():
+    remove_db()
+    await init_db()
+    main.bot.get_chat_member = fake_get_chat_member
+    main.bot.session.make_request = fake_make_request
+    user_session.get_user = counting_get_user
+    await add_required_channel("@chan")
+    await main.sync_channel_tracking()
+    for uid in (1, 2, 3, OWNER_ID):
+        await add_user(uid, f"u{uid}")
+    await set_suspension(3, 600)
+
+    print("subscribed profile:", await feed(message_update(1, "👤 Mening Profilim")))
+    print("get_user calls per update:", len(GET_USER_CALLS))
+    print("not subscribed profile:", await feed(message_update(2, "👤 Mening Profilim")))
+    print("suspended profile:", await feed(message_update(3, "👤 Mening Profilim")))
+    print("owner, not subscribed:", await feed(message_update(OWNER_ID, "👤 Mening Profilim")))
+    print("/start exempt:", await feed(message_update(2, "/start")))
+    print("/start payload exempt:", await feed(message_update(2, "/start ref_1")))
+    print("/startx not exempt:", await feed(message_update(2, "/startx")))
+    print("/help exempt:", await feed(message_update(2, "/help")))
+    # Callback'lar ham bir xil tekshiruvdan o'tadi
+    print("callback not subscribed:", await feed(callback_update(2, "wd_amount:10")))
+    print("callback suspended:", await feed(callback_update(3, "wd_amount:10")))
+    print("check_subs exempt:", await feed(callback_update(2, "check_subs")))
+    print("callback subscribed:", await feed(callback_update(1, "wd_amount:10")))
+
+    user_session.get_user = _orig_get_user
+    await main.fsm_storage.close()
+    await close_db()
+    remove_db()
+
+
+asyncio.run(run())
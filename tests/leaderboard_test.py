@@ -0,0 +1,38 @@
+import os
+import sys
+import random
+
+ROOT = os.path.dirname(os.path.dirname(__file__))
+sys.path.insert(0, ROOT)
+
+from leaderboard import Leaderboard
+
+
+def brute_rank(balances, user_id):
+    return sum(1 for v in balances.values() if v > balances[user_id]) + 1
+
+
+random.seed(42)
+lb = Leaderboard()
+lb.load([(uid, f"user{uid}", random.randint(0, 100)) for uid in range(1, 501)])
+
+mismatches = 0
+for step in range(3000):
+    uid = random.randint(1, 600)
+    if random.random() < 0.1:
+        lb.add_user(uid, f"user{uid}")
+    else:
+        lb.set_balance(uid, random.randint(0, 120))
+
+    if step % 300 == 0:
+        balances = lb.balances()
+        for u in random.sample(list(balances), 25):
+            if lb.rank(u) != (brute_rank(balances, u), len(balances)):
+                mismatches += 1
+        expected = sorted(balances.items(), key=lambda kv: (-kv[1], kv[0]))[:15]
+        if [a for _, a in lb.top(15)] != [v for _, v in expected]:
+            mismatches += 1
+
+print('rank/top mismatches:', mismatches)
+print('total users:', len(lb))
+print('unknown user rank:', lb.rank(10 ** 9))
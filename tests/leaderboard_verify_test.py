@@ -0,0 +1,57 @@
+import os
+import sys
+import asyncio
+
+ROOT = os.path.dirname(os.path.dirname(__file__))
+sys.path.insert(0, ROOT)
+
+from _helpers import remove_db
+import database
+from database import LEADERBOARD, init_db, close_db, add_user, add_almaz, get_user, verify_leaderboard
+
+_fetch = database._fetch_balances
+
+
+async def run():
+    remove_db()
+    await init_db()
+    for uid in range(1, 6):
+        await add_user(uid, f"u{uid}")
+        await add_almaz(uid, uid * 100)
+
+    # O'qish tugamasdan balans o'zgaradi va yangi foydalanuvchi qo'shiladi
+    async def slow_fetch():
+        rows = await _fetch()
+        await add_almaz(1, 1000)
+        await add_user(6, "late")
+        return rows
+
+    database._fetch_balances = slow_fetch
+    drift = await verify_leaderboard()
+    print("drift during concurrent write:", drift)
+    print("fresh balance kept:", LEADERBOARD.balances()[1] == (await get_user(1)).almaz == 1100,
+          "late user kept:", 6 in LEADERBOARD.balances(), "rank:", LEADERBOARD.rank(1)[0])
+
+    # Haqiqiy farq + bir vaqtdagi yozuv: farq tuzatiladi, yangi qiymat saqlanadi
+    LEADERBOARD.set_balance(2, 7)  # xotirani "buzamiz"
+    async def slow_fetch_2():
+        rows = await _fetch()
+        await add_almaz(3, 50)
+        return rows
+
+    database._fetch_balances = slow_fetch_2
+    drift = await verify_leaderboard()
+    print("real drift repaired:", drift, LEADERBOARD.balances()[2] == 200,
+          "concurrent write kept:", LEADERBOARD.balances()[3] == (await get_user(3)).almaz == 350)
+
+    # Parallel yozuvsiz — to'liq qayta yuklash
+    database._fetch_balances = _fetch
+    LEADERBOARD.set_balance(4, 1)
+    print("reload drift:", await verify_leaderboard(), "after:", await verify_leaderboard(),
+          "balance:", LEADERBOARD.balances()[4])
+
+    await close_db()
+    remove_db()
+
+
+asyncio.run(run())
@@ -0,0 +1,64 @@
+import os
+import sys
+import asyncio
+import sqlite3
+
+ROOT = os.path.dirname(os.path.dirname(__file__))
+sys.path.insert(0, ROOT)
+
+from _helpers import remove_db
+import database
+from database import DB_NAME, SCHEMA_VERSION, init_db, close_db
+
+# Remove existing DB for clean test
+remove_db()
+
+# Eski (fix_db.py dan oldingi) struktura: rank ustunlari bor, game ustuni yo'q
+legacy = sqlite3.connect(DB_NAME)
+legacy.executescript("""
+    CREATE TABLE users (
+        user_id INTEGER PRIMARY KEY, username TEXT, almaz INTEGER DEFAULT 0,
+        ref_by INTEGER, verified INTEGER DEFAULT 0, phone TEXT, created_at INTEGER,
+        rank_score INTEGER, rank_level TEXT
+    );
+    CREATE TABLE withdraw_requests (
+        id INTEGER PRIMARY KEY AUTOINCREMENT, user_id INTEGER NOT NULL, amount INTEGER NOT NULL,
+        ff_id TEXT, status TEXT DEFAULT 'pending', created_at INTEGER, processed_at INTEGER,
+        processed_by INTEGER, note TEXT
+    );
+    CREATE TABLE groups (id INTEGER PRIMARY KEY);
+    INSERT INTO users(user_id, username, almaz, rank_score) VALUES (1, 'old', 7, 100);
+    INSERT INTO withdraw_requests(user_id, amount, ff_id) VALUES (1, 5, '123');
+""")
+legacy.commit()
+legacy.close()
+
+
+async def run_test():
+    await init_db()
+    await close_db()
+
+    db = sqlite3.connect(DB_NAME)
+    print('user_version:', db.execute("PRAGMA user_version").fetchone()[0], '(expected', SCHEMA_VERSION, ')')
+    print('users columns:', [r[1] for r in db.execute("PRAGMA table_info(users)")])
+    print('legacy user kept:', db.execute("SELECT user_id, username, almaz FROM users").fetchall())
+    print('withdraw game:', db.execute("SELECT game FROM withdraw_requests").fetchall())
+    print('groups dropped:', db.execute("SELECT COUNT(*) FROM sqlite_master WHERE name='groups'").fetchone()[0] == 0)
+
+    for sql, args in [
+        ("SELECT COUNT(*) FROM referrals WHERE inviter_id=? AND status='verified'", (1,)),
+        ("SELECT inviter_id, COUNT(*) FROM referrals WHERE status='verified' AND verified_at >= ? GROUP BY inviter_id", (0,)),
+        ("SELECT id, user_id, amount, created_at FROM purchases WHERE status='pending' ORDER BY created_at ASC", ()),
+        ("SELECT chat_id, message_id FROM withdraw_notifications WHERE request_id=?", (1,)),
+        ("SELECT user_id FROM users WHERE username=?", ('old',)),
+        ("SELECT COUNT(*) FROM users WHERE ref_by=?", (1,)),
+    ]:
+        plan = " | ".join(r[3] for r in db.execute("EXPLAIN QUERY PLAN " + sql, args))
+        print('plan:', plan)
+    db.close()
+
+    # Qayta ishga tushirish hech narsa qo'llamasligi kerak
+    print('second run applied:', await database.run_migrations())
+    await close_db()
+
+asyncio.run(run_test())
@@ -0,0 +1,59 @@
+import os
+import sys
+import asyncio
+
+ROOT = os.path.dirname(os.path.dirname(__file__))
+sys.path.insert(0, ROOT)
+from _helpers import remove_db, HopCounter
+os.environ.setdefault("BOT_TOKEN", "123456:ABCDEF")
+
+
+import main
+from database import (
+    init_db, close_db, create_offer, update_offer, delete_offer,
+    list_offers, get_offer, offers_version,
+)
+
+HOPS = HopCounter()
+
+
+def labels(kb):
+    return [row[0].text for row in kb.inline_keyboard] if kb else None
+
+
+async def run():
+    remove_db()
+    await init_db()
+    HOPS.install()
+
+    await create_offer("ff", "520 Almaz", 50000)
+    await create_offer("ff", "105 Almaz", 12000)
+    big = await create_offer("ff", "1060 Almaz", 99000)
+    await create_offer("pubg", "60 UC", 15000)
+    print("ff offers:", [o[1] for o in await list_offers("ff")])
+    print("affordable for 50000:", [o[1] for o in await list_offers("ff", max_cost=50000)])
+    print("affordable for 100:", await list_offers("ff", max_cost=100))
+
+    # Katalog bosilishi — bazaga murojaat yo'q, klaviatura keshdan
+    HOPS.reset()
+    first = await main.offers_markup("ff", 60000, "wd_back_prev")
+    again = await main.offers_markup("ff", 55000, "wd_back_prev")
+    print("keyboard:", labels(first))
+    print("same object:", first is again, "db hops:", HOPS.count, "offer:", await get_offer(big))
+
+    # O'zgartirish versiyani oshiradi va klaviatura qayta quriladi
+    version = offers_version()
+    await update_offer(big, "1060 Almaz (aksiya)", 45000)
+    updated = await main.offers_markup("ff", 55000, "wd_back_prev")
+    print("version bumped:", offers_version() > version, "rebuilt:", updated is not first)
+    print("keyboard after update:", labels(updated))
+    await delete_offer(big)
+    print("after delete:", [o[1] for o in await list_offers("ff")], await get_offer(big))
+    print("none affordable:", await main.offers_markup("pubg", 100, "wd_back_menu"))
+
+    HOPS.uninstall()
+    await close_db()
+    remove_db()
+
+
+asyncio.run(run())
@@ -0,0 +1,121 @@
+"""
+/start to'lqini benchmarki: eski yo'l (get_user -> add_user -> get_user
+(ref_by) -> create_referral, har biri alohida yozuv/o'qish) va bitta
+tranzaksiyali register_user. Oqimda yangi foydalanuvchilar (ko'pchiligi
+referal havola bilan) va qayta /start bosganlar aralash keladi.
+
+    python tests/register_user_bench.py [start_soni] [parallel_vazifalar]
+"""
+import os
+import sys
+import time
+import asyncio
+import random
+import statistics
+
+ROOT = os.path.dirname(os.path.dirname(__file__))
+sys.path.insert(0, ROOT)
+
+from _helpers import remove_db
+import database
+from database import init_db, close_db, db_connection, get_user, add_user, create_referral, register_user
+
+STARTS = int(sys.argv[1]) if len(sys.argv) > 1 else 3000
+CONCURRENCY = int(sys.argv[2]) if len(sys.argv) > 2 else 100
+INVITERS = 50
+REPEAT_SHARE = 0.3
+
+
+async def legacy_start(user_id: int, username: str, ref_id):
+    # cmd_start'ning oldingi ketma-ketligi
+    existing = await get_user(user_id)
+    if existing is None:
+        await add_user(user_id, username, ref_id)
+        if ref_id:
+            row = await get_user(user_id)
+            if row and row.ref_by == ref_id:
+                return await create_referral(ref_id, user_id)
+    else:
+        await add_user(user_id, username, None)
+    return False
+
+
+async def unit_start(user_id: int, username: str, ref_id):
+    return (await register_user(user_id, username, ref_id)).referral_created
+
+
+def make_burst(seed: int) -> list:
+    rnd = random.Random(seed)
+    burst, seen = [], []
+    next_id = 1_000_000
+    for _ in range(STARTS):
+        if seen and rnd.random() < REPEAT_SHARE:
+            uid = rnd.choice(seen)
+        else:
+            uid = next_id
+            next_id += 1
+            seen.append(uid)
+        ref = rnd.randint(1, INVITERS) if rnd.random() < 0.8 else None
+        burst.append((uid, f"u{uid}", ref))
+    return burst
+
+
+async def reset():
+    async with db_connection() as db:
+        await db.execute("DELETE FROM users")
+        await db.execute("DELETE FROM referrals")
+        await db.executemany(
+            "INSERT INTO users(user_id, username, created_at) VALUES(?, ?, 0)",
+            [(uid, f"inviter{uid}") for uid in range(1, INVITERS + 1)]
+        )
+        await db.commit()
+    await database.load_leaderboard()
+    database._LAST_SEEN.clear()
+
+
+async def measure(fn, burst):
+    latencies = []
+    created = 0
+    sem = asyncio.Semaphore(CONCURRENCY)
+
+    async def one(args):
+        nonlocal created
+        async with sem:
+            started = time.perf_counter()
+            result = await fn(*args)
+            latencies.append(time.perf_counter() - started)
+            created += bool(result)
+
+    started = time.perf_counter()
+    await asyncio.gather(*(one(args) for args in burst))
+    wall = time.perf_counter() - started
+    latencies.sort()
+    async with db_connection() as db:
+        cur = await db.execute("SELECT COUNT(*) FROM referrals")
+        rows = (await cur.fetchone())[0]
+    return {
+        "mean_ms": statistics.mean(latencies) * 1000,
+        "p99_ms": latencies[int(len(latencies) * 0.99) - 1] * 1000,
+        "starts_s": len(burst) / wall,
+        "created": created,
+        "rows": rows,
+    }
+
+
+async def run():
+    remove_db()
+    await init_db()
+
+    burst = make_burst(42)
+    print(f"starts={STARTS} concurrency={CONCURRENCY} unique_users={len({b[0] for b in burst})}")
+    print(f"{'variant':<8} {'mean ms':>9} {'p99 ms':>9} {'starts/s':>9} {'referrals':>10} {'rows':>6}")
+    for variant, fn in (("legacy", legacy_start), ("unit", unit_start)):
+        await reset()
+        r = await measure(fn, burst)
+        print(f"{variant:<8} {r['mean_ms']:>9.2f} {r['p99_ms']:>9.2f} {r['starts_s']:>9.0f} {r['created']:>10} {r['rows']:>6}")
+
+    await close_db()
+    remove_db()
+
+
+asyncio.run(run())
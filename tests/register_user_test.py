@@ -0,0 +1,43 @@
+import os
+import sys
+import asyncio
+
+ROOT = os.path.dirname(os.path.dirname(__file__))
+sys.path.insert(0, ROOT)
+
+from _helpers import remove_db
+from database import init_db, close_db, add_user, get_user, register_user, db_connection
+
+
+async def referral_rows():
+    async with db_connection() as db:
+        cur = await db.execute("SELECT inviter_id, invited_id, status FROM referrals ORDER BY id")
+        return await cur.fetchall()
+
+
+async def run():
+    remove_db()
+    await init_db()
+    await add_user(1, "inviter")
+
+    r = await register_user(2, "invited", 1)
+    print("new:", r.created, "ref_by:", r.ref_by, "referral:", r.referral_created, "row:", r.user)
+
+    # Qayta /start: boshqa havola ref_by'ni o'zgartirmaydi, username yangilanadi
+    r = await register_user(2, "renamed", 5)
+    print("repeat:", r.created, "ref_by:", r.ref_by, "referral:", r.referral_created,
+          "username:", (await get_user(2)).username)
+
+    print("self ref:", await register_user(3, "self", 3))
+    print("no ref:", (await register_user(4, None, None)).ref_by)
+
+    # Bir vaqtda kelgan bir xil /start — faqat bittasi yangi va bitta referal
+    results = await asyncio.gather(*(register_user(10, "burst", 1) for _ in range(10)))
+    print("parallel created:", sum(r.created for r in results), "referrals:", sum(r.referral_created for r in results))
+    print("referral rows:", await referral_rows())
+
+    await close_db()
+    remove_db()
+
+
+asyncio.run(run())
@@ -0,0 +1,50 @@
+import os
+import sys
+import asyncio
+
+ROOT = os.path.dirname(os.path.dirname(__file__))
+sys.path.insert(0, ROOT)
+
+from _helpers import remove_db, HopCounter
+import database
+from database import (
+    init_db, close_db, get_setting, get_setting_int, set_setting, delete_setting,
+    get_dynamic_text, update_dynamic_text, load_settings_cache,
+)
+
+HOPS = HopCounter().install()
+
+
+async def run():
+    remove_db()
+    await init_db()
+
+    await set_setting("referral_reward", "250")
+    await set_setting("card_number", "8600 0000 0000 0000")
+    await update_dynamic_text("news", "Yangilik")
+
+    HOPS.reset()
+    values = [
+        await get_setting_int("referral_reward", 1),
+        await get_setting("card_number"),
+        await get_setting("card_holder"),
+        await get_dynamic_text("news"),
+        await get_dynamic_text("almaz_buy"),
+    ]
+    print("cached reads:", values, "db hops:", HOPS.count)
+
+    await set_setting("referral_reward", "oops")
+    print("bad int falls back:", await get_setting_int("referral_reward", 1))
+    await delete_setting("card_number")
+    print("deleted:", await get_setting("card_number"))
+
+    # Kesh bazadagi holat bilan bir xil bo'lishi kerak
+    snapshot = (dict(database._SETTINGS), dict(database._TEXTS))
+    await load_settings_cache()
+    print("cache matches db:", snapshot == (database._SETTINGS, database._TEXTS))
+
+    await close_db()
+    remove_db()
+
+
+asyncio.run(run())
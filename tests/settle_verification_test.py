@@ -0,0 +1,48 @@
+import os
+import sys
+import asyncio
+
+ROOT = os.path.dirname(os.path.dirname(__file__))
+sys.path.insert(0, ROOT)
+
+from _helpers import remove_db
+import database
+from database import (
+    init_db, close_db, add_user, get_user, create_referral, set_setting,
+    settle_verification, count_verified_referrals, is_verified,
+)
+
+
+async def run():
+    remove_db()
+    await init_db()
+    await set_setting("referral_reward", "250")
+
+    await add_user(1, "inviter")
+    await add_user(2, "invited", 1)
+    await create_referral(1, 2)
+
+    result = await settle_verification(2, "+998900000002")
+    print("first:", result)
+    print("retry:", await settle_verification(2, "+998900000002"))
+    print("invited verified:", await is_verified(2), "phone:", (await get_user(2)).phone)
+    print("inviter almaz:", (await get_user(1)).almaz, "refs:", await count_verified_referrals(1))
+    print("leaderboard rank:", (await database.get_user_rank(1))[0])
+
+    # Parallel takroriy chaqiruvlar: mukofot faqat bir marta
+    for uid in range(10, 15):
+        await add_user(uid, f"u{uid}", 1)
+        await create_referral(1, uid)
+    results = await asyncio.gather(*(settle_verification(uid, "+998") for uid in range(10, 15) for _ in range(4)))
+    print("parallel rewarded:", sum(r.rewarded for r in results), "of", len(results), "(expected 5)")
+    print("inviter almaz:", (await get_user(1)).almaz, "(expected 1500) refs:", await count_verified_referrals(1))
+
+    # Taklifsiz foydalanuvchi — faqat tasdiqlanadi
+    await add_user(3, "solo")
+    print("no referrer:", await settle_verification(3, "+998900000003"), await is_verified(3))
+
+    await close_db()
+    remove_db()
+
+
+asyncio.run(run())
@@ -0,0 +1,118 @@
+import os
+import sys
+import time
+import asyncio
+from datetime import datetime, timedelta
+
+ROOT = os.path.dirname(os.path.dirname(__file__))
+sys.path.insert(0, ROOT)
+from _helpers import remove_db
+os.environ.setdefault("BOT_TOKEN", "123456:ABCDEF")
+os.environ.setdefault("SUB_CACHE_NEGATIVE_TTL", "0.2")
+
+from aiogram.types import Chat, ChatMemberLeft, ChatMemberMember, ChatMemberUpdated, User
+
+import main
+from cache import TTLCache
+from database import init_db, close_db, add_required_channel, remove_required_channel
+
+API_LATENCY = 0.1
+CALLS = []
+# (kanal, user_id) -> status; bot o'zi @chan da admin, @other da emas
+MEMBERS = {("@chan", 1): "member", ("@chan", 2): "left", ("@other", 1): "member"}
+
+
+class FakeMember:
+    def __init__(self, status):
+        self.status = status
+
+
+async def fake_get_chat_member(chat_id, user_id):
+    CALLS.append((chat_id, user_id))
+    await asyncio.sleep(API_LATENCY)
+    if user_id == main.bot.id:
+        return FakeMember("administrator" if chat_id == "@chan" else "member")
+    return FakeMember(MEMBERS.get((chat_id, user_id), "left"))
+
+
+def member_update(user_id: int, new_member, minutes: int = 0) -> ChatMemberUpdated:
+    user = User(id=user_id, is_bot=False, first_name="u")
+    return ChatMemberUpdated(
+        chat=Chat(id=-1001, type="channel", username="chan"),
+        from_user=user,
+        date=datetime.now() + timedelta(minutes=minutes),
+        old_chat_member=ChatMemberMember(user=user),
+        new_chat_member=new_member(user=user),
+    )
+
+
+async def timed_check(user_id: int, **kwargs):
+    CALLS.clear()
+    started = time.perf_counter()
+    result = await main.check_subscription(user_id, **kwargs)
+    return result, len(CALLS), (time.perf_counter() - started) * 1000
+
+
+async def run():
+    remove_db()
+    await init_db()
+    main.bot.get_chat_member = fake_get_chat_member
+    await add_required_channel("@chan")
+    await main.sync_channel_tracking()
+
+    result, calls, ms = await timed_check(1)
+    print(f"first check: not_sub={result} api_calls={calls} ({ms:.0f} ms)")
+    result, calls, ms = await timed_check(1)
+    print(f"second check: not_sub={result} api_calls={calls} ({ms:.1f} ms)")
+
+    # Foydalanuvchi kanaldan chiqdi — chat_member yangilanishi lokal holatni o'zgartiradi
+    await main.on_channel_member(member_update(1, ChatMemberLeft, minutes=1))
+    result, calls, _ = await timed_check(1)
+    print(f"after leave update: not_sub={result} api_calls={calls}")
+    # Kechikib kelgan eski yangilanish yangisini bosib ketmaydi
+    await main.on_channel_member(member_update(1, ChatMemberMember, minutes=-5))
+    result, calls, _ = await timed_check(1)
+    print(f"stale update ignored: not_sub={result} api_calls={calls}")
+    # "✅ Tekshirish": salbiy lokal javob API orqali qayta tekshiriladi
+    result, calls, _ = await timed_check(1, fresh=True)
+    print(f"fresh recheck: not_sub={result} api_calls={calls}")
+
+    # Bot adminlikdan olindi — lokal jadvalga ishonilmaydi, javob kesh yoki API dan
+    await main.on_bot_membership(member_update(main.bot.id, ChatMemberLeft))
+    result, calls, _ = await timed_check(1)
+    print(f"untracked channel: not_sub={result} api_calls={calls}")
+    # Ikki kanal, ikkalasi noma'lum — parallel tekshiriladi
+    await add_required_channel("@other")
+    await main.sync_channel_tracking()
+    result, calls, ms = await timed_check(2)
+    print(f"two unknown channels: not_sub={result} api_calls={calls} parallel={ms < API_LATENCY * 1000 * 1.5}")
+
+    # Kuzatilmaydigan kanal (@other): natija keshdan olinadi
+    MEMBERS[("@other", 3)] = "member"
+    await timed_check(3)
+    result, calls, _ = await timed_check(3)
+    print(f"cached positive: not_sub={result} api_calls={calls}")
+    result, calls, _ = await timed_check(2)
+    print(f"cached negative: not_sub={result} api_calls={calls}")
+    await asyncio.sleep(0.25)
+    result, calls, _ = await timed_check(2)
+    print(f"negative expired: api_calls={calls}")
+    # Kanallar ro'yxati o'zgarsa kesh tozalanadi
+    await remove_required_channel("@chan")
+    result, calls, _ = await timed_check(3)
+    print(f"after channel change: not_sub={result} api_calls={calls}")
+    print("cache stats:", {k: v for k, v in main.subscription_cache.stats().items() if k != "hit_rate"})
+
+    # LRU: to'lganda eng eski ishlatilmagan yozuv chiqadi
+    cache = TTLCache(2)
+    cache.set("a", 1, 60)
+    cache.set("b", 2, 60)
+    cache.get("a")
+    cache.set("c", 3, 60)
+    print("lru kept:", sorted(k for k in ("a", "b", "c") if cache.get(k) is not None))
+
+    await close_db()
+    remove_db()
+
+
+asyncio.run(run())
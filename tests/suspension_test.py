@@ -0,0 +1,64 @@
+import os
+import sys
+import time
+import asyncio
+
+ROOT = os.path.dirname(os.path.dirname(__file__))
+sys.path.insert(0, ROOT)
+
+from _helpers import remove_db, HopCounter
+from database import (
+    SUSPENSIONS, init_db, close_db, db_connection, set_suspension,
+    get_suspension_remaining, suspension_expiry_loop, load_suspensions,
+)
+
+HOPS = HopCounter().install()
+
+
+async def stored_ids():
+    async with db_connection() as db:
+        cur = await db.execute("SELECT user_id FROM suspensions ORDER BY user_id")
+        return [r[0] for r in await cur.fetchall()]
+
+
+async def run():
+    remove_db()
+    await init_db()
+
+    expired_batches = []
+
+    async def on_expired(user_ids):
+        expired_batches.append((round(time.monotonic() - started, 1), sorted(user_ids)))
+
+    started = time.monotonic()
+    loop_task = asyncio.create_task(suspension_expiry_loop(on_expired))
+    await set_suspension(1, 1)
+    await set_suspension(2, 1)
+    await set_suspension(3, 100)
+    # 4 uzaytirildi: heap'dagi eski (1 s) yozuv uni o'chirmasligi kerak
+    await set_suspension(4, 1)
+    await set_suspension(4, 100)
+
+    HOPS.reset()
+    remaining = [await get_suspension_remaining(uid) for uid in (1, 3, 99)]
+    print("remaining:", [r > 0 for r in remaining], "db hops:", HOPS.count)
+
+    await asyncio.sleep(1.5)
+    print("expired batches:", expired_batches)
+    print("rows left:", await stored_ids(), "active:", len(SUSPENSIONS))
+    print("after expiry:", await get_suspension_remaining(1))
+
+    # Yangi, qisqaroq tanaffus uxlab yotgan loop'ni uyg'otadi
+    await set_suspension(5, 1)
+    await asyncio.sleep(1.5)
+    print("woken for new suspension:", expired_batches[-1][1])
+
+    await load_suspensions()
+    print("reload matches:", sorted(SUSPENSIONS._until) == await stored_ids())
+
+    loop_task.cancel()
+    await close_db()
+    remove_db()
+
+
+asyncio.run(run())
@@ -0,0 +1,79 @@
+"""
+Matnli xabarlar dispatch mikrobenchmarki: aiogram'ning ketma-ket filtr
+tekshiruvi va TextDispatchTable (tugma matni + FSM holati bo'yicha jadval).
+Handlerlar o'rniga bo'sh funksiyalar — faqat dispatch narxi o'lchanadi.
+
+    python tests/text_dispatch_bench.py [takrorlar_soni]
+"""
+import os
+import sys
+import time
+import asyncio
+import statistics
+from datetime import datetime
+
+ROOT = os.path.dirname(os.path.dirname(__file__))
+sys.path.insert(0, ROOT)
+os.environ.setdefault("BOT_TOKEN", "123456:ABCDEF")
+
+from aiogram import Router
+from aiogram.dispatcher.event.handler import HandlerObject
+from aiogram.types import Chat, Message, User
+
+import main
+from text_router import TextDispatchTable
+
+ROUNDS = int(sys.argv[1]) if len(sys.argv) > 1 else 2000
+
+CASES = [
+    ("main menu button", "👤 Mening Profilim", None),
+    ("admin button", "📈 Statistika", None),
+    ("generic back", "⬅️ Orqaga", None),
+    ("back in state", "⬅️ Orqaga", "SearchUser:WAIT"),
+    ("free text in state", "12345: 100", "AdjustAchko:ADD"),
+    ("unknown text", "salom", None),
+]
+
+
+def noop_copy(observer):
+    router = Router()
+    for handler in observer.handlers:
+        async def noop(*args, **kwargs):
+            return None
+        router.message.handlers.append(HandlerObject(callback=noop, filters=handler.filters, flags=handler.flags))
+    return router.message
+
+
+def make_message(text: str) -> Message:
+    user = User(id=1, is_bot=False, first_name="u")
+    return Message(message_id=1, date=datetime.now(), chat=Chat(id=1, type="private"), from_user=user, text=text)
+
+
+async def measure(trigger, msg, state):
+    samples = []
+    for _ in range(ROUNDS):
+        started = time.perf_counter()
+        await trigger(msg, bot=main.bot, raw_state=state)
+        samples.append(time.perf_counter() - started)
+    samples.sort()
+    return statistics.mean(samples) * 1e6, samples[int(len(samples) * 0.99) - 1] * 1e6
+
+
+async def run():
+    observer = noop_copy(main.dp.message)
+    table = TextDispatchTable(observer)
+    table.build()
+    legacy = observer.trigger
+
+    print(f"handlers={len(observer.handlers)} labels={len(table.labels)} rounds={ROUNDS}")
+    print(f"{'case':<20} {'variant':<8} {'mean us':>9} {'p99 us':>9}")
+    for name, text, state in CASES:
+        msg = make_message(text)
+        for variant, trigger in (("linear", legacy), ("table", table.trigger)):
+            mean_us, p99_us = await measure(trigger, msg, state)
+            print(f"{name:<20} {variant:<8} {mean_us:>9.1f} {p99_us:>9.1f}")
+
+    await main.bot.session.close()
+
+
+asyncio.run(run())
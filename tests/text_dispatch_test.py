@@ -0,0 +1,91 @@
+import os
+import sys
+import asyncio
+from datetime import datetime
+
+ROOT = os.path.dirname(os.path.dirname(__file__))
+sys.path.insert(0, ROOT)
+os.environ.setdefault("BOT_TOKEN", "123456:ABCDEF")
+
+from aiogram import Router
+from aiogram.dispatcher.event.handler import HandlerObject
+from aiogram.types import Chat, Contact, Message, User
+
+import main
+from text_router import TextDispatchTable
+
+
+def noop_copy(observer):
+    # Bir xil filtrlar, lekin handler faqat o'z nomini qaytaradi
+    router = Router()
+    for handler in observer.handlers:
+        async def noop(*args, __name=handler.callback.__name__, **kwargs):
+            return __name
+        router.message.handlers.append(HandlerObject(callback=noop, filters=handler.filters, flags=handler.flags))
+    return router.message
+
+
+def make_message(text=None, contact=False) -> Message:
+    user = User(id=1, is_bot=False, first_name="u")
+    return Message(
+        message_id=1, date=datetime.now(), chat=Chat(id=1, type="private"), from_user=user, text=text,
+        contact=Contact(phone_number="+998", first_name="u", user_id=1) if contact else None,
+    )
+
+
+async def run():
+    observer = noop_copy(main.dp.message)
+    table = TextDispatchTable(observer)
+    table.build()
+    legacy = observer.trigger
+
+    texts = sorted(table.labels) + ["/start", "/start ref_5", "/admin", "/help", "salom", "12345: 100"]
+    states = [None] + sorted(table.states())
+    messages = [make_message(t) for t in texts] + [make_message(contact=True)]
+    checked = mismatches = 0
+    for msg in messages:
+        for state in states:
+            kwargs = {"bot": main.bot, "raw_state": state}
+            expected = await legacy(msg, **dict(kwargs))
+            got = await table.trigger(msg, **dict(kwargs))
+            checked += 1
+            if expected != got:
+                mismatches += 1
+                print("MISMATCH", repr(msg.text), state, expected, got)
+    print(f"handlers: {len(observer.handlers)} labels: {len(table.labels)} states: {len(states)}")
+    print(f"checked: {checked} mismatches: {mismatches}")
+
+    # Keyinroq qo'shilgan handler jadvalni qayta quradi
+    async def late(*args, **kwargs):
+        return "late"
+    observer.register(late, main.F.text == "🆕 Yangi tugma")
+    print("late handler:", await table.trigger(make_message("🆕 Yangi tugma"), bot=main.bot, raw_state=None))
+
+    # Filtr lug'at qaytarib, keyingi filtri rad etgan handler'ning
+    # ma'lumotlari keyingi nomzodga o'tmasligi kerak
+    router = Router()
+
+    async def partial(message):
+        return {"leak": "partial"}
+
+    async def reject(message):
+        return False
+
+    async def first(*args, **kwargs):
+        return "first"
+
+    async def second(*args, leak=None, **kwargs):
+        return f"second leak={leak}"
+
+    router.message.register(first, main.F.text == "X", partial, reject)
+    router.message.register(second, main.F.text == "X")
+    leak_table = TextDispatchTable(router.message)
+    leak_table.build()
+    msg = make_message("X")
+    print("filter data leak:", await router.message.trigger(msg, bot=main.bot, raw_state=None),
+          "|", await leak_table.trigger(msg, bot=main.bot, raw_state=None))
+
+    await main.bot.session.close()
+
+
+asyncio.run(run())
@@ -0,0 +1,49 @@
+import os
+import sys
+import asyncio
+
+ROOT = os.path.dirname(os.path.dirname(__file__))
+sys.path.insert(0, ROOT)
+
+from _helpers import remove_db
+from database import init_db, close_db, add_user, get_user
+from user_session import UserSession
+
+
+async def run():
+    remove_db()
+    await init_db()
+    await add_user(1, "inviter")
+
+    # /start oqimi: get -> add_user -> get_ref_by -> is_verified
+    users = UserSession()
+    print("missing user:", await users.get(2))
+    await users.add_user(2, "invited", 1)
+    print("ref_by:", await users.get_ref_by(2), "verified:", await users.is_verified(2))
+    print("start flow queries:", users.queries)
+
+    # Telefon tasdiqlandi + taklif qilganga mukofot
+    await users.set_phone_verified(2, "+998901234567")
+    print("verified after phone:", await users.is_verified(2), "queries:", users.queries)
+    print("inviter balance:", await users.add_almaz(1, 5))
+
+    # Admin balans qo'shadi: get -> adjust -> yangi balans (qayta o'qishsiz)
+    users = UserSession()
+    row = await users.get(1)
+    print("typed row:", row.username, row.almaz, "positional:", row[3])
+    print("adjust ok:", await users.adjust_balance(1, 10, min_zero=False))
+    print("balance:", await users.balance(1), "queries:", users.queries)
+    print("rejected:", await users.adjust_balance(1, -1000), "balance:", await users.balance(1))
+    print("matches db:", (await get_user(1)) == await users.get(1), "phone in db:", (await get_user(2)).phone)
+
+    # Mavjud foydalanuvchi: ref_by faqat bo'sh bo'lsa o'rnatiladi
+    users = UserSession()
+    await users.get(2)
+    await users.add_user(2, "renamed", 1000)
+    print("existing ref_by kept:", await users.get_ref_by(2), "username:", (await users.get(2)).username)
+
+    await close_db()
+    remove_db()
+
+
+asyncio.run(run())
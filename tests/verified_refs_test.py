@@ -0,0 +1,64 @@
+import os
+import sys
+import asyncio
+import subprocess
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+
+from _helpers import remove_db
+from database import (
+    init_db, close_db, db_connection, add_user, create_referral, mark_referral_verified,
+    settle_verification, count_verified_referrals, reconcile_verified_refs,
+)
+
+
+def cli(*args) -> str:
+    # Joriy papkadagi bazaga qarshi: python database.py reconcile [--fix]
+    out = subprocess.run(
+        [sys.executable, os.path.join(ROOT, "database.py"), *args],
+        capture_output=True, text=True, timeout=60,
+    )
+    return out.stdout.strip()
+
+
+async def counters() -> list:
+    return [await count_verified_referrals(uid) for uid in (1, 2)]
+
+
+async def run():
+    remove_db()
+    await init_db()
+
+    # 1 — 5 ta taklif (3 tasi tasdiqlangan), 2 — 2 ta (1 tasi tasdiqlangan)
+    await add_user(1, "inviter1")
+    await add_user(2, "inviter2")
+    for invited, inviter in ((10, 1), (11, 1), (12, 1), (13, 1), (14, 1), (20, 2), (21, 2)):
+        await add_user(invited, f"u{invited}", inviter)
+        await create_referral(inviter, invited)
+    await mark_referral_verified(10)
+    await mark_referral_verified(11)
+    await settle_verification(12, "+998")
+    await settle_verification(12, "+998")
+    await mark_referral_verified(20)
+    print("counters:", await counters(), "(expected [3, 1])")
+    print("clean reconcile:", await reconcile_verified_refs())
+
+    # Hisoblagichni buzamiz
+    async with db_connection() as db:
+        await db.execute("UPDATE users SET verified_refs = 9 WHERE user_id = 1")
+        await db.execute("UPDATE users SET verified_refs = 0 WHERE user_id = 2")
+        await db.commit()
+    await close_db()
+
+    print("report:", cli("reconcile").splitlines()[:2])
+    print("fix:", [line for line in cli("reconcile", "--fix").splitlines() if "tuzatildi" in line])
+    print("after fix:", cli("reconcile").splitlines()[0])
+
+    await init_db()
+    print("counters after fix:", await counters(), "(expected [3, 1])")
+    await close_db()
+    remove_db()
+
+
+asyncio.run(run())
@@ -0,0 +1,68 @@
+import os
+import sys
+import asyncio
+
+ROOT = os.path.dirname(os.path.dirname(__file__))
+sys.path.insert(0, ROOT)
+os.environ.setdefault("BOT_TOKEN", "123456:ABCDEF")
+
+from _helpers import remove_db
+from database import (
+    init_db, close_db, db_connection, add_user, add_almaz, create_referral, mark_referral_verified,
+    create_withdraw_request, get_withdraw_request, get_withdraw_card, get_user, count_verified_referrals,
+)
+import main
+from main import WithdrawCardView
+
+
+async def separate(request_id: int) -> tuple:
+    # Kartadan oldingi usul: uchta alohida so'rov
+    row = await get_withdraw_request(request_id)
+    user = await get_user(row[1])
+    refs = await count_verified_referrals(row[1])
+    return tuple(row) + ((user.username if user else None), (user.almaz or 0) if user else 0, refs)
+
+
+async def run():
+    remove_db()
+    await init_db()
+
+    await add_user(1, "player")
+    await add_almaz(1, 700)
+    for invited in (10, 11, 12):
+        await add_user(invited, f"u{invited}", 1)
+        await create_referral(1, invited)
+    await mark_referral_verified(10)
+    await mark_referral_verified(11)
+    ff = await create_withdraw_request(1, 300, "123456789", game="ff")
+    pubg = await create_withdraw_request(1, 100, "555", game="pubg")
+
+    # Foydalanuvchi qatori yo'q — LEFT JOIN bo'sh qiymatlar beradi
+    async with db_connection() as db:
+        cur = await db.execute(
+            "INSERT INTO withdraw_requests(user_id, amount, ff_id, game, status, created_at) "
+            "VALUES(999, 50, '42', 'ff', 'pending', strftime('%s','now'))"
+        )
+        orphan = cur.lastrowid
+        await db.commit()
+
+    for name, request_id in (("ff", ff), ("pubg", pubg), ("missing user", orphan)):
+        card = await get_withdraw_card(request_id)
+        print(f"{name}: matches separate queries:", tuple(card) == await separate(request_id))
+    print("missing user card:", (await get_withdraw_card(orphan))[10:])
+    print("unknown request:", await get_withdraw_card(10 ** 6))
+
+    view = WithdrawCardView(await get_withdraw_card(ff))
+    text = view.admin_new()
+    print("admin_new:", "@player" in text, "700 so'm" in text, "<b>2</b>" in text, "Free Fire ID" in text)
+    print("pubg label:", WithdrawCardView(await get_withdraw_card(pubg)).id_label)
+    orphan_view = WithdrawCardView(await get_withdraw_card(orphan))
+    print("orphan mention:", orphan_view.mention, "| anonim:", "@Anonim" in orphan_view.admin_status("❌"))
+    print("receipt:", f"<code>{ff}</code>" in view.proof_receipt(), "Kutilmoqda" in view.proof_request())
+
+    await main.bot.session.close()
+    await close_db()
+    remove_db()
+
+
+asyncio.run(run())
@@ -0,0 +1,94 @@
+import os
+import sys
+import asyncio
+from collections import Counter
+from datetime import datetime
+
+ROOT = os.path.dirname(os.path.dirname(__file__))
+sys.path.insert(0, ROOT)
+from _helpers import remove_db
+os.environ.setdefault("BOT_TOKEN", "123456:ABCDEF")
+
+from aiogram.methods import AnswerCallbackQuery, SendMessage
+from aiogram.types import CallbackQuery, Chat, Message, Update, User
+
+import main
+from config import OWNER_ID, OWNER2_ID
+from database import (
+    init_db, close_db, add_user, add_almaz, get_user, create_withdraw_and_deduct,
+    transition_withdraw,
+)
+
+SENT = []
+USER_ID = 500
+
+
+async def fake_make_request(bot, method, timeout=None):
+    SENT.append(method)
+    # Parallel bosishlar bir-biriga aralashishi uchun API kechikishi
+    await asyncio.sleep(0.01)
+    return True
+
+
+_update_id = 0
+
+
+def callback_update(admin_id: int, data: str) -> Update:
+    global _update_id
+    _update_id += 1
+    user = User(id=admin_id, is_bot=False, first_name="admin")
+    msg = Message(message_id=_update_id, date=datetime.now(), chat=Chat(id=admin_id, type="private"), text="x")
+    cb = CallbackQuery(id=str(_update_id), from_user=user, chat_instance="ci", message=msg, data=data)
+    return Update(update_id=_update_id, callback_query=cb)
+
+
+def summary():
+    answers = Counter(
+        m.text.split(" '")[0] for m in SENT if isinstance(m, AnswerCallbackQuery)
+    )
+    to_user = [m for m in SENT if isinstance(m, SendMessage) and m.chat_id == USER_ID]
+    return dict(answers), len(to_user)
+
+
+async def run():
+    remove_db()
+    await init_db()
+    main.bot.session.make_request = fake_make_request
+    await add_user(USER_ID, "player")
+    await add_almaz(USER_ID, 1000)
+
+    # 10 ta parallel bosish: 5 tasdiqlash + 5 rad etish, ikki admindan
+    req_id = await create_withdraw_and_deduct(USER_ID, 300, "12345")
+    updates = []
+    for i in range(5):
+        updates.append(callback_update(OWNER_ID, f"wd_ok:{req_id}"))
+        updates.append(callback_update(OWNER2_ID, f"wd_reject:{req_id}"))
+    SENT.clear()
+    await asyncio.gather(*(main.dp.feed_update(main.bot, u) for u in updates))
+    answers, user_messages = summary()
+    print("answers:", answers)
+    print("messages to user:", user_messages)
+    print("balance after:", (await get_user(USER_ID)).almaz, "(expected 700)")
+
+    # Tasdiqlash qayta summa yechmaydi
+    req_id = await create_withdraw_and_deduct(USER_ID, 200, "12345")
+    SENT.clear()
+    await main.dp.feed_update(main.bot, callback_update(OWNER_ID, f"wd_ok:{req_id}"))
+    print("approve answers:", summary()[0], "balance:", (await get_user(USER_ID)).almaz, "(expected 500)")
+
+    # Yakuniy holatdan o'tish yo'q; noma'lum holat rad etiladi
+    ok, card = await transition_withdraw(req_id, "rejected", OWNER_ID)
+    print("approved -> rejected:", ok, card.status)
+    ok, card = await transition_withdraw(10 ** 6, "approved", OWNER_ID)
+    print("missing request:", ok, card)
+    try:
+        await transition_withdraw(req_id, "paid", OWNER_ID)
+    except ValueError as e:
+        print("unknown target:", e)
+
+    await main.fsm_storage.close()
+    await close_db()
+    remove_db()
+
+
+asyncio.run(run())
@@ -0,0 +1,69 @@
+import os
+import sys
+import time
+import asyncio
+
+ROOT = os.path.dirname(os.path.dirname(__file__))
+sys.path.insert(0, ROOT)
+
+from _helpers import remove_db
+import database
+from database import (
+    init_db, close_db, db_connection, add_user, get_user,
+    log_admin_action, add_withdraw_notification, get_withdraw_notifications,
+    write_behind_stats, touch_last_seen,
+)
+
+
+async def count(table: str) -> int:
+    async with db_connection() as db:
+        cur = await db.execute(f"SELECT COUNT(*) FROM {table}")
+        return (await cur.fetchone())[0]
+
+
+async def run():
+    remove_db()
+    await init_db()
+
+    # 10 ta admin uchun xabar id'lari — darhol o'qilganda ham ko'rinadi
+    started = time.perf_counter()
+    for chat_id in range(10):
+        await add_withdraw_notification(1, chat_id, 100 + chat_id)
+    print(f"10 notifications queued in {(time.perf_counter() - started) * 1000:.2f} ms")
+    print("notifications visible:", len(await get_withdraw_notifications(1)))
+
+    # max_rows chegarasi: 250 ta log bir nechta paketda yoziladi
+    for i in range(250):
+        await log_admin_action(1, "achko_add", i, 1, None)
+    await asyncio.sleep(database.WRITE_BEHIND_DELAY_MS / 1000 * 2)
+    print("admin actions after delay:", await count("admin_actions"))
+
+    # Username yangilanishi kechiktiriladi, yangi foydalanuvchi esa darhol yoziladi
+    await add_user(5, "old")
+    print("new user username:", (await get_user(5))[1])
+    await add_user(5, "new")
+    await log_admin_action(1, "last", None, None, None)
+
+    # Faollik keshi chegaralangan: eng eskilari boshidan chiqariladi
+    database.LAST_SEEN_MAX = 50
+    for uid in range(1000, 1200):
+        touch_last_seen(uid)
+    print("last_seen bounded:", len(database._LAST_SEEN) <= 50, "newest kept:", 1199 in database._LAST_SEEN,
+          "oldest evicted:", 1000 not in database._LAST_SEEN)
+
+    stats = write_behind_stats()
+    print("pending before close:", stats["pending"])
+    print("max batch <= limit:", stats["max_batch"] <= database.WRITE_BEHIND_MAX_ROWS)
+    print(f"flushes={stats['flushes']} rows={stats['rows']} avg_batch={stats['avg_batch']:.1f} "
+          f"p50_lag={stats['p50_lag_ms']:.1f}ms max_lag={stats['max_lag_ms']:.1f}ms")
+
+    await close_db()
+    print("admin actions after close:", await count("admin_actions"))
+    print("username after close:", (await get_user(5))[1])
+    print("failed rows:", write_behind_stats()["failed"])
+    await close_db()
+
+    remove_db()
+
+
+asyncio.run(run())
@@ -0,0 +1,39 @@
+import os
+import sys
+import sqlite3
+
+ROOT = os.path.dirname(os.path.dirname(__file__))
+sys.path.insert(0, ROOT)
+
+from database import _run_in_transaction
+
+# Kechiktirilgan FOREIGN KEY xatosi faqat COMMIT paytida chiqadi
+conn = sqlite3.connect(":memory:")
+conn.execute("PRAGMA foreign_keys=ON")
+conn.execute("CREATE TABLE parent (id INTEGER PRIMARY KEY)")
+conn.execute(
+    "CREATE TABLE child (id INTEGER PRIMARY KEY, "
+    "parent_id INTEGER REFERENCES parent(id) DEFERRABLE INITIALLY DEFERRED)"
+)
+conn.commit()
+
+
+def orphan(c):
+    c.execute("INSERT INTO child(parent_id) VALUES(42)")
+
+
+def ok(c):
+    c.execute("INSERT INTO parent(id) VALUES(1)")
+    c.execute("INSERT INTO child(parent_id) VALUES(1)")
+    return "ok"
+
+
+try:
+    _run_in_transaction(conn, orphan, ())
+    print("commit failed: False")
+except sqlite3.IntegrityError:
+    print("commit failed: True")
+print("still in transaction:", conn.in_transaction)
+print("next unit:", _run_in_transaction(conn, ok, ()))
+print("children:", conn.execute("SELECT COUNT(*) FROM child").fetchone()[0], "(expected 1)")
+conn.close()
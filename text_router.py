@@ -0,0 +1,160 @@
+# text_router.py - Tugma matni bo'yicha hash-jadval orqali dispatch
+import operator
+from typing import Any, NamedTuple, Optional
+
+from aiogram.dispatcher.event.bases import UNHANDLED, SkipHandler
+from aiogram.dispatcher.event.handler import FilterObject, HandlerObject
+from aiogram.dispatcher.event.telegram import TelegramEventObserver
+from aiogram.filters import StateFilter
+from aiogram.fsm.state import State
+from magic_filter.magic import in_op
+from magic_filter.operations import ComparatorOperation, FunctionOperation, GetAttributeOperation
+
+
+class _Entry(NamedTuple):
+    index: int
+    handler: HandlerObject
+    texts: Optional[frozenset]      # None — har qanday matn
+    states: Optional[frozenset]     # None — har qanday holat
+    residual: tuple                 # jadvalga sig'magan filtrlar (tartib saqlanadi)
+
+
+def _text_keys(flt: FilterObject) -> Optional[frozenset]:
+    # F.text == "..." yoki F.text.in_([...]) bo'lsa — matnlar to'plami
+    if flt.magic is None:
+        return None
+    ops = flt.magic._operations
+    if len(ops) != 2 or not isinstance(ops[0], GetAttributeOperation) or ops[0].name != "text":
+        return None
+    op = ops[1]
+    if isinstance(op, ComparatorOperation) and op.comparator is operator.eq and isinstance(op.right, str):
+        return frozenset((op.right,))
+    if isinstance(op, FunctionOperation) and op.function is in_op and len(op.args) == 1 and not op.kwargs:
+        values = op.args[0]
+        if isinstance(values, (list, tuple, set, frozenset)) and all(isinstance(v, str) for v in values):
+            return frozenset(values)
+    return None
+
+
+_ANY = object()
+
+
+def _state_key(state: Any):
+    if isinstance(state, State):
+        state = state.state
+    if state == "*":
+        return _ANY
+    if state is None or isinstance(state, str):
+        return state
+    raise TypeError(state)
+
+
+def _state_keys(flt: FilterObject):
+    # StateFilter(...) yoki to'g'ridan-to'g'ri State — holat satrlari to'plami
+    if isinstance(flt.callback, StateFilter):
+        states = flt.callback.states
+    elif isinstance(flt.callback, State):
+        states = (flt.callback,)
+    else:
+        return None
+    try:
+        keys = [_state_key(s) for s in states]
+    except TypeError:
+        # StatesGroup va h.k. — oddiy filtr sifatida tekshiriladi
+        return None
+    return _ANY if _ANY in keys else frozenset(keys)
+
+
+def _compile(index: int, handler: HandlerObject) -> _Entry:
+    texts = states = None
+    residual = []
+    for flt in handler.filters or ():
+        keys = _text_keys(flt)
+        if keys is not None:
+            texts = keys if texts is None else texts & keys
+            continue
+        keys = _state_keys(flt)
+        if keys is _ANY:
+            continue
+        if keys is not None:
+            states = keys if states is None else states & keys
+            continue
+        residual.append(flt)
+    return _Entry(index, handler, texts, states, tuple(residual))
+
+
+class TextDispatchTable:
+    """
+    Observer'dagi message handlerlarini bir marta tahlil qilib,
+    (matn, FSM holati) -> nomzod handlerlar jadvalini quradi. Natija
+    aiogram'ning o'zi bilan bir xil: ro'yxat tartibidagi birinchi mos handler.
+    """
+
+    def __init__(self, observer: TelegramEventObserver):
+        self._observer = observer
+        self._entries: list[_Entry] = []
+        self._texts: frozenset = frozenset()
+        self._memo: dict[tuple, tuple] = {}
+        self._count = -1
+
+    def build(self):
+        handlers = self._observer.handlers
+        self._entries = [_compile(i, h) for i, h in enumerate(handlers)]
+        self._texts = frozenset().union(*(e.texts for e in self._entries if e.texts is not None))
+        self._memo = {}
+        self._count = len(handlers)
+
+    def install(self) -> "TextDispatchTable":
+        self.build()
+        self._observer.trigger = self.trigger
+        return self
+
+    @property
+    def labels(self) -> frozenset:
+        return self._texts
+
+    def states(self) -> frozenset:
+        return frozenset().union(*(e.states for e in self._entries if e.states is not None))
+
+    def candidates(self, text: Optional[str], state: Optional[str]) -> tuple:
+        if len(self._observer.handlers) != self._count:
+            self.build()
+        key = (text if text in self._texts else None, state)
+        found = self._memo.get(key)
+        if found is None:
+            text = key[0]
+            found = tuple(
+                e for e in self._entries
+                if (e.texts is None or text in e.texts) and (e.states is None or state in e.states)
+            )
+            self._memo[key] = found
+        return found
+
+    async def trigger(self, event, **kwargs: Any) -> Any:
+        observer = self._observer
+        for entry in self.candidates(getattr(event, "text", None), kwargs.get("raw_state")):
+            handler = entry.handler
+            kwargs["handler"] = handler
+            # HandlerObject.check kabi: filtr natijalari nusxada yig'iladi va
+            # faqat handler mos kelsa kwargs'ga qo'shiladi
+            data = dict(kwargs)
+            passed = True
+            for flt in entry.residual:
+                check = await flt.call(event, **data)
+                if not check:
+                    passed = False
+                    break
+                if isinstance(check, dict):
+                    data.update(check)
+            if not passed:
+                continue
+            kwargs.update(data)
+            try:
+                wrapped_inner = observer.outer_middleware.wrap_middlewares(
+                    observer._resolve_middlewares(),
+                    handler.call,
+                )
+                return await wrapped_inner(event, kwargs)
+            except SkipHandler:
+                continue
+        return UNHANDLED
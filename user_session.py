@@ -0,0 +1,101 @@
+# user_session.py - Bitta yangilanish (update) doirasidagi foydalanuvchi qatorlari
+from typing import Optional
+
+from database import (
+    UserRow, Registration, get_user, add_user, register_user, add_almaz, apply_balance_delta,
+    set_verified, set_phone_verified,
+)
+
+_MISSING = object()
+
+
+class UserSession:
+    """
+    Identity map: bir yangilanish ichida har bir foydalanuvchi qatori
+    bazadan ko'pi bilan bir marta o'qiladi. Ma'lum yozuvlar (balans,
+    tasdiqlash, ref_by) bazaga yoziladi va keshdagi qatorga ham qo'llanadi.
+    """
+
+    def __init__(self):
+        self._rows: dict[int, Optional[UserRow]] = {}
+        self.queries = 0
+
+    async def get(self, user_id: int) -> Optional[UserRow]:
+        row = self._rows.get(user_id, _MISSING)
+        if row is _MISSING:
+            self.queries += 1
+            row = await get_user(user_id)
+            self._rows[user_id] = row
+        return row
+
+    def _cached(self, user_id: int) -> Optional[UserRow]:
+        return self._rows.get(user_id)
+
+    def forget(self, user_id: int):
+        self._rows.pop(user_id, None)
+
+    async def add_user(self, user_id: int, username: Optional[str] = None, ref_by: Optional[int] = None) -> bool:
+        inserted = await add_user(user_id, username, ref_by)
+        valid_ref = ref_by if ref_by and ref_by != user_id else None
+        row = self._cached(user_id)
+        if inserted:
+            self._rows[user_id] = UserRow(user_id, username, valid_ref, 0, 0, None)
+        elif row is not None:
+            self._rows[user_id] = row._replace(
+                username=username or row.username,
+                ref_by=row.ref_by if row.ref_by is not None else valid_ref,
+            )
+        else:
+            # Qator hali o'qilmagan — keyingi get() bazadan oladi
+            self.forget(user_id)
+        return inserted
+
+    async def register(self, user_id: int, username: Optional[str] = None, ref_id: Optional[int] = None) -> Registration:
+        result = await register_user(user_id, username, ref_id)
+        self._rows[user_id] = result.user
+        return result
+
+    async def get_ref_by(self, user_id: int) -> Optional[int]:
+        row = await self.get(user_id)
+        return row.ref_by if row else None
+
+    async def is_verified(self, user_id: int) -> bool:
+        row = await self.get(user_id)
+        try:
+            return bool(row and int(row.verified or 0))
+        except (TypeError, ValueError):
+            return False
+
+    async def balance(self, user_id: int) -> int:
+        row = await self.get(user_id)
+        return int(row.almaz or 0) if row else 0
+
+    def _set(self, user_id: int, **fields):
+        row = self._cached(user_id)
+        if row is not None:
+            self._rows[user_id] = row._replace(**fields)
+
+    async def adjust_balance(
+        self, user_id: int, delta: int, min_zero: bool = True, reason: str = "adjust", ref_id: Optional[int] = None
+    ) -> bool:
+        new_balance = await apply_balance_delta(user_id, delta, min_zero, reason, ref_id)
+        if new_balance is None:
+            return False
+        self._set(user_id, almaz=new_balance)
+        return True
+
+    async def add_almaz(
+        self, user_id: int, amount: int, reason: str = "credit", ref_id: Optional[int] = None
+    ) -> Optional[int]:
+        new_balance = await add_almaz(user_id, amount, reason, ref_id)
+        if new_balance is not None:
+            self._set(user_id, almaz=new_balance)
+        return new_balance
+
+    async def set_verified(self, user_id: int):
+        await set_verified(user_id)
+        self._set(user_id, verified=1)
+
+    async def set_phone_verified(self, user_id: int, phone: str):
+        await set_phone_verified(user_id, phone)
+        self._set(user_id, phone=phone, verified=1)